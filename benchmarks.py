@@ -0,0 +1,269 @@
+"""
+Benchmark suite for serializer_api and comm_engine.
+
+Runs every serialize/deserialize pair, full record round trips, and
+comm_engine frame writes/reads over a socketpair. Results (microseconds per
+operation) can be saved as a baseline JSON file, and later runs are compared
+against it, flagging the cases that got slower than the threshold.
+
+Usage:
+    python benchmarks.py                    run and compare with the baseline
+    python benchmarks.py --save-baseline    run and store the results as the
+                                            new baseline
+    python benchmarks.py --threshold 0.1    flag cases more than 10% slower
+    python benchmarks.py --filter string    only run cases containing "string"
+"""
+import argparse
+import json
+import os
+import socket
+import sys
+import threading
+import time
+import timeit
+
+import comm_engine
+import serializer_api
+
+DEFAULT_BASELINE_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                     'benchmark_baseline.json')
+
+DEFAULT_THRESHOLD = 0.2
+
+# minimum duration of each timed run, in seconds
+MIN_RUN_TIME = 0.2
+
+NUMBER_TYPES = [
+    ('byte', -5),
+    ('short', -3000),
+    ('int', 5000000),
+    ('long', -300000000000),
+]
+
+STRING_SIZES = [0, 16, 256, 4096, 65536]
+
+FRAME_SIZES = [
+    ('1B', 1),
+    ('254B', 254),
+    ('64KiB', 64 * 1024),
+    ('1MiB', 1024 * 1024),
+]
+
+FRAMES_PER_RUN = 64
+
+
+def _time_per_call(function):
+    """
+    Times a function, calibrating the number of calls so that each run lasts
+    at least MIN_RUN_TIME
+    :return: best (of 3 runs) time per call, in microseconds
+    """
+    number = 1
+    while True:
+        elapsed = timeit.timeit(function, number=number)
+        if elapsed >= MIN_RUN_TIME:
+            break
+        number *= 2 if elapsed == 0 else \
+            max(2, int(MIN_RUN_TIME / elapsed) + 1)
+    best = min([elapsed] + timeit.repeat(function, number=number, repeat=2))
+    return best / number * 1e6
+
+
+def _serializer_cases():
+    cases = []
+    for name, value in NUMBER_TYPES:
+        for kind in ('value', 'object'):
+            serialize = getattr(serializer_api,
+                                'serialize_%s_%s' % (name, kind))
+            deserialize = getattr(serializer_api,
+                                  'deserialize_%s_%s' % (name, kind))
+            data = serialize(value)
+            cases.append(('serialize_%s_%s' % (name, kind),
+                          lambda serialize=serialize, value=value:
+                          serialize(value)))
+            cases.append(('deserialize_%s_%s' % (name, kind),
+                          lambda deserialize=deserialize, data=data:
+                          deserialize(data)))
+    for size in STRING_SIZES:
+        string = u'x' * size
+        data = serializer_api.serialize_string(string)
+        cases.append(('serialize_string_%d' % size,
+                      lambda string=string:
+                      serializer_api.serialize_string(string)))
+        cases.append(('deserialize_string_%d' % size,
+                      lambda data=data: serializer_api.deserialize_string(data)))
+        cases.append(('reader_string_%d' % size,
+                      lambda data=data:
+                      serializer_api.Reader(data).read_string()))
+    return cases
+
+
+def _serialize_record(record):
+    peer_id, ip_address, port, country_code, wish_regular, connection_time = \
+        record
+    data = serializer_api.serialize_string(peer_id)
+    data += serializer_api.serialize_string(ip_address)
+    data += serializer_api.serialize_short_value(port)
+    data += serializer_api.serialize_string(country_code)
+    data += serializer_api.serialize_boolean(wish_regular)
+    data += serializer_api.serialize_long_object(connection_time)
+    return data
+
+
+def _deserialize_record(data):
+    m_offset = serializer_api.MutableOffset()
+    return (serializer_api.deserialize_string(data, m_offset),
+            serializer_api.deserialize_string(data, m_offset),
+            serializer_api.deserialize_short_value(data, m_offset),
+            serializer_api.deserialize_string(data, m_offset),
+            serializer_api.deserialize_boolean(data, m_offset),
+            serializer_api.deserialize_long_object(data, m_offset))
+
+
+def _read_record(data):
+    reader = serializer_api.Reader(data)
+    return (reader.read_string(),
+            reader.read_string(),
+            reader.read_short_value(),
+            reader.read_string(),
+            reader.read_boolean(),
+            reader.read_long_object())
+
+
+def _record_cases():
+    record = (u'%064x' % 0x1234567890abcdef, u'192.168.1.10', 12345, u'ES',
+              True, 1444000000000)
+    records = [record] * 100
+    return [
+        ('record_round_trip',
+         lambda: _deserialize_record(_serialize_record(record))),
+        ('record_round_trip_reader',
+         lambda: _read_record(_serialize_record(record))),
+        ('record_list_100_round_trip_reader',
+         lambda: [_read_record(_serialize_record(r)) for r in records]),
+    ]
+
+
+def _run_frames(writer, reader, write, read, payload):
+    # writes from a separate thread, so that large frames do not block on a
+    # full socket buffer while nobody reads
+    def write_all():
+        for i in range(FRAMES_PER_RUN):
+            write(writer, payload)
+
+    thread = threading.Thread(target=write_all)
+    thread.start()
+    for i in range(FRAMES_PER_RUN):
+        read(reader)
+    thread.join()
+
+
+def _frame_cases(socket_pair):
+    writer, reader = socket_pair
+    framed_writer = comm_engine.FramedSocket(writer)
+    framed_reader = comm_engine.FramedSocket(reader)
+    cases = []
+    for name, size in FRAME_SIZES:
+        payload = b'x' * size
+        cases.append((
+            'frame_%s_functions' % name,
+            lambda payload=payload: _run_frames(
+                writer, reader, comm_engine.write_data_to_socket,
+                comm_engine.read_data_from_socket, payload)))
+        cases.append((
+            'frame_%s_framed_socket' % name,
+            lambda payload=payload: _run_frames(
+                framed_writer, framed_reader,
+                comm_engine.FramedSocket.write_frame,
+                comm_engine.FramedSocket.read_frame_view, payload)))
+    return cases
+
+
+def run(name_filter=None):
+    """
+    Runs the benchmark cases
+    :param name_filter: if given, only the cases whose name contains it are
+    run
+    :return: dict mapping case names to microseconds per operation
+    """
+    socket_pair = socket.socketpair()
+    try:
+        cases = _serializer_cases() + _record_cases() + \
+                _frame_cases(socket_pair)
+        results = {}
+        for name, function in cases:
+            if name_filter and name_filter not in name:
+                continue
+            results[name] = _time_per_call(function)
+            if name.startswith('frame_'):
+                results[name] /= FRAMES_PER_RUN
+            print('%-40s %14.3f us' % (name, results[name]))
+        return results
+    finally:
+        for sock in socket_pair:
+            sock.close()
+
+
+def compare(results, baseline, threshold):
+    """
+    Compares results with a baseline
+    :param threshold: relative slowdown above which a case is flagged
+    :return: list of (case name, baseline time, new time) for the flagged
+    cases
+    """
+    regressions = []
+    for name in sorted(results):
+        if name in baseline and \
+                results[name] > baseline[name] * (1 + threshold):
+            regressions.append((name, baseline[name], results[name]))
+    return regressions
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(
+        description='Benchmarks for serializer_api and comm_engine')
+    parser.add_argument('--baseline', default=DEFAULT_BASELINE_FILE,
+                        help='baseline JSON file')
+    parser.add_argument('--save-baseline', action='store_true',
+                        help='store the results as the new baseline')
+    parser.add_argument('--threshold', type=float, default=DEFAULT_THRESHOLD,
+                        help='relative slowdown flagged as regression')
+    parser.add_argument('--filter', default=None,
+                        help='only run cases whose name contains this')
+    args = parser.parse_args(argv)
+
+    results = run(args.filter)
+
+    if args.save_baseline:
+        baseline = {}
+        if args.filter and os.path.exists(args.baseline):
+            with open(args.baseline) as f:
+                baseline = json.load(f)['results']
+        baseline.update(results)
+        with open(args.baseline, 'w') as f:
+            json.dump({'created': time.strftime('%Y-%m-%d %H:%M:%S'),
+                       'python': sys.version.split()[0],
+                       'results': baseline},
+                      f, indent=2, sort_keys=True)
+        print('Baseline saved to %s' % args.baseline)
+        return 0
+
+    if not os.path.exists(args.baseline):
+        print('No baseline found at %s (run with --save-baseline)' %
+              args.baseline)
+        return 0
+    with open(args.baseline) as f:
+        baseline = json.load(f)['results']
+    regressions = compare(results, baseline, args.threshold)
+    for name, baseline_time, new_time in regressions:
+        print('REGRESSION %-40s %10.3f us -> %10.3f us (+%.0f%%)' % (
+            name, baseline_time, new_time,
+            (new_time / baseline_time - 1) * 100))
+    if regressions:
+        return 1
+    print('No regressions above %.0f%%' % (args.threshold * 100))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,271 @@
+"""
+Two level read-through cache: a bounded in-process LRU in front of memcache.
+
+Lookups that find nothing are cached too (with a shorter TTL), so repeated
+lookups of missing keys do not reach the loader either.
+
+Loaded values are added to memcache, never set, and deletes lock their keys
+for DELETE_LOCK_TIME, so that a load racing an explicit set or delete cannot
+overwrite the entry with what it read before.
+"""
+import collections
+import threading
+
+import utils
+from storage import memcache
+
+# seconds during which loaded values cannot be added for deleted keys.
+# Longer than a load takes
+DELETE_LOCK_TIME = 10
+
+# registry of the created caches, by namespace, for reporting their stats
+_caches = {}
+
+
+class _Negative(object):
+    """
+    Marker stored for keys that the loader did not find
+    """
+    pass
+
+
+class LRUCache:
+    """
+    Thread safe LRU map with a size bound and per entry expiration.
+    """
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is None:
+                return default
+            value, expiration = entry
+            if expiration < utils.timestamp():
+                return default
+            # re-insert as most recently used
+            self._entries[key] = entry
+            return value
+
+    def set(self, key, value, ttl):
+        if self.max_size <= 0:
+            return
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = (value, utils.timestamp() + ttl)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+
+class ReadThroughCache:
+    """
+    Caches the results of a loader function in an in-process LRU, backed by
+    memcache. Entries in the LRU of other instances are not invalidated, so
+    this is meant for data that does not change once stored (or that can be
+    stale for up to the TTL).
+    """
+
+    def __init__(self, namespace, lru_size, ttl, negative_ttl):
+        """
+        :param namespace: memcache namespace of the cache
+        :param lru_size: maximum number of entries kept in process (0 to only
+        use memcache)
+        :param ttl: seconds that found values are cached
+        :param negative_ttl: seconds that lookups with no result are cached
+        """
+        self.namespace = namespace
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self._lru = LRUCache(lru_size)
+        self.local_hits = 0
+        self.shared_hits = 0
+        self.negative_hits = 0
+        self.misses = 0
+        _caches[namespace] = self
+
+    def get(self, key, loader):
+        """
+        Gets a value, loading it if it is not cached
+        :param key: key of the value (a string)
+        :param loader: function receiving the key and returning the value,
+        or None if there is no value for the key
+        :return: the value, or None if the loader found no value
+        """
+        value = self._lru.get(key)
+        if value is not None:
+            self.local_hits += 1
+            return self._unwrap(value)
+        value = memcache.get(key, namespace=self.namespace)
+        if value is not None:
+            self.shared_hits += 1
+            self._lru.set(key, value, self._ttl_of(value))
+            return self._unwrap(value)
+        self.misses += 1
+        loaded = loader(key)
+        self._fill(key, loaded)
+        return loaded
+
+    def get_multi(self, keys, loader):
+        """
+        Gets several values, loading the ones that are not cached in a single
+        call of the loader
+        :param keys: keys of the values
+        :param loader: function receiving a list of keys and returning a dict
+        with the found values by key
+        :return: dict with the found values by key
+        """
+        values = {}
+        missing_keys = []
+        for key in keys:
+            value = self._lru.get(key)
+            if value is not None:
+                self.local_hits += 1
+                values[key] = value
+            else:
+                missing_keys.append(key)
+        if missing_keys:
+            shared_values = memcache.get_multi(missing_keys,
+                                               namespace=self.namespace)
+            self.shared_hits += len(shared_values)
+            for key, value in shared_values.items():
+                self._lru.set(key, value, self._ttl_of(value))
+            values.update(shared_values)
+            missing_keys = [key for key in missing_keys
+                            if key not in shared_values]
+        if missing_keys:
+            self.misses += len(missing_keys)
+            loaded = loader(missing_keys)
+            self._fill_multi(dict((key, loaded.get(key))
+                                  for key in missing_keys))
+            values.update(loaded)
+        found = {}
+        for key, value in values.items():
+            value = self._unwrap(value)
+            if value is not None:
+                found[key] = value
+        return found
+
+    def peek(self, key):
+        """
+        Gets a value only if it is cached, for callers that load values
+        themselves (for example asynchronously) and then store them with set
+        :return: the value, or None if not cached (or cached as missing)
+        """
+        value = self._lru.get(key)
+        if value is not None:
+            self.local_hits += 1
+            return self._unwrap(value)
+        value = memcache.get(key, namespace=self.namespace)
+        if value is not None:
+            self.shared_hits += 1
+            self._lru.set(key, value, self._ttl_of(value))
+            return self._unwrap(value)
+        self.misses += 1
+        return None
+
+    def set(self, key, value, ttl=None):
+        """
+        Stores a value (None to record that there is no value for the key)
+        :param ttl: seconds to keep the value, if not the default of the cache
+        """
+        self._store(key, value, ttl)
+
+    def set_multi(self, values):
+        """
+        Stores several values
+        :param values: dict of values (or None for no value) by key
+        """
+        by_ttl = {}
+        for key, value in values.items():
+            if value is None:
+                value = _Negative()
+            ttl = self._ttl_of(value)
+            self._lru.set(key, value, ttl)
+            by_ttl.setdefault(ttl, {})[key] = value
+        for ttl, ttl_values in by_ttl.items():
+            memcache.set_multi(ttl_values, time=ttl, namespace=self.namespace)
+
+    def delete(self, key):
+        self._lru.delete(key)
+        memcache.delete(key, seconds=DELETE_LOCK_TIME,
+                        namespace=self.namespace)
+
+    def delete_multi(self, keys):
+        for key in keys:
+            self._lru.delete(key)
+        memcache.delete_multi(keys, seconds=DELETE_LOCK_TIME,
+                              namespace=self.namespace)
+
+    def stats(self):
+        lookups = self.local_hits + self.shared_hits + self.misses
+        return {
+            'local_hits': self.local_hits,
+            'shared_hits': self.shared_hits,
+            'negative_hits': self.negative_hits,
+            'misses': self.misses,
+            'hit_rate': float(lookups - self.misses) / lookups
+            if lookups else 0.0,
+            'local_size': len(self._lru),
+        }
+
+    def _store(self, key, value, ttl=None):
+        if value is None:
+            value = _Negative()
+        if ttl is None:
+            ttl = self._ttl_of(value)
+        self._lru.set(key, value, ttl)
+        memcache.set(key, value, time=ttl, namespace=self.namespace)
+
+    def _fill(self, key, value):
+        # values loaded on a miss are only added, so that a load racing an
+        # explicit set or delete never overwrites it
+        if value is None:
+            value = _Negative()
+        ttl = self._ttl_of(value)
+        self._lru.set(key, value, ttl)
+        memcache.add(key, value, time=ttl, namespace=self.namespace)
+
+    def _fill_multi(self, values):
+        by_ttl = {}
+        for key, value in values.items():
+            if value is None:
+                value = _Negative()
+            ttl = self._ttl_of(value)
+            self._lru.set(key, value, ttl)
+            by_ttl.setdefault(ttl, {})[key] = value
+        for ttl, ttl_values in by_ttl.items():
+            memcache.add_multi(ttl_values, time=ttl, namespace=self.namespace)
+
+    def _ttl_of(self, value):
+        if isinstance(value, _Negative):
+            return self.negative_ttl
+        return self.ttl
+
+    def _unwrap(self, value):
+        if isinstance(value, _Negative):
+            self.negative_hits += 1
+            return None
+        return value
+
+
+def all_stats():
+    """
+    :return: dict with the stats of every created cache, by namespace
+    """
+    return dict((namespace, cache.stats())
+                for namespace, cache in _caches.items())
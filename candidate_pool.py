@@ -0,0 +1,40 @@
+"""
+Weighted sampling of candidate peers by how recently each peer was handed
+out, used by peer_pool.py.
+"""
+import random
+
+# seconds after a peer is handed out during which its sampling weight is
+# reduced (linearly recovering to full weight)
+DEFAULT_HANDOUT_COOLDOWN = 5 * 60
+
+# weight of a peer that has just been handed out. Not zero, so that small
+# pools still return their peers
+MIN_WEIGHT = 0.05
+
+# when weighting, this many candidates per requested peer are drawn
+# uniformly, and the requested peers are chosen among them by weight
+OVERSAMPLING = 3
+
+
+def handout_weight(last_handout, now, handout_cooldown):
+    if last_handout is None:
+        return 1.0
+    return max(MIN_WEIGHT,
+               min(1.0, float(now - last_handout) / handout_cooldown))
+
+
+def weighted_sample(candidates, count, last_handouts, now,
+                    handout_cooldown=DEFAULT_HANDOUT_COOLDOWN):
+    """
+    Picks peers among candidates without repetition, weighted by how long
+    ago they were last handed out (Efraimidis-Spirakis sampling)
+    :param last_handouts: dict with the last handout time of the candidates
+    that have one
+    :return: list of peer IDs
+    """
+    keyed = [(random.random() ** (1.0 / handout_weight(
+        last_handouts.get(peer_id), now, handout_cooldown)), peer_id)
+        for peer_id in candidates]
+    keyed.sort(reverse=True)
+    return [peer_id for key, peer_id in keyed[:count]]
@@ -0,0 +1,113 @@
+"""
+Change log of the active sessions, for incremental info polling.
+
+Connects, disconnects and expirations get a version from a counter shared
+by all instances in memcache. Connected sessions store their version
+(ActiveSession.changeVersion), and removed peers leave a tombstone with the
+version of their removal. A poll then returns the peers whose version is
+newer than the version the client last saw.
+
+Versions follow the time in microseconds (each bump sets the counter to the
+current time, or one more than its value if that is greater), so they keep
+increasing if memcache loses the counter, and a poll can tell which changes
+may still be in flight: it only covers the changes older than
+IN_FLIGHT_MARGIN, and newer ones are returned again by the next poll.
+
+Tombstones only cover the removals after the tombstone_horizon: older ones
+have expired, or may have been lost with memcache. A poll whose last seen
+version is older than the horizon cannot tell which of the peers without
+session were removed since, and reports them all.
+"""
+import logging
+
+import utils
+from storage import memcache
+
+NAMESPACE = 'change_log'
+TOMBSTONES_NAMESPACE = 'change_log_tombstones'
+
+VERSION_KEY = 'version'
+# version from which the tombstones are kept (lost with them if memcache is
+# flushed)
+TOMBSTONES_SINCE_KEY = 'tombstones_since'
+
+# attempts to bump the version counter when other instances bump it at the
+# same time
+CAS_RETRIES = 10
+
+# microseconds within which a change (such as a connect, between getting its
+# version and storing its session) is assumed to complete
+IN_FLIGHT_MARGIN = 10 * 1000000
+
+# seconds that tombstones are kept. Polls with an older last seen version
+# have every peer without session reported as removed
+TOMBSTONE_TTL = 60 * 60
+
+
+def next_version():
+    """
+    :return: a new version, greater than all the previous ones
+    """
+    client = memcache.Client()
+    for i in range(CAS_RETRIES):
+        now = _now_microseconds()
+        current = client.gets(VERSION_KEY, namespace=NAMESPACE)
+        if current is None:
+            if memcache.add(VERSION_KEY, now, namespace=NAMESPACE):
+                return now
+        else:
+            version = max(current + 1, now)
+            if client.cas(VERSION_KEY, version, namespace=NAMESPACE):
+                return version
+    # memcache failed or too contended, the time is the best approximation
+    logging.warning("Could not bump the change log version")
+    return _now_microseconds()
+
+
+def covered_version():
+    """
+    :return: the version up to which a poll made now sees all the changes
+    """
+    return _now_microseconds() - IN_FLIGHT_MARGIN
+
+
+def tombstone_horizon():
+    """
+    :return: the version after which every removal has a tombstone (unless
+    memcache evicted it)
+    """
+    now = _now_microseconds()
+    since = memcache.get(TOMBSTONES_SINCE_KEY,
+                         namespace=TOMBSTONES_NAMESPACE)
+    if since is None:
+        # lost with the tombstones, so only the removals from now on are
+        # known. Another instance may have set it in the meantime
+        if not memcache.add(TOMBSTONES_SINCE_KEY, now,
+                            namespace=TOMBSTONES_NAMESPACE):
+            since = memcache.get(TOMBSTONES_SINCE_KEY,
+                                 namespace=TOMBSTONES_NAMESPACE)
+        since = since or now
+    return max(since, now - TOMBSTONE_TTL * 1000000)
+
+
+def record_removals(peer_ids):
+    """
+    Leaves tombstones of peers whose session was removed
+    """
+    if not peer_ids:
+        return
+    version = next_version()
+    memcache.set_multi(dict((peer_id, version) for peer_id in peer_ids),
+                       time=TOMBSTONE_TTL, namespace=TOMBSTONES_NAMESPACE)
+
+
+def removal_versions(peer_ids):
+    """
+    :return: dict with the version of the removal of the given peers that
+    have a tombstone, by peerID
+    """
+    return memcache.get_multi(peer_ids, namespace=TOMBSTONES_NAMESPACE)
+
+
+def _now_microseconds():
+    return int(utils.timestamp() * 1000000)
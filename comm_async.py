@@ -0,0 +1,228 @@
+"""
+Event driven server and client for the comm_engine frame protocol.
+
+Built on asyncore with a poll based loop (asyncio is not available on the
+python27 runtime), so a single thread can serve thousands of connections.
+Frames use the same length-prefixed format as read_data_from_socket and
+write_data_to_socket.
+"""
+__author__ = 'Alberto'
+import asyncore
+import collections
+import errno
+import socket
+
+import comm_engine
+
+# outgoing data above the high mark pauses reading from the connection (so a
+# peer that does not read its responses cannot make us buffer without limit),
+# reading resumes once the buffered data drops below the low mark
+DEFAULT_WRITE_BUFFER_HIGH = 256 * 1024
+DEFAULT_WRITE_BUFFER_LOW = 64 * 1024
+
+DEFAULT_LISTEN_BACKLOG = 1024
+
+# per connection receive buffers start small (they grow to fit larger
+# frames) to keep memory bounded with thousands of open connections
+DEFAULT_RECEIVE_BUFFER_SIZE = 8192
+
+_WOULD_BLOCK = (errno.EAGAIN, errno.EWOULDBLOCK)
+
+
+class FrameConnection(asyncore.dispatcher):
+    """
+    Non-blocking frame stream over a connected socket.
+
+    Subclasses implement frame_received. Frames are sent with send_frame,
+    which only buffers them; the event loop writes the buffer as the socket
+    becomes writable, coalescing all pending frames in each send.
+    """
+
+    def __init__(self, sock=None, map=None,
+                 receive_buffer_size=DEFAULT_RECEIVE_BUFFER_SIZE):
+        asyncore.dispatcher.__init__(self, sock, map)
+        self._frame_buffer = comm_engine.FrameBuffer(receive_buffer_size)
+        self._out_buffer = bytearray()
+        self._write_buffer_high = DEFAULT_WRITE_BUFFER_HIGH
+        self._write_buffer_low = DEFAULT_WRITE_BUFFER_LOW
+        self._reading_paused = False
+
+    def set_write_buffer_limits(self, high, low=None):
+        """
+        Sets the outgoing buffer sizes that pause and resume reading
+        :param high: buffered byte count above which reading is paused
+        :param low: buffered byte count below which reading is resumed
+        (high / 4 if not given)
+        """
+        if low is None:
+            low = high // 4
+        self._write_buffer_high = high
+        self._write_buffer_low = low
+
+    def get_write_buffer_size(self):
+        return len(self._out_buffer)
+
+    def send_frame(self, data):
+        """
+        Buffers a frame for sending
+        :param data: payload of the frame. Empty payloads are not sent
+        """
+        if len(data) > 0:
+            self._out_buffer += comm_engine.encode_frame_header(len(data))
+            self._out_buffer += data
+            if len(self._out_buffer) > self._write_buffer_high:
+                self._reading_paused = True
+
+    def frame_received(self, frame):
+        """
+        Called for every received frame
+        :param frame: memoryview over the frame payload, only valid during
+        the call
+        """
+        raise NotImplementedError
+
+    def readable(self):
+        return not self._reading_paused
+
+    def writable(self):
+        return bool(self._out_buffer) or not self.connected
+
+    def handle_read(self):
+        try:
+            received = self.socket.recv_into(
+                self._frame_buffer.writable_view())
+        except socket.error as e:
+            if e.args[0] in _WOULD_BLOCK:
+                return
+            raise
+        if received == 0:
+            self.handle_close()
+            return
+        self._frame_buffer.advance(received)
+        frame = self._frame_buffer.next_frame()
+        while frame is not None:
+            self.frame_received(frame)
+            frame = self._frame_buffer.next_frame()
+
+    def handle_write(self):
+        sent = self.send(self._out_buffer)
+        if sent:
+            del self._out_buffer[:sent]
+        if self._reading_paused and \
+                len(self._out_buffer) <= self._write_buffer_low:
+            self._reading_paused = False
+
+    def handle_connect(self):
+        pass
+
+    def handle_close(self):
+        self.close()
+
+
+class FrameServerConnection(FrameConnection):
+    """
+    Server side of a connection. Every received frame is passed to the
+    request handler and its result (if any) is sent back as a frame. Requests
+    can be pipelined: responses are sent in the order of the requests.
+    """
+
+    def __init__(self, sock, map, request_handler, receive_buffer_size,
+                 write_buffer_high, write_buffer_low):
+        FrameConnection.__init__(self, sock, map, receive_buffer_size)
+        self.set_write_buffer_limits(write_buffer_high, write_buffer_low)
+        self._request_handler = request_handler
+
+    def frame_received(self, frame):
+        response = self._request_handler(frame)
+        if response is not None:
+            self.send_frame(response)
+
+
+class FrameServer(asyncore.dispatcher):
+    """
+    Listening socket accepting frame connections.
+    """
+
+    def __init__(self, host, port, request_handler, map=None,
+                 backlog=DEFAULT_LISTEN_BACKLOG,
+                 receive_buffer_size=DEFAULT_RECEIVE_BUFFER_SIZE,
+                 write_buffer_high=DEFAULT_WRITE_BUFFER_HIGH,
+                 write_buffer_low=DEFAULT_WRITE_BUFFER_LOW):
+        """
+        :param host: address to listen on
+        :param port: port to listen on (0 for any free port)
+        :param request_handler: function receiving each request frame (as a
+        memoryview) and returning the response payload, or None for no
+        response
+        :param map: asyncore socket map to register in (None for the global
+        one)
+        """
+        asyncore.dispatcher.__init__(self, map=map)
+        self._map = map
+        self._request_handler = request_handler
+        self._receive_buffer_size = receive_buffer_size
+        self._write_buffer_high = write_buffer_high
+        self._write_buffer_low = write_buffer_low
+        self.create_socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.set_reuse_addr()
+        self.bind((host, port))
+        self.listen(backlog)
+
+    def get_port(self):
+        return self.socket.getsockname()[1]
+
+    def handle_accept(self):
+        # accept every pending connection, not just one per loop iteration
+        pair = self.accept()
+        while pair is not None:
+            sock, address = pair
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            FrameServerConnection(
+                sock, self._map, self._request_handler,
+                self._receive_buffer_size, self._write_buffer_high,
+                self._write_buffer_low)
+            pair = self.accept()
+
+    def serve_forever(self, timeout=1.0):
+        run(timeout, self._map)
+
+
+class FrameClient(FrameConnection):
+    """
+    Client connection that pipelines requests: any number of requests can be
+    sent without waiting for responses, and each response is delivered to
+    the callback of the oldest pending request.
+    """
+
+    def __init__(self, host, port, map=None,
+                 receive_buffer_size=DEFAULT_RECEIVE_BUFFER_SIZE):
+        FrameConnection.__init__(self, map=map,
+                                 receive_buffer_size=receive_buffer_size)
+        self._callbacks = collections.deque()
+        self.create_socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.connect((host, port))
+
+    def send_request(self, data, callback):
+        """
+        Sends a request frame
+        :param data: payload of the request
+        :param callback: function receiving the response payload (as bytes)
+        """
+        self._callbacks.append(callback)
+        self.send_frame(data)
+
+    def pending_requests(self):
+        return len(self._callbacks)
+
+    def frame_received(self, frame):
+        callback = self._callbacks.popleft()
+        callback(frame.tobytes())
+
+
+def run(timeout=1.0, map=None, count=None):
+    """
+    Runs the event loop using poll, which (unlike select) is not limited in
+    the number of sockets it can watch
+    """
+    asyncore.loop(timeout=timeout, use_poll=True, map=map, count=count)
@@ -0,0 +1,90 @@
+"""
+Loopback benchmark for comm_async: many pipelining clients against an echo
+FrameServer. Reports frames/sec and request latency percentiles.
+
+Usage: python comm_async_benchmark.py [connections] [pipeline depth]
+                                      [requests per connection] [payload size]
+"""
+import asyncore
+import sys
+import threading
+import time
+
+import comm_async
+
+
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, int(len(sorted_values) * fraction))
+    return sorted_values[index]
+
+
+class _BenchmarkClient:
+    def __init__(self, port, client_map, depth, requests, payload, latencies):
+        self.client = comm_async.FrameClient('127.0.0.1', port, client_map)
+        self.payload = payload
+        self.remaining = requests
+        self.latencies = latencies
+        self.depth = depth
+
+    def start(self):
+        for i in range(min(self.depth, self.remaining)):
+            self._send()
+
+    def done(self):
+        return self.remaining == 0 and self.client.pending_requests() == 0
+
+    def _send(self):
+        self.remaining -= 1
+        sent_time = time.time()
+
+        def on_response(response):
+            self.latencies.append(time.time() - sent_time)
+            if self.remaining > 0:
+                self._send()
+
+        self.client.send_request(self.payload, on_response)
+
+
+def main(connections=100, depth=16, requests=1000, payload_size=64):
+    server_map = {}
+    server = comm_async.FrameServer('127.0.0.1', 0, lambda frame: frame,
+                                    map=server_map)
+    server_thread = threading.Thread(target=server.serve_forever,
+                                     args=(0.1,))
+    server_thread.start()
+
+    client_map = {}
+    latencies = []
+    payload = b'x' * payload_size
+    clients = [_BenchmarkClient(server.get_port(), client_map, depth,
+                                requests, payload, latencies)
+               for i in range(connections)]
+    # establish all the connections before timing
+    while not all(client.client.connected for client in clients):
+        comm_async.run(timeout=0.1, map=client_map, count=1)
+    start = time.time()
+    for client in clients:
+        client.start()
+    while not all(client.done() for client in clients):
+        comm_async.run(timeout=0.1, map=client_map, count=1)
+    elapsed = time.time() - start
+    asyncore.close_all(client_map)
+    asyncore.close_all(server_map)
+    server_thread.join()
+
+    latencies.sort()
+    print('connections: %d, pipeline depth: %d, payload: %d bytes' % (
+        connections, depth, payload_size))
+    print('frames: %d in %.2f s -> %.0f frames/sec' % (
+        len(latencies), elapsed, len(latencies) / elapsed))
+    print('latency (ms): p50 %.3f, p95 %.3f, p99 %.3f, max %.3f' % (
+        percentile(latencies, 0.50) * 1000,
+        percentile(latencies, 0.95) * 1000,
+        percentile(latencies, 0.99) * 1000,
+        latencies[-1] * 1000))
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:]])
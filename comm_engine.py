@@ -1,37 +1,434 @@
 __author__ = 'Alberto'
+import collections
+import contextlib
+import select
+import threading
+import time
+
 import serializer_api
 import httplib
 
+# frames are prefixed by a variable length header: one byte for lengths
+# below 255, otherwise a 255 byte followed by a two byte length, or (for
+# lengths of 65536 and above) by a zero short and a four byte length
+SHORT_LENGTH_MARK = 255
+MAX_SHORT_LENGTH = 65536
+
+DEFAULT_RECEIVE_BUFFER_SIZE = 65536
+
+# connection pool defaults: open connections per remote peer, and seconds
+# that an idle connection is kept before being closed
+DEFAULT_POOL_MAX_SIZE = 4
+DEFAULT_POOL_IDLE_TIMEOUT = 60.0
+
+
+class PoolExhaustedError(Exception):
+    pass
+
 
 class CommModule:
-    def __init__(self):
-        self.socket = httplib.socket.socket(httplib.socket.AF_INET, httplib.socket.SOCK_STREAM)
+    def __init__(self, pool=None):
+        self.pool = pool if pool is not None else default_pool
+
+    def exchange(self, host, port, data):
+        """
+        Sends a frame to a peer and waits for its response frame, reusing a
+        pooled connection to the peer if one is available
+        :param host: address of the peer
+        :param port: port of the peer
+        :param data: payload to send
+        :return: the payload of the response
+        """
+        with self.pool.connection(host, port) as framed_socket:
+            framed_socket.write_frame(data)
+            return framed_socket.read_frame()
+
+
+class ConnectionPool:
+    """
+    Pool of connected FramedSockets, keyed by (host, port) of the peer.
+
+    At most max_size connections are open per peer; checkouts beyond that
+    wait for a connection to be returned. Idle connections are closed after
+    idle_timeout seconds, by the first checkout or checkin (to any peer) once
+    they are, and at most idle_timeout / 2 seconds later (evict_idle runs at
+    most that often). Connections closed by the peer are discarded at
+    checkout. Thread safe.
+    """
+
+    def __init__(self, max_size=DEFAULT_POOL_MAX_SIZE,
+                 idle_timeout=DEFAULT_POOL_IDLE_TIMEOUT, connect_timeout=None):
+        self.max_size = max_size
+        self.idle_timeout = idle_timeout
+        self.connect_timeout = connect_timeout
+        self._lock = threading.Lock()
+        self._released = threading.Condition(self._lock)
+        # (host, port) -> deque of (framed socket, time of last use), most
+        # recently used at the right
+        self._idle = {}
+        # (host, port) -> number of open connections (idle or checked out)
+        self._open = collections.defaultdict(int)
+        # time after which the next checkout or checkin runs evict_idle
+        self._next_eviction = time.time() + idle_timeout / 2.0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @contextlib.contextmanager
+    def connection(self, host, port, timeout=None):
+        """
+        Checks out a connection for the duration of a with block. If the
+        block raises, the connection is closed instead of returned
+        """
+        framed_socket = self.checkout(host, port, timeout)
+        try:
+            yield framed_socket
+        except BaseException:
+            self.checkin(host, port, framed_socket, reusable=False)
+            raise
+        self.checkin(host, port, framed_socket)
+
+    def checkout(self, host, port, timeout=None):
+        """
+        Gets a connection to a peer, connecting only if no live idle
+        connection is pooled
+        :param host: address of the peer
+        :param port: port of the peer
+        :param timeout: seconds to wait for a connection if max_size are
+        already checked out (None waits indefinitely)
+        :return: a connected FramedSocket
+        """
+        self._evict_idle_if_due()
+        key = (host, port)
+        deadline = None if timeout is None else time.time() + timeout
+        with self._lock:
+            while True:
+                framed_socket = self._pop_idle(key)
+                if framed_socket is not None:
+                    self.hits += 1
+                    return framed_socket
+                if self._open[key] < self.max_size:
+                    self._open[key] += 1
+                    self.misses += 1
+                    break
+                remaining = None if deadline is None else deadline - time.time()
+                if remaining is not None and remaining <= 0:
+                    raise PoolExhaustedError(
+                        "No connection to %s:%d available" % key)
+                self._released.wait(remaining)
+        try:
+            sock = httplib.socket.create_connection(key, self.connect_timeout)
+        except Exception:
+            with self._lock:
+                self._open[key] -= 1
+                self._released.notify()
+            raise
+        return FramedSocket(sock)
+
+    def checkin(self, host, port, framed_socket, reusable=True):
+        """
+        Returns a checked out connection to the pool
+        :param reusable: False if the connection is in an unknown state (for
+        example after an error) and must be closed
+        """
+        key = (host, port)
+        with self._lock:
+            if reusable:
+                self._idle.setdefault(key, collections.deque()).append(
+                    (framed_socket, time.time()))
+            else:
+                self._open[key] -= 1
+            self._released.notify()
+        if not reusable:
+            framed_socket.close()
+        self._evict_idle_if_due()
+
+    def evict_idle(self):
+        """
+        Closes every pooled connection idle for longer than idle_timeout
+        """
+        limit = time.time() - self.idle_timeout
+        expired = []
+        with self._lock:
+            for key, idle in self._idle.items():
+                while idle and idle[0][1] < limit:
+                    expired.append(idle.popleft()[0])
+                    self._open[key] -= 1
+                    self.evictions += 1
+            self._released.notify_all()
+        for framed_socket in expired:
+            framed_socket.close()
+
+    def close(self):
+        with self._lock:
+            idle = self._idle
+            self._idle = {}
+            for key, connections in idle.items():
+                self._open[key] -= len(connections)
+            self._released.notify_all()
+        for connections in idle.values():
+            for framed_socket, last_use in connections:
+                framed_socket.close()
+
+    def stats(self):
+        with self._lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'idle': sum(len(idle) for idle in self._idle.values()),
+                'open': sum(self._open.values()),
+            }
+
+    def _evict_idle_if_due(self):
+        now = time.time()
+        with self._lock:
+            if now < self._next_eviction:
+                return
+            self._next_eviction = now + self.idle_timeout / 2.0
+        self.evict_idle()
+
+    def _pop_idle(self, key):
+        # called with the lock held
+        idle = self._idle.get(key)
+        limit = time.time() - self.idle_timeout
+        while idle:
+            framed_socket, last_use = idle.pop()
+            if last_use >= limit and _is_alive(framed_socket):
+                return framed_socket
+            self._open[key] -= 1
+            self.evictions += 1
+            framed_socket.close()
+        return None
+
+
+def _is_alive(framed_socket):
+    # an idle connection must have nothing to read: readable means that the
+    # peer closed it (or sent unexpected data), so it cannot be reused
+    try:
+        readable, writable, failed = select.select(
+            [framed_socket.socket], [], [], 0)
+    except (select.error, ValueError):
+        return False
+    return not readable
+
+
+class FrameBuffer:
+    """
+    Receive buffer that incoming data is written into directly and from which
+    complete frames are decoded without copying them.
+    """
+
+    def __init__(self, size=DEFAULT_RECEIVE_BUFFER_SIZE):
+        self._buffer = bytearray(size)
+        # unread data lives in self._buffer[self._start:self._end]
+        self._start = 0
+        self._end = 0
+
+    def writable_view(self):
+        """
+        :return: memoryview over the free space at the end of the buffer, to
+        be passed to recv_into. Call advance with the received byte count
+        """
+        if self._start == self._end:
+            self._start = self._end = 0
+        elif self._end == len(self._buffer):
+            self._compact()
+        return memoryview(self._buffer)[self._end:]
+
+    def advance(self, count):
+        self._end += count
+
+    def next_frame(self):
+        """
+        Decodes the next buffered frame
+        :return: a memoryview over the payload, only valid until the buffer is
+        written again, or None if no complete frame is buffered
+        """
+        header = decode_frame_header(self._buffer, self._start, self._end)
+        if header is None:
+            return None
+        length, header_size = header
+        frame_start = self._start + header_size
+        if frame_start + length > self._end:
+            self._reserve(header_size + length)
+            return None
+        self._start = frame_start + length
+        return memoryview(self._buffer)[frame_start:self._start]
+
+    def _reserve(self, size):
+        # make room for a frame of the given total size starting at _start
+        if size > len(self._buffer):
+            buffer = bytearray(max(size, 2 * len(self._buffer)))
+            buffer[:self._end - self._start] = \
+                self._buffer[self._start:self._end]
+            self._buffer = buffer
+            self._end -= self._start
+            self._start = 0
+        elif self._start + size > len(self._buffer):
+            self._compact()
+
+    def _compact(self):
+        unread = self._end - self._start
+        self._buffer[:unread] = self._buffer[self._start:self._end]
+        self._start = 0
+        self._end = unread
+
+
+class FramedSocket:
+    """
+    Length-prefixed frame stream over a connected socket.
+
+    Received data is accumulated in a FrameBuffer filled with large recv_into
+    calls, from which any number of complete frames are decoded. Written
+    frames are queued together with their headers and sent with a single
+    sendall on flush.
+    """
+
+    def __init__(self, socket, receive_buffer_size=DEFAULT_RECEIVE_BUFFER_SIZE):
+        self.socket = socket
+        self._frame_buffer = FrameBuffer(receive_buffer_size)
+        self._pending = bytearray()
+
+    def read_frame(self):
+        """
+        Reads the next frame, blocking until it has been fully received
+        :return: the frame payload
+        """
+        return self.read_frame_view().tobytes()
+
+    def read_frame_view(self):
+        """
+        Reads the next frame without copying it out of the receive buffer
+        :return: a memoryview over the payload, only valid until the next read
+        """
+        frame = self._frame_buffer.next_frame()
+        while frame is None:
+            self._receive()
+            frame = self._frame_buffer.next_frame()
+        return frame
+
+    def read_frames(self):
+        """
+        Reads all the frames that can be decoded from the buffered data,
+        receiving from the socket only if no complete frame is buffered
+        :return: list with the payloads of the read frames (at least one)
+        """
+        frames = [self.read_frame()]
+        frame = self._frame_buffer.next_frame()
+        while frame is not None:
+            frames.append(frame.tobytes())
+            frame = self._frame_buffer.next_frame()
+        return frames
+
+    def queue_frame(self, data):
+        """
+        Queues a frame for sending. Queued frames are sent on flush
+        :param data: payload of the frame. Empty payloads are not sent
+        """
+        if len(data) > 0:
+            self._pending += encode_frame_header(len(data))
+            self._pending += data
+
+    def write_frame(self, data):
+        """
+        Sends a frame, together with any previously queued frames
+        :param data: payload of the frame
+        """
+        self.queue_frame(data)
+        self.flush()
+
+    def flush(self):
+        if self._pending:
+            pending = self._pending
+            self._pending = bytearray()
+            self.socket.sendall(pending)
+
+    def close(self):
+        self.socket.close()
+
+    def _receive(self):
+        received = self.socket.recv_into(self._frame_buffer.writable_view())
+        if received == 0:
+            raise EOFError("Connection closed by peer")
+        self._frame_buffer.advance(received)
+
+
+def encode_frame_header(length):
+    """
+    Encodes the header of a frame
+    :param length: length of the frame payload
+    :return: byte array with the header
+    """
+    if length < SHORT_LENGTH_MARK:
+        return serializer_api.serialize_byte_value(length)
+    elif length < MAX_SHORT_LENGTH:
+        return serializer_api.serialize_byte_value(SHORT_LENGTH_MARK) + \
+               serializer_api.serialize_short_value(length)
+    else:
+        return serializer_api.serialize_byte_value(SHORT_LENGTH_MARK) + \
+               serializer_api.serialize_short_value(0) + \
+               serializer_api.serialize_int_value(length)
+
+
+def decode_frame_header(data, start=0, end=None):
+    """
+    Decodes the header of a frame
+    :param data: buffer containing the header
+    :param start: position of the header in data
+    :param end: end of the valid data in the buffer
+    :return: (payload length, header size) tuple, or None if the buffer does
+    not contain the full header
+    """
+    if end is None:
+        end = len(data)
+    if end - start < 1:
+        return None
+    m_offset = serializer_api.MutableOffset()
+    m_offset.add(start)
+    length = serializer_api.deserialize_byte_value(data, m_offset) & 0xFF
+    if length == SHORT_LENGTH_MARK:
+        if end - start < 3:
+            return None
+        length = serializer_api.deserialize_short_value(data, m_offset) & 0xFFFF
+        if length == 0:
+            if end - start < 7:
+                return None
+            length = serializer_api.deserialize_int_value(data, m_offset)
+    return length, m_offset.value() - start
 
 
 def read_data_from_socket(socket):
-    data = socket.recv(1)
-    length = serializer_api.deserialize_byte_value(data)
-    if length == 255:
-        data = socket.recv(2)
-        length = serializer_api.deserialize_short_value(data)
+    data = _recv_exact(socket, 1)
+    length = serializer_api.deserialize_byte_value(data) & 0xFF
+    if length == SHORT_LENGTH_MARK:
+        data = _recv_exact(socket, 2)
+        length = serializer_api.deserialize_short_value(data) & 0xFFFF
         if length == 0:
-            data = socket.recv(4)
+            data = _recv_exact(socket, 4)
             length = serializer_api.deserialize_int_value(data)
-    return socket.recv(length)
+    return _recv_exact(socket, length)
 
 
 def write_data_to_socket(socket, data):
     if len(data) > 0:
-        if len(data) < 255:
-            socket.send(serializer_api.serialize_byte_value(len(data)))
-        else:
-            socket.send(serializer_api.serialize_byte_value(255))
-            if len(data) < 65536:
-                socket.send(serializer_api.serialize_short_value(len(data)))
-            else:
-                socket.send(serializer_api.serialize_short_value(0))
-                socket.send(serializer_api.serialize_int_value(len(data)))
-        socket.send(data)
-        socket.flush()
+        frame = encode_frame_header(len(data))
+        frame += data
+        socket.sendall(frame)
+
+
+def _recv_exact(socket, count):
+    # socket.recv may return less than requested, so keep reading until the
+    # requested amount has arrived
+    data = bytearray(count)
+    view = memoryview(data)
+    received = 0
+    while received < count:
+        chunk = socket.recv_into(view[received:], count - received)
+        if chunk == 0:
+            raise EOFError("Connection closed by peer")
+        received += chunk
+    return bytes(data)
 
 
+default_pool = ConnectionPool()
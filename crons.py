@@ -1,14 +1,144 @@
+import hashlib
+import json
+import logging
+import time
 import webapp2
+from google.appengine.api import taskqueue
+from google.appengine.datastore.datastore_query import Cursor
 from server import ServerApi
+import caches
+import migrations
+import session_counters
+import sweeper
 
 class RemoveOldClients(webapp2.RequestHandler):
     def get(self):
-        """Set Announcement in Memcache."""
-        ServerApi._remove_old_clients()
+        """Start a sweep of the expired sessions (cron)."""
+        self._sweep()
+
+    def post(self):
+        """Continue an unfinished sweep (task queue)."""
+        retry_count = int(self.request.headers.get(
+            'X-AppEngine-TaskRetryCount', 0))
+        if retry_count:
+            # the pages of the failed attempts are swept again, so the
+            # totals of this run can include sessions that they deleted
+            logging.warning("Sweep task retried %d times, its totals can "
+                            "count sessions deleted by a previous attempt",
+                            retry_count)
+        self._sweep(Cursor(urlsafe=self.request.get('cursor')),
+                    sweeper.parse_limit(self.request.get('limit')))
+
+    def _sweep(self, cursor=None, limit=None):
+        result = ServerApi._remove_old_clients(cursor, limit)
+        if not result.finished:
+            params = {'cursor': result.cursor.urlsafe(),
+                      'limit': sweeper.format_limit(result.limit)}
+            # named after the point it continues from, so that a retried
+            # run does not start a second chain of tasks
+            name = 'sweep-' + hashlib.sha1(
+                params['limit'] + params['cursor']).hexdigest()
+            try:
+                taskqueue.add(url='/crons/remove_old_clients', name=name,
+                              params=params)
+            except (taskqueue.TaskAlreadyExistsError,
+                    taskqueue.TombstonedTaskError):
+                logging.info("Sweep continuation %s already enqueued", name)
+        self.response.content_type = 'application/json'
+        self.response.write(json.dumps({
+            'deleted': result.deleted,
+            'pages': result.pages,
+            'duration': result.duration,
+            'finished': result.finished,
+        }))
+
+
+class CacheStats(webapp2.RequestHandler):
+    def get(self):
+        """Report the hit/miss counters of the caches of this instance."""
+        self.response.content_type = 'application/json'
+        self.response.write(json.dumps(caches.all_stats(), indent=2))
+
+
+class ReconcileSessionCounters(webapp2.RequestHandler):
+    def get(self):
+        """Start a scan of the sessions correcting the drift of the
+        per-country session counters (cron)."""
+        self._reconcile(started=repr(time.time()))
+
+    def post(self):
+        """Continue an unfinished scan (task queue)."""
+        self._reconcile(Cursor(urlsafe=self.request.get('cursor')),
+                        _parse_counts(self.request.get('counts')),
+                        _parse_counts(self.request.get('snapshot')),
+                        self.request.get('started'))
+
+    def _reconcile(self, cursor=None, counts=None, snapshot=None,
+                   started=None):
+        result = session_counters.reconcile(cursor, counts, snapshot)
+        if not result.finished:
+            params = {'cursor': result.cursor.urlsafe(),
+                      'counts': json.dumps(result.counts),
+                      'snapshot': json.dumps(result.snapshot),
+                      'started': started}
+            # named after the scan and the point it continues from, so that
+            # a retried run does not start a second chain of tasks
+            name = 'reconcile-' + hashlib.sha1(
+                started + params['cursor']).hexdigest()
+            try:
+                taskqueue.add(url='/crons/reconcile_session_counters',
+                              name=name, params=params)
+            except (taskqueue.TaskAlreadyExistsError,
+                    taskqueue.TombstonedTaskError):
+                logging.info("Reconcile continuation %s already enqueued",
+                             name)
+        self.response.content_type = 'application/json'
+        self.response.write(json.dumps({
+            'countries': len(result.counts),
+            'online': sum(online for online, _ in result.counts.values()),
+            'drifted': result.drifted,
+            'pages': result.pages,
+            'finished': result.finished,
+        }))
+
+
+def _parse_counts(counts):
+    # JSON turns the (online, wishRegularConnections) tuples into lists
+    return dict((country_code, tuple(country_counts))
+                for country_code, country_counts in json.loads(counts).items())
+
+
+class MigrateToPeerIDKeys(webapp2.RequestHandler):
+    def post(self):
+        """Migrate one batch of peers to peerID keys, and enqueue the
+        next batch as a new task until all peers have been scanned."""
+        cursor = self.request.get('cursor')
+        cursor = Cursor(urlsafe=cursor) if cursor else None
+        migrated, next_cursor, more = migrations.migrate_to_peer_id_keys(
+            cursor)
+        if more and next_cursor:
+            taskqueue.add(url='/crons/migrate_to_peer_id_keys',
+                          params={'cursor': next_cursor.urlsafe()})
         self.response.set_status(204)
 
 
+class MigratePublicKeys(webapp2.RequestHandler):
+    def post(self):
+        """Pack the public keys of one batch of peers, and enqueue the
+        next batch as a new task until all peers have been scanned."""
+        cursor = self.request.get('cursor')
+        cursor = Cursor(urlsafe=cursor) if cursor else None
+        migrated, next_cursor, more = migrations.migrate_public_keys(cursor)
+        if more and next_cursor:
+            taskqueue.add(url='/crons/migrate_public_keys',
+                          params={'cursor': next_cursor.urlsafe()})
+        self.response.set_status(204)
+
 
 app = webapp2.WSGIApplication([
     ('/crons/remove_old_clients', RemoveOldClients),
+    ('/crons/cache_stats', CacheStats),
+    ('/crons/reconcile_session_counters', ReconcileSessionCounters),
+    ('/crons/migrate_to_peer_id_keys', MigrateToPeerIDKeys),
+    ('/crons/migrate_public_keys', MigratePublicKeys),
 ], debug=True)
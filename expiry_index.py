@@ -0,0 +1,76 @@
+"""
+Index of keys by deadline, giving the keys whose deadline has passed in
+O(log n) per key.
+
+A min-heap of (deadline, key) entries. Rescheduling or cancelling a key does
+not search the heap: the current deadline of each key is kept in a dict, and
+heap entries that no longer match it are dropped when they reach the top.
+"""
+import heapq
+
+# when stale entries outnumber live ones by this factor, the heap is rebuilt
+# so that it does not grow without bound with keys that are rescheduled often
+COMPACTION_FACTOR = 2
+
+
+class ExpiryIndex:
+    def __init__(self):
+        self._heap = []
+        self._deadlines = {}
+
+    def schedule(self, key, deadline):
+        """
+        Sets the deadline of a key (replacing its previous deadline)
+        """
+        if self._deadlines.get(key) == deadline:
+            return
+        self._deadlines[key] = deadline
+        heapq.heappush(self._heap, (deadline, key))
+        if len(self._heap) > COMPACTION_FACTOR * len(self._deadlines) + 64:
+            self._compact()
+
+    def cancel(self, key):
+        self._deadlines.pop(key, None)
+
+    def deadline(self, key):
+        return self._deadlines.get(key)
+
+    def next_deadline(self):
+        """
+        :return: the earliest deadline, or None if the index is empty
+        """
+        self._drop_stale()
+        return self._heap[0][0] if self._heap else None
+
+    def pop_expired(self, limit, max_count=None):
+        """
+        Removes the keys whose deadline is before a limit
+        :param limit: keys with a deadline before this are removed
+        :param max_count: maximum number of keys to remove (None for all)
+        :return: list of (deadline, key) of the removed keys, earliest first
+        """
+        expired = []
+        while max_count is None or len(expired) < max_count:
+            self._drop_stale()
+            if not self._heap or self._heap[0][0] >= limit:
+                break
+            deadline, key = heapq.heappop(self._heap)
+            del self._deadlines[key]
+            expired.append((deadline, key))
+        return expired
+
+    def __contains__(self, key):
+        return key in self._deadlines
+
+    def __len__(self):
+        return len(self._deadlines)
+
+    def _drop_stale(self):
+        heap = self._heap
+        while heap and self._deadlines.get(heap[0][1]) != heap[0][0]:
+            heapq.heappop(heap)
+
+    def _compact(self):
+        self._heap = [(deadline, key)
+                      for key, deadline in self._deadlines.items()]
+        heapq.heapify(self._heap)
@@ -0,0 +1,171 @@
+"""
+Write-behind store for session refresh times.
+
+In write-behind mode, refresh records the refresh time of a session in
+memcache instead of writing the ActiveSession entity, unless the stored
+lastRefreshTime is older than FLUSH_AGE: the refresh then writes it back to
+the datastore. The effective last refresh time of a session is the latest of
+its stored lastRefreshTime and its recorded heartbeat.
+
+Peers refresh every MIN_REMINDER_TIME to MAX_REMINDER_TIME (18 to 20
+minutes), and FLUSH_AGE lies between MAX_REMINDER_TIME and twice
+MIN_REMINDER_TIME, so every other refresh is recorded as a heartbeat and the
+next one writes. The stored time of a live session then stays within
+FLUSH_AGE of its last refresh: a session whose heartbeat was lost with
+memcache is not expired before its stored time is older than the limit by
+FLUSH_AGE. That grace only applies to the sessions stored before the
+heartbeats kept in memcache start (see expired): the others have their
+heartbeat if they have been refreshed since they were stored.
+"""
+import datetime
+
+import utils
+from storage import memcache
+
+NAMESPACE = 'heartbeats'
+
+# seconds after which a refresh writes the refresh time to the datastore.
+# Longer than the expiry time of the sessions (server.MAX_REMINDER_TIME), so
+# that the refresh following a write is recorded as a heartbeat, and shorter
+# than two refresh periods (server.MIN_REMINDER_TIME), so that the one after
+# writes
+FLUSH_AGE = 30 * 60
+
+# seconds that heartbeats are kept in memcache. Longer than the expiry time,
+# during which they decide whether a session is expired
+TTL = 60 * 60
+
+# time from which the heartbeats are kept (lost with them if memcache is
+# flushed). Not a valid urlsafe session key
+_SINCE_KEY = ':since'
+
+
+def record(session_key, refresh_time):
+    """
+    Records a refresh of a session
+    :param session_key: key of the ActiveSession
+    :param refresh_time: time of the refresh
+    :return: True if recorded, False if memcache failed (the refresh must
+    then be written to the datastore directly)
+    """
+    return memcache.set(_cache_key(session_key), refresh_time, time=TTL,
+                        namespace=NAMESPACE)
+
+
+def record_multi(session_keys, refresh_time):
+    """
+    Records a refresh of several sessions
+    :param session_keys: keys of the ActiveSessions
+    :param refresh_time: time of the refresh
+    :return: list of the session keys that could not be recorded (their
+    refresh must be written to the datastore directly)
+    """
+    cache_keys = dict((_cache_key(key), key) for key in session_keys)
+    failed_keys = memcache.set_multi(
+        dict((cache_key, refresh_time) for cache_key in cache_keys),
+        time=TTL, namespace=NAMESPACE)
+    return [cache_keys[cache_key] for cache_key in failed_keys]
+
+
+def needs_flush(session, refresh_time):
+    """
+    :return: whether a refresh of a session must write the refresh time to
+    the datastore, instead of recording a heartbeat
+    """
+    return session.lastRefreshTime < \
+        refresh_time - datetime.timedelta(seconds=FLUSH_AGE)
+
+
+def expired(stored_time, heartbeat, limit, since):
+    """
+    :param stored_time: stored lastRefreshTime of a session
+    :param heartbeat: recorded heartbeat of the session, or None if it has
+    none
+    :param limit: expiration limit
+    :param since: time from which the heartbeats are kept (see expired_keys)
+    :return: whether the session is expired. Without heartbeat, a session
+    stored before since and less than FLUSH_AGE before the limit is not
+    expired: it may have been refreshed without a write, and its heartbeat
+    lost
+    """
+    if heartbeat is not None:
+        return max(stored_time, heartbeat) < limit
+    if stored_time < since:
+        return stored_time < limit - datetime.timedelta(seconds=FLUSH_AGE)
+    return stored_time < limit
+
+
+def expired_keys(stored_times, limit):
+    """
+    :param stored_times: dict with the stored lastRefreshTime of sessions, by
+    session key
+    :param limit: expiration limit
+    :return: set with the keys of the expired sessions (see expired)
+    """
+    # sessions stored more than FLUSH_AGE before the limit are expired
+    # whatever their heartbeat
+    horizon = limit - datetime.timedelta(seconds=FLUSH_AGE)
+    recorded_heartbeats, since = _get_multi_since(
+        [key for key, stored_time in stored_times.items()
+         if horizon <= stored_time < limit])
+    return set(key for key, stored_time in stored_times.items()
+               if expired(stored_time, recorded_heartbeats.get(key), limit,
+                          since))
+
+
+def last_refresh_time(session):
+    """
+    :param session: an ActiveSession
+    :return: the effective last refresh time of the session
+    """
+    heartbeat = memcache.get(_cache_key(session.key), namespace=NAMESPACE)
+    if heartbeat is not None and heartbeat > session.lastRefreshTime:
+        return heartbeat
+    return session.lastRefreshTime
+
+
+def get_multi(session_keys):
+    """
+    :param session_keys: keys of ActiveSessions
+    :return: dict with the recorded heartbeat of the given sessions that
+    have one, by session key
+    """
+    cache_keys = dict((_cache_key(key), key) for key in session_keys)
+    heartbeats = memcache.get_multi(cache_keys.keys(), namespace=NAMESPACE)
+    return dict((cache_keys[cache_key], heartbeat)
+                for cache_key, heartbeat in heartbeats.items())
+
+
+def last_refresh_times(stored_times):
+    """
+    :param stored_times: dict with the stored lastRefreshTime of sessions, by
+    session key
+    :return: dict with the effective last refresh time of the sessions, by
+    session key
+    """
+    refresh_times = dict(stored_times)
+    for key, heartbeat in get_multi(stored_times.keys()).items():
+        if heartbeat > refresh_times[key]:
+            refresh_times[key] = heartbeat
+    return refresh_times
+
+
+def _cache_key(session_key):
+    return session_key.urlsafe()
+
+
+def _get_multi_since(session_keys):
+    # the heartbeats of sessions, and the time from which heartbeats are
+    # kept, in a single get. If memcache lost it, only the heartbeats
+    # recorded from now on are known to be kept (another instance may have
+    # set it in the meantime)
+    cache_keys = dict((_cache_key(key), key) for key in session_keys)
+    values = memcache.get_multi(cache_keys.keys() + [_SINCE_KEY],
+                                namespace=NAMESPACE)
+    since = values.pop(_SINCE_KEY, None)
+    if since is None:
+        since = utils.now()
+        if not memcache.add(_SINCE_KEY, since, namespace=NAMESPACE):
+            since = memcache.get(_SINCE_KEY, namespace=NAMESPACE) or since
+    return (dict((cache_keys[cache_key], heartbeat)
+                 for cache_key, heartbeat in values.items()), since)
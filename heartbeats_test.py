@@ -0,0 +1,109 @@
+"""
+Tests of the write-behind refreshes (heartbeats.py), driving the ServerApi
+methods on the in-memory storage backend in virtual time.
+
+Needs the App Engine SDK libraries (ndb, protorpc, endpoints) on the Python
+path, but no App Engine services.
+
+Usage: python heartbeats_test.py
+"""
+import datetime
+import os
+import time
+import unittest
+
+os.environ.setdefault('APPLICATION_ID', 'jaczserver')
+
+import heartbeats
+import memory_storage
+import port_test
+import server
+import storage
+import utils
+from models import ConnectionRequest
+from models import RefreshResponseValue
+from models import RegistrationRequest
+from models import UpdateRequest
+from protorpc import remote
+
+MINUTE = 60.0
+
+PEER_ID = '%032x' % 1
+
+
+class WriteBehindTest(unittest.TestCase):
+    def setUp(self):
+        self.backend = memory_storage.MemoryStorage()
+        storage.use(self.backend)
+        self.now = time.time()
+        utils.set_clock(lambda: self.now)
+        self.original_start_test = port_test.start_test
+        port_test.start_test = _reachable_port_test
+        self.original_write_behind = server.HEARTBEAT_WRITE_BEHIND
+        server.HEARTBEAT_WRITE_BEHIND = True
+        # heartbeats are known to be kept from the start of the test
+        heartbeats.expired_keys({}, utils.now())
+        self.api = server.ServerApi()
+        self.api.initialize_request_state(
+            remote.HttpRequestState(remote_address='10.0.0.1'))
+        self._call('register', RegistrationRequest(
+            peerID=PEER_ID, publicKeySizes=[256],
+            publicKeyValues=['%064x' % 1]))
+        self.session_id = self._call('connect', ConnectionRequest(
+            peerID=PEER_ID, localIPAddress='192.168.1.2',
+            localMainServerPort=50000, externalMainServerPort=50000,
+            clientCountryCode='ES', wishRegularConnections=True)).sessionID
+
+    def tearDown(self):
+        port_test.start_test = self.original_start_test
+        server.HEARTBEAT_WRITE_BEHIND = self.original_write_behind
+        utils.set_clock(time.time)
+
+    def test_every_other_refresh_writes(self):
+        # 19 minutes apart, within the refresh period of the peers
+        self.assertFalse(self._refresh_writes(19))
+        self.assertTrue(self._refresh_writes(19))
+        self.assertFalse(self._refresh_writes(19))
+
+    def test_recorded_refresh_keeps_session(self):
+        self._refresh_writes(19)
+        self.now += 19 * MINUTE
+        limit = utils.now() - datetime.timedelta(
+            milliseconds=server.MAX_REMINDER_TIME)
+        session = self.backend.get_session(PEER_ID)
+        self.assertFalse(heartbeats.expired_keys(
+            {session.key: session.lastRefreshTime}, limit))
+
+    def test_session_without_refresh_expires_on_limit(self):
+        self.now += 21 * MINUTE
+        limit = utils.now() - datetime.timedelta(
+            milliseconds=server.MAX_REMINDER_TIME)
+        session = self.backend.get_session(PEER_ID)
+        self.assertEqual(set([session.key]), heartbeats.expired_keys(
+            {session.key: session.lastRefreshTime}, limit))
+
+    def _refresh_writes(self, minutes):
+        """
+        Refreshes the session some minutes after the previous refresh
+        :return: whether the refresh wrote to the datastore
+        """
+        self.now += minutes * MINUTE
+        puts = self.backend.operations['put']
+        response = self._call('refresh',
+                              UpdateRequest(sessionID=self.session_id))
+        self.assertEqual(RefreshResponseValue.OK, response.response)
+        return self.backend.operations['put'] > puts
+
+    def _call(self, endpoint, request):
+        # the undecorated method, as the endpoints authentication does not
+        # apply here
+        method = getattr(server.ServerApi, endpoint).remote.method
+        return method(self.api, request)
+
+
+def _reachable_port_test(peer_id, public_ip, main_port):
+    return port_test.PortTest(None, result=True)
+
+
+if __name__ == '__main__':
+    unittest.main()
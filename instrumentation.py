@@ -0,0 +1,190 @@
+"""
+Instrumentation of the API endpoints.
+
+Endpoint methods decorated with instrumented record their wall time and the
+number of datastore, memcache and urlfetch RPCs of each call, and every RPC
+records its latency. Values go to in-memory histograms of the instance,
+reported together with the cache hit rates by the stats handler (stats.py).
+
+RPCs are observed with API proxy hooks, so they are counted whichever
+library makes them.
+"""
+import bisect
+import collections
+import functools
+import logging
+import threading
+import time
+
+from google.appengine.api import apiproxy_stub_map
+
+import caches
+
+# services whose RPCs are counted per endpoint call
+SERVICES = ('datastore_v3', 'memcache', 'urlfetch')
+
+# upper bounds of the histogram buckets, from 0.1 to about 100000 growing by
+# a factor of sqrt(2), so percentiles are estimated within that factor
+BUCKET_BOUNDS = [0.1 * 2 ** (i / 2.0) for i in range(41)]
+
+_histograms = {}
+_errors = collections.Counter()
+_lock = threading.Lock()
+
+# start times kept for RPCs in progress, per thread. RPCs that are never
+# waited for have no post-call hook, so their start times are dropped at the
+# end of each endpoint call, and beyond this count outside endpoint calls
+MAX_RPC_STARTS = 1000
+
+# RPC counters of the endpoint call running in each thread, and start times
+# of its RPCs in progress
+_local = threading.local()
+
+
+class Histogram:
+    def __init__(self):
+        # one bucket per bound, plus one for larger values
+        self.counts = [0] * (len(BUCKET_BOUNDS) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self._lock = threading.Lock()
+
+    def record(self, value):
+        bucket = bisect.bisect_left(BUCKET_BOUNDS, value)
+        with self._lock:
+            self.counts[bucket] += 1
+            self.count += 1
+            self.total += value
+            if value > self.max:
+                self.max = value
+
+    def percentile(self, fraction):
+        """
+        :return: estimate of the percentile (the upper bound of its bucket)
+        """
+        rank = fraction * self.count
+        seen = 0
+        for bucket, count in enumerate(self.counts):
+            seen += count
+            if count and seen >= rank:
+                if bucket < len(BUCKET_BOUNDS):
+                    return min(BUCKET_BOUNDS[bucket], self.max)
+                return self.max
+        return 0.0
+
+    def summary(self):
+        return {
+            'count': self.count,
+            'mean': self.total / self.count if self.count else 0.0,
+            'p50': self.percentile(0.5),
+            'p95': self.percentile(0.95),
+            'p99': self.percentile(0.99),
+            'max': self.max,
+        }
+
+
+def record(name, value):
+    histogram = _histograms.get(name)
+    if histogram is None:
+        with _lock:
+            histogram = _histograms.setdefault(name, Histogram())
+    histogram.record(value)
+
+
+def record_stages(timer):
+    """
+    Records the stages of a utils.StageTimer (and logs them)
+    """
+    for stage, duration in timer.stages:
+        record('%s.stage.%s.ms' % (timer.name, stage), duration * 1000)
+    timer.log()
+
+
+def instrumented(method):
+    """
+    Decorator of endpoint methods (placed under endpoints.method), recording
+    the wall time and RPCs of each call
+    """
+    name = method.__name__
+
+    @functools.wraps(method)
+    def instrumented_method(*args, **kwargs):
+        rpcs = collections.Counter()
+        outer_rpcs = getattr(_local, 'rpcs', None)
+        _local.rpcs = rpcs
+        start = time.time()
+        try:
+            return method(*args, **kwargs)
+        except Exception as e:
+            with _lock:
+                _errors['%s.%s' % (name, type(e).__name__)] += 1
+            raise
+        finally:
+            _local.rpcs = outer_rpcs
+            if outer_rpcs is None:
+                _local.rpc_starts = {}
+            duration = (time.time() - start) * 1000
+            record('%s.ms' % name, duration)
+            for service in SERVICES:
+                record('%s.%s.rpcs' % (name, service), rpcs[service])
+            if logging.getLogger().isEnabledFor(logging.DEBUG):
+                logging.debug("%s: %.1f ms, RPCs: %s", name, duration,
+                              dict(rpcs))
+
+    return instrumented_method
+
+
+def stats():
+    """
+    :return: dict with the summaries of the histograms of this instance, the
+    error counts and the cache stats
+    """
+    with _lock:
+        histograms = dict(_histograms)
+        errors = dict(_errors)
+    return {
+        'histograms': dict((name, histogram.summary())
+                           for name, histogram in histograms.items()),
+        'errors': errors,
+        'caches': caches.all_stats(),
+    }
+
+
+def reset():
+    with _lock:
+        _histograms.clear()
+        _errors.clear()
+
+
+def _pre_call_hook(service, call, request, response, rpc=None):
+    rpcs = getattr(_local, 'rpcs', None)
+    if rpcs is not None:
+        rpcs[service] += 1
+    if rpc is not None:
+        rpc_starts = getattr(_local, 'rpc_starts', None)
+        if rpc_starts is None or len(rpc_starts) >= MAX_RPC_STARTS:
+            rpc_starts = _local.rpc_starts = {}
+        rpc_starts[id(rpc)] = time.time()
+
+
+def _post_call_hook(service, call, request, response, rpc=None, error=None):
+    rpc_starts = getattr(_local, 'rpc_starts', None)
+    if rpc is None or not rpc_starts:
+        return
+    start = rpc_starts.pop(id(rpc), None)
+    if start is not None:
+        # for asynchronous RPCs, the time until the result was waited for
+        record('rpc.%s.%s.ms' % (service, call), (time.time() - start) * 1000)
+
+
+def install_hooks():
+    """
+    Installs the RPC hooks (only once, whatever the number of calls)
+    """
+    apiproxy = apiproxy_stub_map.apiproxy
+    apiproxy.GetPreCallHooks().Append('instrumentation', _pre_call_hook)
+    apiproxy.GetPostCallHooks().Append('instrumentation', _post_call_hook)
+
+
+install_hooks()
@@ -0,0 +1,274 @@
+"""
+Load generator simulating a population of peers against the ServerApi
+methods, on the in-memory storage backend (see memory_storage.py).
+
+Each peer registers, connects, refreshes its session every 18-20 minutes,
+looks up other peers (info) and asks for regular peers, and eventually
+disconnects, or vanishes leaving its session to expire, and connects again
+later. The sweeper runs every 10 minutes, as the cron job. The simulation
+runs in virtual time (see utils.set_clock), so hours of activity take
+seconds, while latencies are measured in real time. The port test is
+stubbed: every peer is reachable.
+
+Reports the throughput and the latency percentiles of each endpoint, and the
+datastore and memcache operations that each request makes.
+
+Needs the App Engine SDK libraries (ndb, protorpc, endpoints) on the Python
+path, but no App Engine services.
+
+Usage: python load_generator.py [peers] [simulated minutes] [seed]
+"""
+import collections
+import heapq
+import os
+import random
+import sys
+import time
+
+os.environ.setdefault('APPLICATION_ID', 'jaczserver')
+
+import memory_storage
+import port_test
+import server
+import storage
+import utils
+from models import ConnectionRequest
+from models import InfoRequest
+from models import RegistrationRequest
+from models import RegularPeersRequest
+from models import UpdateRequest
+from protorpc import remote
+
+MINUTE = 60.0
+
+# minutes over which peers register at the start of the simulation
+REGISTRATION_PERIOD = 10
+# mean minutes of a session, and of the time offline between sessions
+MEAN_SESSION_TIME = 90
+MEAN_OFFLINE_TIME = 30
+# mean minutes between info requests, and between regular peers requests of
+# the peers that wish regular connections
+MEAN_INFO_PERIOD = 5
+MEAN_REGULAR_PEERS_PERIOD = 10
+# peers looked up per info request
+INFO_PEERS = 10
+# ratio of sessions that end without a disconnect
+VANISH_RATIO = 0.1
+WISH_REGULAR_RATIO = 0.5
+SWEEP_PERIOD = 10
+
+# countries of the peers, with their relative weight
+COUNTRIES = [('US', 30), ('DE', 12), ('ES', 10), ('GB', 10), ('FR', 8),
+             ('IT', 6), ('NL', 4), ('PT', 3), ('SE', 2), ('AD', 1)]
+
+STORAGE_OPERATIONS = ('get', 'put', 'delete', 'query')
+
+
+class Peer:
+    def __init__(self, index):
+        self.peer_id = '%032x' % random.getrandbits(128)
+        self.api = server.ServerApi()
+        self.api.initialize_request_state(remote.HttpRequestState(
+            remote_address='10.%d.%d.%d' % (
+                index >> 16 & 0xFF, index >> 8 & 0xFF, index & 0xFF)))
+        self.country_code = _weighted_choice(COUNTRIES)
+        self.wish_regular_connections = \
+            random.random() < WISH_REGULAR_RATIO
+        self.session_id = None
+        # number of the current session, so that events of finished
+        # sessions are ignored
+        self.session = 0
+
+
+class EndpointStats:
+    def __init__(self):
+        self.latencies = []
+        self.responses = collections.Counter()
+        self.storage_operations = collections.Counter()
+        self.memcache_operations = 0
+
+
+class LoadGenerator:
+    def __init__(self, peer_count, seed=None):
+        random.seed(seed)
+        self.backend = memory_storage.MemoryStorage()
+        self.peers = [Peer(index) for index in range(peer_count)]
+        self.stats = collections.defaultdict(EndpointStats)
+        self.start = time.time()
+        self.now = self.start
+        self._events = []
+        self._sequence = 0
+
+    def run(self, minutes):
+        storage.use(self.backend)
+        utils.set_clock(lambda: self.now)
+        original_start_test = port_test.start_test
+        port_test.start_test = _reachable_port_test
+        try:
+            for peer in self.peers:
+                self._schedule(random.uniform(0, REGISTRATION_PERIOD),
+                               self._register, peer, 0)
+            self._schedule(SWEEP_PERIOD, self._sweep, None, 0)
+            end = self.start + minutes * MINUTE
+            while self._events and self._events[0][0] < end:
+                self.now, _, action, peer, session = \
+                    heapq.heappop(self._events)
+                if peer is None or peer.session == session:
+                    action(peer)
+        finally:
+            port_test.start_test = original_start_test
+            utils.set_clock(time.time)
+
+    def report(self):
+        print('%-22s %8s %9s %8s %8s %8s %6s %6s %6s %6s %6s' % (
+            'endpoint', 'calls', 'req/s', 'p50 ms', 'p95 ms', 'p99 ms',
+            'get', 'put', 'delete', 'query', 'mc'))
+        total_calls = 0
+        total_time = 0.0
+        for endpoint in sorted(self.stats):
+            stats = self.stats[endpoint]
+            latencies = sorted(stats.latencies)
+            calls = len(latencies)
+            total_calls += calls
+            total_time += sum(latencies)
+            print('%-22s %8d %9.0f %8.3f %8.3f %8.3f %s %6.2f' % (
+                endpoint, calls, calls / max(sum(latencies), 1e-9),
+                _percentile(latencies, 0.5) * 1000,
+                _percentile(latencies, 0.95) * 1000,
+                _percentile(latencies, 0.99) * 1000,
+                ' '.join('%6.2f' % (
+                    float(stats.storage_operations[operation]) / calls)
+                    for operation in STORAGE_OPERATIONS),
+                float(stats.memcache_operations) / calls))
+        print('%d requests, %.0f requests/s of server time (datastore and '
+              'memcache columns: operations per request)' % (
+                  total_calls, total_calls / max(total_time, 1e-9)))
+        for endpoint in sorted(self.stats):
+            print('%-22s %s' % (endpoint, ', '.join(
+                '%s %d' % (response, count) for response, count in
+                sorted(self.stats[endpoint].responses.items()))))
+
+    def _schedule(self, minutes, action, peer, session):
+        self._sequence += 1
+        heapq.heappush(self._events, (self.now + minutes * MINUTE,
+                                      self._sequence, action, peer, session))
+
+    def _call(self, peer, endpoint, request):
+        # the undecorated method, as the endpoints authentication does not
+        # apply here
+        method = getattr(server.ServerApi, endpoint).remote.method
+        response = self._measure(endpoint, method, peer.api, request)
+        self.stats[endpoint].responses[
+            getattr(response, 'response', None) or 'OK'] += 1
+        return response
+
+    def _measure(self, endpoint, function, *args):
+        storage_operations = self.backend.operations.copy()
+        memcache_operations = sum(self.backend.memcache.operations.values())
+        start = time.time()
+        result = function(*args)
+        latency = time.time() - start
+        stats = self.stats[endpoint]
+        stats.latencies.append(latency)
+        stats.storage_operations.update(self.backend.operations)
+        stats.storage_operations.subtract(storage_operations)
+        stats.memcache_operations += \
+            sum(self.backend.memcache.operations.values()) - \
+            memcache_operations
+        return result
+
+    def _register(self, peer):
+        self._call(peer, 'register', RegistrationRequest(
+            peerID=peer.peer_id,
+            publicKeySizes=[256],
+            publicKeyValues=['%064x' % random.getrandbits(256)]))
+        self._connect(peer)
+
+    def _connect(self, peer):
+        peer.session += 1
+        response = self._call(peer, 'connect', ConnectionRequest(
+            peerID=peer.peer_id,
+            localIPAddress='192.168.1.%d' % random.randint(2, 254),
+            localMainServerPort=50000,
+            externalMainServerPort=random.randint(1024, 65535),
+            clientCountryCode=peer.country_code,
+            wishRegularConnections=peer.wish_regular_connections))
+        peer.session_id = response.sessionID
+        self._schedule_refresh(peer)
+        self._schedule(random.expovariate(1.0 / MEAN_INFO_PERIOD),
+                       self._info, peer, peer.session)
+        if peer.wish_regular_connections:
+            self._schedule(
+                random.expovariate(1.0 / MEAN_REGULAR_PEERS_PERIOD),
+                self._regular_peers, peer, peer.session)
+        self._schedule(random.expovariate(1.0 / MEAN_SESSION_TIME),
+                       self._leave, peer, peer.session)
+
+    def _schedule_refresh(self, peer):
+        # within the reminder times, with some margin
+        self._schedule(random.uniform(
+            server.MIN_REMINDER_TIME / 60000.0 + 0.2,
+            server.MAX_REMINDER_TIME / 60000.0 - 0.2),
+            self._refresh, peer, peer.session)
+
+    def _refresh(self, peer):
+        self._call(peer, 'refresh', UpdateRequest(sessionID=peer.session_id))
+        self._schedule_refresh(peer)
+
+    def _info(self, peer):
+        self._call(peer, 'info', InfoRequest(peerIDList=[
+            random.choice(self.peers).peer_id for i in range(INFO_PEERS)]))
+        self._schedule(random.expovariate(1.0 / MEAN_INFO_PERIOD),
+                       self._info, peer, peer.session)
+
+    def _regular_peers(self, peer):
+        self._call(peer, 'regular_peers_request', RegularPeersRequest(
+            clientCountryCode=peer.country_code))
+        self._schedule(random.expovariate(1.0 / MEAN_REGULAR_PEERS_PERIOD),
+                       self._regular_peers, peer, peer.session)
+
+    def _leave(self, peer):
+        if random.random() >= VANISH_RATIO:
+            self._call(peer, 'disconnect',
+                       UpdateRequest(sessionID=peer.session_id))
+        peer.session += 1
+        self._schedule(random.expovariate(1.0 / MEAN_OFFLINE_TIME),
+                       self._connect, peer, peer.session)
+
+    def _sweep(self, peer):
+        result = self._measure('(sweep)',
+                               server.ServerApi._remove_old_clients)
+        self.stats['(sweep)'].responses['deleted'] += result.deleted
+        self._schedule(SWEEP_PERIOD, self._sweep, None, 0)
+
+
+def _reachable_port_test(peer_id, public_ip, main_port):
+    return port_test.PortTest(None, result=True)
+
+
+def _weighted_choice(choices):
+    position = random.uniform(0, sum(weight for _, weight in choices))
+    for choice, weight in choices:
+        position -= weight
+        if position <= 0:
+            return choice
+    return choices[-1][0]
+
+
+def _percentile(values, fraction):
+    if not values:
+        return 0.0
+    return values[int(fraction * (len(values) - 1))]
+
+
+def main(peer_count=1000, minutes=180, seed=None):
+    print('%d peers, %d simulated minutes' % (peer_count, minutes))
+    generator = LoadGenerator(peer_count, seed)
+    start = time.time()
+    generator.run(minutes)
+    print('simulated in %.1f s' % (time.time() - start))
+    generator.report()
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:]])
@@ -0,0 +1,186 @@
+"""
+In-process stand-in of the App Engine memcache, for running the server
+without App Engine services (see memory_storage.py).
+
+Implements the part of the memcache API used by the server, with the same
+signatures and return values. Values are stored as given, not serialized, so
+they must not be modified once stored or read.
+"""
+import collections
+import threading
+
+import utils
+
+# return values of delete, as in the memcache API
+DELETE_ITEM_MISSING = 1
+DELETE_SUCCESSFUL = 2
+
+
+class MemoryCache:
+    def __init__(self):
+        # (value, expiration time or None, CAS ID) by (namespace, key)
+        self._entries = {}
+        # time until which adds fail, by (namespace, key) of deleted keys
+        self._add_locks = {}
+        self._lock = threading.Lock()
+        self._cas_ids = 0
+        # number of calls, by method name
+        self.operations = collections.Counter()
+
+    def get(self, key, namespace=None):
+        self.operations['get'] += 1
+        with self._lock:
+            entry = self._get_entry((namespace, key))
+            return entry[0] if entry else None
+
+    def get_multi(self, keys, namespace=None):
+        self.operations['get_multi'] += 1
+        values = {}
+        with self._lock:
+            for key in keys:
+                entry = self._get_entry((namespace, key))
+                if entry:
+                    values[key] = entry[0]
+        return values
+
+    def set(self, key, value, time=0, namespace=None):
+        self.operations['set'] += 1
+        with self._lock:
+            self._set_entry((namespace, key), value, time)
+        return True
+
+    def set_multi(self, mapping, time=0, namespace=None):
+        """
+        :return: list of the keys that were not set (always empty)
+        """
+        self.operations['set_multi'] += 1
+        with self._lock:
+            for key, value in mapping.items():
+                self._set_entry((namespace, key), value, time)
+        return []
+
+    def add(self, key, value, time=0, namespace=None):
+        self.operations['add'] += 1
+        with self._lock:
+            return self._add_entry((namespace, key), value, time)
+
+    def add_multi(self, mapping, time=0, namespace=None):
+        """
+        :return: list of the keys that were not added
+        """
+        self.operations['add_multi'] += 1
+        with self._lock:
+            return [key for key, value in mapping.items()
+                    if not self._add_entry((namespace, key), value, time)]
+
+    def delete(self, key, seconds=0, namespace=None):
+        self.operations['delete'] += 1
+        with self._lock:
+            if self._delete_entry((namespace, key), seconds) is None:
+                return DELETE_ITEM_MISSING
+            return DELETE_SUCCESSFUL
+
+    def delete_multi(self, keys, seconds=0, namespace=None):
+        self.operations['delete_multi'] += 1
+        with self._lock:
+            for key in keys:
+                self._delete_entry((namespace, key), seconds)
+        return True
+
+    def incr(self, key, delta=1, namespace=None, initial_value=None):
+        """
+        :return: the new value, or None if the key is missing and there is no
+        initial value
+        """
+        self.operations['incr'] += 1
+        with self._lock:
+            entry = self._get_entry((namespace, key))
+            if entry:
+                value, expiration = entry[0], entry[1]
+            elif initial_value is not None:
+                value, expiration = initial_value, None
+            else:
+                return None
+            value = max(0, value + delta)
+            self._cas_ids += 1
+            self._entries[(namespace, key)] = (value, expiration,
+                                               self._cas_ids)
+            return value
+
+    def flush_all(self):
+        with self._lock:
+            self._entries.clear()
+            self._add_locks.clear()
+        return True
+
+    def Client(self):
+        """
+        :return: a client for compare-and-set operations (as
+        memcache.Client())
+        """
+        return _CasClient(self)
+
+    def _get_entry(self, entry_key):
+        entry = self._entries.get(entry_key)
+        if entry is None:
+            return None
+        if entry[1] is not None and entry[1] < utils.timestamp():
+            del self._entries[entry_key]
+            return None
+        return entry
+
+    def _add_entry(self, entry_key, value, seconds):
+        if self._get_entry(entry_key):
+            return False
+        lock_time = self._add_locks.get(entry_key)
+        if lock_time is not None:
+            if lock_time >= utils.timestamp():
+                return False
+            del self._add_locks[entry_key]
+        self._set_entry(entry_key, value, seconds)
+        return True
+
+    def _delete_entry(self, entry_key, seconds):
+        if seconds:
+            self._add_locks[entry_key] = utils.timestamp() + seconds
+        return self._entries.pop(entry_key, None)
+
+    def _set_entry(self, entry_key, value, seconds):
+        # the key now has a value, which already makes adds fail
+        self._add_locks.pop(entry_key, None)
+        self._cas_ids += 1
+        expiration = utils.timestamp() + seconds if seconds else None
+        self._entries[entry_key] = (value, expiration, self._cas_ids)
+
+
+class _CasClient:
+    def __init__(self, cache):
+        self._cache = cache
+        # CAS ID of the values read with gets, by (namespace, key)
+        self._cas_ids = {}
+
+    def get(self, key, namespace=None):
+        return self._cache.get(key, namespace=namespace)
+
+    def gets(self, key, namespace=None):
+        self._cache.operations['gets'] += 1
+        with self._cache._lock:
+            entry = self._cache._get_entry((namespace, key))
+            if entry is None:
+                return None
+            self._cas_ids[(namespace, key)] = entry[2]
+            return entry[0]
+
+    def cas(self, key, value, time=0, namespace=None):
+        """
+        :return: True if the value was stored, False if it changed since it
+        was read with gets (or it was not read with gets)
+        """
+        self._cache.operations['cas'] += 1
+        with self._cache._lock:
+            cas_id = self._cas_ids.pop((namespace, key), None)
+            entry = self._cache._get_entry((namespace, key))
+            if cas_id is None or entry is None or entry[2] != cas_id:
+                return False
+            self._cache._set_entry((namespace, key), value, time)
+            return True
@@ -0,0 +1,234 @@
+"""
+Storage backend keeping peers and sessions in the memory of the process, for
+self-hosted runs and for benchmarking the server without the datastore.
+
+Sessions are indexed by peerID and by session ID, their peerIDs and those of
+the peers that wish regular connections by country in sorted lists (paged
+with bisect), and all sessions by lastRefreshTime in an
+expiry_index.ExpiryIndex (a heap), so finding each expired session costs
+O(log n), and the other operations are dict, set or sorted list operations.
+
+The operations counter counts the datastore RPCs that each call would make
+with NdbStorage (a batch get is one 'get'), to estimate the datastore load
+of a workload.
+
+Stored entities are copies of the ones put, so entities modified after a put
+must be put again (as with the datastore). Entities returned by gets are the
+stored ones and must not be modified without putting them back.
+"""
+import base64
+import bisect
+import collections
+import os
+import threading
+
+import expiry_index
+import memory_cache
+import storage
+
+
+class MemoryStorage(storage.Storage):
+    def __init__(self):
+        self.memcache = memory_cache.MemoryCache()
+        self._lock = threading.RLock()
+        # PeerData by peerID
+        self._peers = {}
+        # ActiveSession by peerID, and peerID by session ID
+        self._sessions = {}
+        self._session_peer_ids = {}
+        # sorted list of the peerIDs of all sessions
+        self._session_index = []
+        # sorted list of the peerIDs wishing regular connections, by country
+        # code
+        self._regular_peers = {}
+        # peerIDs of all sessions by lastRefreshTime
+        self._expiry = expiry_index.ExpiryIndex()
+        # peerIDs returned by the expiry pages of the current sweep
+        self._examined = []
+        self._secrets = {}
+        # (online, wishRegularConnections) session counters by country code
+        self._session_counts = {}
+        # datastore RPCs, by type (get, put, delete, query)
+        self.operations = collections.Counter()
+
+    def get_peer(self, peer_id):
+        self.operations['get'] += 1
+        return self._peers.get(peer_id)
+
+    def put_peer(self, peer_data):
+        self.operations['put'] += 1
+        with self._lock:
+            self._peers[peer_data.key.id()] = _copy(peer_data)
+
+    def get_session(self, peer_id):
+        self.operations['get'] += 1
+        return self._sessions.get(peer_id)
+
+    def get_sessions(self, peer_ids):
+        self.operations['get'] += 1
+        sessions = {}
+        for peer_id in peer_ids:
+            session = self._sessions.get(peer_id)
+            if session:
+                sessions[peer_id] = session
+        return sessions
+
+    def get_session_by_id(self, session_id):
+        self.operations['get'] += 1
+        peer_id = self._session_peer_ids.get(session_id)
+        if peer_id is None:
+            return None
+        return self._sessions.get(peer_id)
+
+    def get_sessions_by_id(self, session_ids):
+        self.operations['get'] += 1
+        sessions = {}
+        for session_id in session_ids:
+            session = self._sessions.get(
+                self._session_peer_ids.get(session_id))
+            if session:
+                sessions[session_id] = session
+        return sessions
+
+    def put_session(self, session):
+        self.operations['put'] += 1
+        with self._lock:
+            self._store_session(session)
+
+    def put_sessions(self, sessions):
+        self.operations['put'] += 1
+        with self._lock:
+            for session in sessions:
+                self._store_session(session)
+
+    def replace_session_async(self, session):
+        self.operations['get'] += 1
+        self.operations['put'] += 1
+        with self._lock:
+            existing_session = self._sessions.get(session.key.id())
+            self._store_session(session)
+        return storage.CompletedFuture(existing_session)
+
+    def delete_session(self, session_key):
+        self.operations['delete'] += 1
+        with self._lock:
+            self._remove_session(session_key.id())
+
+    def delete_sessions_async(self, session_keys):
+        self.operations['delete'] += 1
+        with self._lock:
+            for session_key in session_keys:
+                self._remove_session(session_key.id())
+        return [storage.CompletedFuture()]
+
+    def regular_peer_ids(self, country_code, limit):
+        self.operations['query'] += 1
+        with self._lock:
+            return self._regular_peers.get(country_code, [])[:limit]
+
+    def regular_peer_ids_page(self, country_code, page_size, cursor=None):
+        # the cursor is the last peerID of the previous page, encoded so that
+        # clients treat it as opaque (as the datastore cursors)
+        self.operations['query'] += 1
+        last_peer_id = None if cursor is None else _decode_cursor(cursor)
+        with self._lock:
+            country_peers = self._regular_peers.get(country_code, [])
+            start = 0 if last_peer_id is None else \
+                bisect.bisect_right(country_peers, last_peer_id)
+            peer_ids = country_peers[start:start + page_size]
+            more = start + page_size < len(country_peers)
+            return peer_ids, _encode_cursor(peer_ids[-1]) if more else None
+
+    def get_secret(self, name):
+        with self._lock:
+            return self._secrets.setdefault(
+                name, os.urandom(storage.SECRET_SIZE))
+
+    def update_session_counts_async(self, deltas):
+        self.operations['put'] += 1
+        with self._lock:
+            for country_code, (online, wish_regular) in deltas.items():
+                counts = self._session_counts.get(country_code, (0, 0))
+                self._session_counts[country_code] = (
+                    counts[0] + online, counts[1] + wish_regular)
+        return [storage.CompletedFuture()]
+
+    def get_session_counts(self, consistent=False):
+        self.operations['query'] += 1
+        with self._lock:
+            return dict(self._session_counts)
+
+    def session_countries_page(self, cursor=None, page_size=1000):
+        # the cursor is the last peerID of the previous page
+        self.operations['query'] += 1
+        with self._lock:
+            start = 0 if cursor is None else \
+                bisect.bisect_right(self._session_index, cursor)
+            page = self._session_index[start:start + page_size]
+            more = start + page_size < len(self._session_index)
+            return ([self._sessions[peer_id] for peer_id in page],
+                    page[-1] if page else None, more)
+
+    def expired_sessions_page(self, limit, cursor=None, page_size=500):
+        # sessions leave the expiry index as they are returned. Those that
+        # the sweeper keeps (thanks to a heartbeat) go back to the index when
+        # the next sweep starts, so that they are examined again then. The
+        # cursor is the (lastRefreshTime, peerID) of the last session
+        self.operations['query'] += 1
+        with self._lock:
+            if cursor is None:
+                self._reschedule_examined()
+            expired = self._expiry.pop_expired(limit, page_size)
+            self._examined.extend(peer_id for _, peer_id in expired)
+            sessions = [self._sessions[peer_id] for _, peer_id in expired]
+            next_deadline = self._expiry.next_deadline()
+            more = next_deadline is not None and next_deadline < limit
+            return sessions, expired[-1] if expired else None, more
+
+    def _reschedule_examined(self):
+        for peer_id in self._examined:
+            session = self._sessions.get(peer_id)
+            if session and peer_id not in self._expiry:
+                self._expiry.schedule(peer_id, session.lastRefreshTime)
+        self._examined = []
+
+    def _store_session(self, session):
+        peer_id = session.key.id()
+        self._remove_session(peer_id)
+        session = _copy(session)
+        self._sessions[peer_id] = session
+        self._session_peer_ids[self.session_id(session)] = peer_id
+        bisect.insort(self._session_index, peer_id)
+        if session.wishRegularConnections:
+            bisect.insort(self._regular_peers.setdefault(
+                session.clientCountryCode, []), peer_id)
+        self._expiry.schedule(peer_id, session.lastRefreshTime)
+
+    def _remove_session(self, peer_id):
+        session = self._sessions.pop(peer_id, None)
+        if session is None:
+            return
+        self._session_peer_ids.pop(self.session_id(session), None)
+        del self._session_index[bisect.bisect_left(self._session_index,
+                                                   peer_id)]
+        if session.wishRegularConnections:
+            country_peers = self._regular_peers.get(session.clientCountryCode)
+            del country_peers[bisect.bisect_left(country_peers, peer_id)]
+            if not country_peers:
+                del self._regular_peers[session.clientCountryCode]
+        self._expiry.cancel(peer_id)
+
+
+def _copy(entity):
+    return type(entity)(key=entity.key, **entity.to_dict())
+
+
+def _encode_cursor(peer_id):
+    return base64.urlsafe_b64encode(peer_id.encode('utf-8'))
+
+
+def _decode_cursor(cursor):
+    try:
+        return base64.urlsafe_b64decode(str(cursor)).decode('utf-8')
+    except (TypeError, ValueError, UnicodeError):
+        raise ValueError("Invalid cursor: %r" % cursor)
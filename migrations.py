@@ -0,0 +1,79 @@
+"""
+Datastore migrations, run in batches so that each call stays within request
+deadlines. Each migration returns a cursor to continue from, to be passed to
+the next call.
+"""
+import logging
+
+from google.appengine.ext import ndb
+
+from models import PeerData
+import public_key_codec
+
+DEFAULT_BATCH_SIZE = 100
+
+def migrate_to_peer_id_keys(cursor=None, batch_size=DEFAULT_BATCH_SIZE):
+    """
+    Moves one batch of PeerData entities with automatic IDs to entities
+    keyed by their peerID. If a keyed entity already exists for a peer, it
+    is kept. Each peer is moved in its own transaction, so a registration
+    running at the same time is never overwritten.
+    Sessions are not migrated: the keys of legacy sessions are the session
+    IDs that their peers hold, so they are left to expire.
+    :param cursor: cursor returned by the previous call (None to start)
+    :param batch_size: number of entities scanned per call
+    :return: (number of migrated entities, cursor for the next call, whether
+    there are more entities to scan)
+    """
+    peers, next_cursor, more = PeerData.query().fetch_page(
+        batch_size, start_cursor=cursor)
+    legacy_keys = [peer.key for peer in peers if peer.key.id() != peer.peerID]
+    if not legacy_keys:
+        return 0, next_cursor, more
+
+    # all the transactions run concurrently
+    futures = [_move_to_peer_id_key_async(key) for key in legacy_keys]
+    copied = sum(1 for future in futures if future.get_result())
+    logging.info("Migrated %d PeerData entities to peerID keys (%d copied)",
+                 len(legacy_keys), copied)
+    return len(legacy_keys), next_cursor, more
+
+
+@ndb.transactional_tasklet(xg=True)
+def _move_to_peer_id_key_async(legacy_key):
+    # the legacy entity is read again in the transaction, in case another
+    # run already moved it
+    legacy_peer = yield legacy_key.get_async()
+    if legacy_peer is None:
+        raise ndb.Return(False)
+    existing_peer = yield ndb.Key(PeerData, legacy_peer.peerID).get_async()
+    futures = [legacy_key.delete_async()]
+    if existing_peer is None:
+        futures.append(PeerData(id=legacy_peer.peerID,
+                                **legacy_peer.to_dict()).put_async())
+    yield futures
+    raise ndb.Return(existing_peer is None)
+
+
+def migrate_public_keys(cursor=None, batch_size=DEFAULT_BATCH_SIZE):
+    """
+    Packs the public keys of one batch of PeerData entities with
+    public_key_codec, clearing the hexadecimal properties
+    :param cursor: cursor returned by the previous call (None to start)
+    :param batch_size: number of entities scanned per call
+    :return: (number of migrated entities, cursor for the next call, whether
+    there are more entities to scan)
+    """
+    peers, next_cursor, more = PeerData.query().fetch_page(
+        batch_size, start_cursor=cursor)
+    legacy_peers = [peer for peer in peers if peer.publicKeys is None]
+    for peer in legacy_peers:
+        peer.publicKeys = public_key_codec.encode_public_keys(
+            peer.publicKeySizes, peer.publicKeyValues)
+        peer.publicKeySizes = []
+        peer.publicKeyValues = []
+    if legacy_peers:
+        ndb.put_multi(legacy_peers)
+        logging.info("Packed the public keys of %d PeerData entities",
+                     len(legacy_peers))
+    return len(legacy_peers), next_cursor, more
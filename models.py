@@ -1,6 +1,8 @@
 from protorpc import messages
 from google.appengine.ext import ndb
 
+import public_key_codec
+
 
 class HelloReturn(messages.Message):
     """ProfileMiniForm -- update Profile form message"""
@@ -83,6 +85,11 @@ class UpdateRequest(messages.Message):
     sessionID = messages.StringField(1)
 
 
+class MultiUpdateRequest(messages.Message):
+    # session IDs to refresh
+    sessionIDList = messages.StringField(1, repeated=True)
+
+
 class RefreshResponse(messages.Message):
     # OK
     # UNRECOGNIZED_SESSION
@@ -98,6 +105,11 @@ class RefreshResponseValue:
     WRONG_IP_ADDRESS = 'WRONG_IP_ADDRESS'
 
 
+class MultiRefreshResponse(messages.Message):
+    # RefreshResponseValue of each session, in the order of the request
+    responseList = messages.StringField(1, repeated=True)
+
+
 class DisconnectResponse(messages.Message):
     # OK
     # UNRECOGNIZED_SESSION
@@ -112,10 +124,25 @@ class DisconnectResponseValue:
 
 class InfoRequest(messages.Message):
     peerIDList = messages.StringField(1, repeated=True)
+    # if true, the response carries the peers in packedPeerIDInfoList
+    # instead of peerIDInfoList
+    binaryResponse = messages.BooleanField(2)
+    # version of the previous response to the same peerIDList. If given,
+    # the response only carries the peers that connected again since then,
+    # and lists the ones that disconnected or expired in removedPeerIDList
+    lastSeenVersion = messages.IntegerField(3)
 
 
 class RegularPeersRequest(messages.Message):
     clientCountryCode = messages.StringField(1)
+    # if true, the response carries the peers in packedPeerIDInfoList
+    # instead of peerIDInfoList
+    binaryResponse = messages.BooleanField(2)
+    # if pageSize or cursor are given, the response carries a page of all
+    # the peers of the country (instead of a random sample), and a
+    # nextCursor to pass as cursor for the next page
+    pageSize = messages.IntegerField(3)
+    cursor = messages.StringField(4)
 
 
 class PeerIDInfo(messages.Message):
@@ -132,24 +159,72 @@ class PeerIDInfo(messages.Message):
     wishRegularConnections = messages.BooleanField(9)
 
 
+class CountrySessionCount(messages.Message):
+    clientCountryCode = messages.StringField(1)
+    # sessions of the country, and how many of them wish regular connections
+    online = messages.IntegerField(2)
+    wishRegularConnections = messages.IntegerField(3)
+
+
+class SessionCountsResponse(messages.Message):
+    countryList = messages.MessageField(CountrySessionCount, 1, repeated=True)
+
+
 class InfoResponse(messages.Message):
     peerIDInfoList = messages.MessageField(PeerIDInfo, 1, repeated=True)
+    # peer list encoded with peer_info_codec (base64 in JSON), only filled
+    # when the request asked for a binary response
+    packedPeerIDInfoList = messages.BytesField(2)
+    # version to send as lastSeenVersion in the next info request
+    version = messages.IntegerField(3)
+    # peers without session that were removed since lastSeenVersion, or all
+    # the peers without session if the server no longer knows which were
+    # (only in responses to requests with a lastSeenVersion)
+    removedPeerIDList = messages.StringField(4, repeated=True)
+    # cursor of the next page of a paged regular peers request (empty on the
+    # last page)
+    nextCursor = messages.StringField(5)
 
 
 class PeerData(ndb.Model):
     """Conference -- Conference object"""
+    # keyed by peerID (entities registered before that have automatic ids,
+    # and are converted by migrations.migrate_to_peer_id_keys). peerID stays
+    # indexed while storage.LEGACY_PEER_DATA_LOOKUP queries by it
     # sessionID              = ndb.StringProperty(required=True)
     peerID           = ndb.StringProperty(required=True, indexed=True)
     registrationTime = ndb.DateTimeProperty(required=True, indexed=False)
+    # public keys packed with public_key_codec (see public_keys)
+    publicKeys       = ndb.BlobProperty(indexed=False)
+    # public keys of entities registered before packed keys, until
+    # migrations.migrate_public_keys packs them
     publicKeySizes   = ndb.IntegerProperty(indexed=False, repeated=True)
     # hexadecimal
     publicKeyValues  = ndb.StringProperty(indexed=False, repeated=True)
 
+    def public_keys(self):
+        """
+        :return: (list of key sizes, list of key values as hexadecimal
+        strings). Packed keys are decoded on the first call
+        """
+        if self.publicKeys is None:
+            return self.publicKeySizes, self.publicKeyValues
+        packed_keys, decoded_keys = getattr(self, '_decoded_public_keys',
+                                            (None, None))
+        if packed_keys is not self.publicKeys:
+            packed_keys = self.publicKeys
+            decoded_keys = public_key_codec.decode_public_keys(packed_keys)
+            self._decoded_public_keys = (packed_keys, decoded_keys)
+        return decoded_keys
+
 
 class ActiveSession(ndb.Model):
     """Conference -- Conference object"""
+    # keyed by peerID, so a peer has at most one session (sessions created
+    # before that have automatic ids, and are left to expire, as their keys
+    # are the session IDs held by their peers)
     # sessionID              = ndb.StringProperty(required=True)
-    peerID                 = ndb.StringProperty(required=True)
+    peerID                 = ndb.StringProperty(required=True, indexed=False)
     connectionTime         = ndb.DateTimeProperty(required=True, indexed=False)
     lastRefreshTime        = ndb.DateTimeProperty(required=True)
     localIPAddress         = ndb.StringProperty(required=True, indexed=False)
@@ -160,6 +235,22 @@ class ActiveSession(ndb.Model):
     externalRESTServerPort = ndb.IntegerProperty(required=False, indexed=False)
     clientCountryCode      = ndb.StringProperty(required=True)
     wishRegularConnections = ndb.BooleanProperty(required=True)
+    # version of the connect that created the session (see change_log.py)
+    changeVersion          = ndb.IntegerProperty(indexed=False)
+
+
+class SessionCounterShard(ndb.Model):
+    # one of the shards of the session counters of a country (keyed by
+    # '<country code>:<shard>'), see session_counters.py
+    clientCountryCode      = ndb.StringProperty(required=True, indexed=False)
+    online                 = ndb.IntegerProperty(default=0, indexed=False)
+    wishRegularConnections = ndb.IntegerProperty(default=0, indexed=False)
+
+
+class ServerSecret(ndb.Model):
+    # random key shared by all the instances (keyed by the name of the
+    # secret), such as the key signing the session tokens
+    value = ndb.BlobProperty(required=True)
 
 
 # class StoredSession(ndb.Model):
@@ -0,0 +1,95 @@
+"""
+Cache of the PeerIDInfo projection of active sessions, by peerID.
+
+Entries are tuples with the PeerIDInfo fields of the session followed by its
+stored lastRefreshTime and its changeVersion (see session_values). The cache only lives in
+memcache, so that invalidations are seen by every instance: entries are
+replaced on connect and deleted on disconnect and expiry.
+
+Lookups can leave out the sessions that have expired but have not been
+removed by the sweeper yet.
+"""
+from google.appengine.ext import ndb
+
+import caches
+import heartbeats
+import storage
+from models import ActiveSession
+
+TTL = 60 * 60
+# peers without session are cached for less time, as a safety net in case an
+# invalidation is lost
+NEGATIVE_TTL = 10 * 60
+
+cache = caches.ReadThroughCache('peer_info:3', lru_size=0, ttl=TTL,
+                                negative_ttl=NEGATIVE_TTL)
+
+
+# PeerIDInfo fields stored in the cache entries, in order
+FIELDS = ('peerID',
+          'localIPAddress',
+          'externalIPAddress',
+          'localMainServerPort',
+          'externalMainServerPort',
+          'clientCountryCode',
+          'wishRegularConnections')
+
+
+# position of the stored lastRefreshTime in the cache entries
+REFRESH_TIME = len(FIELDS)
+# position of the changeVersion (see change_log.py) in the cache entries
+CHANGE_VERSION = REFRESH_TIME + 1
+
+
+def session_values(session):
+    """
+    :param session: an ActiveSession
+    :return: tuple with the PeerIDInfo fields of the session, followed by its
+    stored lastRefreshTime and its changeVersion (0 for sessions created
+    before change versions)
+    """
+    return tuple(getattr(session, field) for field in FIELDS) + \
+        (session.lastRefreshTime, session.changeVersion or 0)
+
+
+def get_multi(peer_ids, expiration_limit=None):
+    """
+    :param peer_ids: list of peer IDs
+    :param expiration_limit: if given, sessions expired at this time
+    (see heartbeats.expired) are left out
+    :return: dict with the session_values of the peers that have an active
+    session, by peerID
+    """
+    values = cache.get_multi(peer_ids, _load_session_values)
+    if expiration_limit is None:
+        return values
+    # only sessions with an old stored refresh time need their heartbeat.
+    # Entries are loaded with storage get_sessions, so they are all of
+    # sessions keyed by their peerID
+    stale_times = dict((ndb.Key(ActiveSession, peer_id),
+                        peer_values[REFRESH_TIME])
+                       for peer_id, peer_values in values.items()
+                       if peer_values[REFRESH_TIME] < expiration_limit)
+    if stale_times:
+        for key in heartbeats.expired_keys(stale_times, expiration_limit):
+            del values[key.id()]
+    return values
+
+
+def set_session(session):
+    cache.set(session.peerID, session_values(session))
+
+
+def set_sessions(sessions):
+    cache.set_multi(dict((session.peerID, session_values(session))
+                         for session in sessions))
+
+
+def invalidate(peer_ids):
+    cache.delete_multi(peer_ids)
+
+
+def _load_session_values(peer_ids):
+    return dict((peer_id, session_values(session))
+                for peer_id, session in
+                storage.backend.get_sessions(peer_ids).items())
@@ -0,0 +1,158 @@
+"""
+Compact binary encoding of PeerIDInfo lists, built on serializer_api.
+
+Layout: an int with the number of peers, followed for each peer by
+- peerID, as a serializer_api string
+- localIPAddress and externalIPAddress, each as a byte with the address
+  length (4 or 16) followed by the raw address bytes. Addresses that are not
+  valid IPs are stored with length 0 followed by a string, and missing
+  addresses with length -1
+- localMainServerPort and externalMainServerPort, each as a byte with the
+  port length (2) followed by the port as an unsigned short. Values that are
+  not valid ports are stored with length 8 followed by a long, and missing
+  ports with length -1
+- clientCountryCode, as two bytes. Codes that are not two ASCII characters
+  are stored as two 0xFF bytes followed by a string
+- a flags byte, with wishRegularConnections in the lowest bit
+"""
+import socket
+
+import serializer_api
+from models import PeerIDInfo
+
+_NO_ADDRESS = -1
+_STRING_ADDRESS = 0
+_IPV4_LENGTH = 4
+_IPV6_LENGTH = 16
+
+_NO_PORT = -1
+_SHORT_PORT = 2
+_LONG_PORT = 8
+_MAX_PORT = 0xFFFF
+
+_NO_COUNTRY = b'\x00\x00'
+_STRING_COUNTRY = b'\xff\xff'
+
+_WISH_REGULAR_CONNECTIONS_FLAG = 0x01
+
+
+def encode_peer_id_info_list(peer_id_info_list):
+    """
+    Encodes a list of peer infos
+    :param peer_id_info_list: list of PeerIDInfo messages
+    :return: byte array with the encoded list
+    """
+    data = serializer_api.serialize_int_value(len(peer_id_info_list))
+    for peer_id_info in peer_id_info_list:
+        data += serializer_api.serialize_string(peer_id_info.peerID)
+        data += _encode_address(peer_id_info.localIPAddress)
+        data += _encode_address(peer_id_info.externalIPAddress)
+        data += _encode_port(peer_id_info.localMainServerPort)
+        data += _encode_port(peer_id_info.externalMainServerPort)
+        data += _encode_country_code(peer_id_info.clientCountryCode)
+        flags = 0
+        if peer_id_info.wishRegularConnections:
+            flags |= _WISH_REGULAR_CONNECTIONS_FLAG
+        data += serializer_api.serialize_byte_value(flags)
+    return data
+
+
+def decode_peer_id_info_list(data):
+    """
+    Decodes a list of peer infos
+    :param data: buffer with the encoded list
+    :return: list of PeerIDInfo messages
+    """
+    reader = serializer_api.Reader(data)
+    peer_id_info_list = []
+    for i in range(reader.read_int_value()):
+        peer_id = reader.read_string()
+        local_ip_address = _decode_address(reader)
+        external_ip_address = _decode_address(reader)
+        local_main_server_port = _decode_port(reader)
+        external_main_server_port = _decode_port(reader)
+        client_country_code = _decode_country_code(reader)
+        flags = reader.read_byte_value()
+        peer_id_info_list.append(
+            PeerIDInfo(
+                peerID=peer_id,
+                localIPAddress=local_ip_address,
+                externalIPAddress=external_ip_address,
+                localMainServerPort=local_main_server_port,
+                externalMainServerPort=external_main_server_port,
+                clientCountryCode=client_country_code,
+                wishRegularConnections=bool(
+                    flags & _WISH_REGULAR_CONNECTIONS_FLAG)
+            )
+        )
+    return peer_id_info_list
+
+
+def _encode_address(address):
+    if address is None:
+        return serializer_api.serialize_byte_value(_NO_ADDRESS)
+    for family, length in ((socket.AF_INET, _IPV4_LENGTH),
+                           (socket.AF_INET6, _IPV6_LENGTH)):
+        try:
+            packed = socket.inet_pton(family, address)
+        except (socket.error, ValueError, UnicodeError):
+            continue
+        # only canonical forms are packed, so that decoding gives back the
+        # exact same string
+        if socket.inet_ntop(family, packed) == address:
+            return serializer_api.serialize_byte_value(length) + packed
+    return serializer_api.serialize_byte_value(_STRING_ADDRESS) + \
+           serializer_api.serialize_string(address)
+
+
+def _decode_address(reader):
+    length = reader.read_byte_value()
+    if length == _NO_ADDRESS:
+        return None
+    elif length == _STRING_ADDRESS:
+        return reader.read_string()
+    elif length == _IPV4_LENGTH:
+        return unicode(socket.inet_ntop(
+            socket.AF_INET, reader.read_bytes(length).tobytes()))
+    else:
+        return unicode(socket.inet_ntop(
+            socket.AF_INET6, reader.read_bytes(length).tobytes()))
+
+
+def _encode_port(port):
+    if port is None:
+        return serializer_api.serialize_byte_value(_NO_PORT)
+    if 0 <= port <= _MAX_PORT:
+        return serializer_api.serialize_byte_value(_SHORT_PORT) + \
+               serializer_api.serialize_short_value(port)
+    return serializer_api.serialize_byte_value(_LONG_PORT) + \
+           serializer_api.serialize_long_value(port)
+
+
+def _decode_port(reader):
+    length = reader.read_byte_value()
+    if length == _NO_PORT:
+        return None
+    elif length == _SHORT_PORT:
+        return reader.read_short_value() & _MAX_PORT
+    else:
+        return reader.read_long_value()
+
+
+def _encode_country_code(country_code):
+    if not country_code:
+        return bytearray(_NO_COUNTRY)
+    if len(country_code) == 2 and all(ord(c) < 0x80 for c in country_code):
+        return bytearray(country_code.encode('ascii'))
+    # any other code the clients send (such as three letter codes)
+    return bytearray(_STRING_COUNTRY) + \
+        serializer_api.serialize_string(country_code)
+
+
+def _decode_country_code(reader):
+    country_code = reader.read_bytes(2).tobytes()
+    if country_code == _NO_COUNTRY:
+        return None
+    elif country_code == _STRING_COUNTRY:
+        return reader.read_string()
+    return country_code.decode('ascii')
@@ -0,0 +1,73 @@
+"""
+Compares the size and encoding time of InfoResponse payloads in JSON (as
+returned by the endpoints) against the binary peer_info_codec mode.
+
+Usage: python peer_info_codec_benchmark.py
+"""
+import random
+import timeit
+
+from protorpc import protojson
+
+import peer_info_codec
+from models import InfoResponse
+from models import PeerIDInfo
+
+PEER_COUNTS = [5, 100, 1000]
+
+COUNTRY_CODES = [u'ES', u'FR', u'DE', u'US', u'GB', u'IT']
+
+
+def _random_ip():
+    return u'.'.join(str(random.randint(1, 254)) for i in range(4))
+
+
+def generate_peer_id_info_list(count):
+    return [
+        PeerIDInfo(
+            peerID=u'%064x' % random.getrandbits(256),
+            localIPAddress=u'192.168.%d.%d' % (random.randint(0, 254),
+                                               random.randint(1, 254)),
+            externalIPAddress=_random_ip(),
+            localMainServerPort=random.randint(1024, 65535),
+            externalMainServerPort=random.randint(1024, 65535),
+            clientCountryCode=random.choice(COUNTRY_CODES),
+            wishRegularConnections=random.random() < 0.5
+        )
+        for i in range(count)]
+
+
+def encode_json(peer_id_info_list):
+    return protojson.encode_message(
+        InfoResponse(peerIDInfoList=peer_id_info_list))
+
+
+def encode_binary(peer_id_info_list):
+    return protojson.encode_message(
+        InfoResponse(packedPeerIDInfoList=bytes(
+            peer_info_codec.encode_peer_id_info_list(peer_id_info_list))))
+
+
+def _time(function, peer_id_info_list, iterations):
+    # best of 3 runs, in milliseconds per call
+    return min(timeit.repeat(lambda: function(peer_id_info_list),
+                             number=iterations, repeat=3)) / iterations * 1e3
+
+
+def main():
+    print('%6s %12s %12s %7s %12s %12s' % (
+        'peers', 'json bytes', 'binary bytes', 'ratio', 'json ms',
+        'binary ms'))
+    for count in PEER_COUNTS:
+        peer_id_info_list = generate_peer_id_info_list(count)
+        iterations = max(1, 2000 // count)
+        json_size = len(encode_json(peer_id_info_list))
+        binary_size = len(encode_binary(peer_id_info_list))
+        print('%6d %12d %12d %6.2fx %12.3f %12.3f' % (
+            count, json_size, binary_size, float(json_size) / binary_size,
+            _time(encode_json, peer_id_info_list, iterations),
+            _time(encode_binary, peer_id_info_list, iterations)))
+
+
+if __name__ == '__main__':
+    main()
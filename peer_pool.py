@@ -0,0 +1,220 @@
+"""
+Per-country pools of the peers that wish regular connections, shared by all
+instances through memcache.
+
+Each country pool is split in SHARD_COUNT memcache entries (lists of at
+most MAX_SHARD_SIZE peer IDs, a peer always going to the same shard), updated
+with compare-and-set on connect, disconnect and expiry. Shards that are
+missing from memcache (never built, or evicted) are rebuilt from the
+datastore when they are next sampled.
+
+Sampling reads SAMPLED_SHARDS random shards (all of them only for pools too
+small to fill a request), so its cost does not grow with the pool. It is
+random, and less likely to pick peers that were handed out recently, so that
+load spreads over the whole pool. Countries with too few peers are completed
+with peers from neighbouring countries.
+"""
+import logging
+import random
+import zlib
+
+import candidate_pool
+import storage
+import utils
+from storage import memcache
+
+NAMESPACE = 'peer_pool'
+HANDOUTS_NAMESPACE = 'peer_handouts'
+
+SHARD_COUNT = 16
+
+# peers kept per shard, so that shards stay far below the memcache value
+# size limit and cheap to rewrite. Peers added to a full shard are left out
+# of the pool
+MAX_SHARD_SIZE = 625
+
+# shards read per batch when sampling
+SAMPLED_SHARDS = 2
+
+# attempts of a compare-and-set update before giving up
+CAS_RETRIES = 10
+
+# peers read from the datastore when rebuilding a country pool
+MAX_REBUILD_PEERS = SHARD_COUNT * MAX_SHARD_SIZE
+
+# weight candidates by how recently they were handed out
+WEIGHT_BY_HANDOUT_RECENCY = True
+
+# countries whose peers complete the results of a country with a small pool,
+# in order of preference
+NEIGHBOUR_COUNTRIES = {
+    'AD': ['ES', 'FR'],
+    'AT': ['DE', 'CH', 'IT', 'CZ', 'HU'],
+    'BE': ['NL', 'FR', 'DE', 'LU'],
+    'CA': ['US'],
+    'CH': ['DE', 'FR', 'IT', 'AT'],
+    'CZ': ['DE', 'AT', 'PL', 'SK'],
+    'DE': ['AT', 'CH', 'NL', 'FR', 'PL', 'CZ', 'BE', 'DK'],
+    'DK': ['DE', 'SE', 'NO'],
+    'ES': ['PT', 'FR', 'AD'],
+    'FI': ['SE', 'EE', 'NO'],
+    'FR': ['ES', 'BE', 'CH', 'DE', 'IT', 'LU'],
+    'GB': ['IE', 'FR', 'NL', 'BE'],
+    'IE': ['GB'],
+    'IT': ['FR', 'CH', 'AT', 'SI'],
+    'LU': ['BE', 'FR', 'DE'],
+    'MX': ['US', 'GT'],
+    'NL': ['BE', 'DE'],
+    'NO': ['SE', 'DK', 'FI'],
+    'PL': ['DE', 'CZ', 'SK', 'LT'],
+    'PT': ['ES'],
+    'SE': ['NO', 'FI', 'DK'],
+    'US': ['CA', 'MX'],
+}
+
+
+def add(country_code, peer_id):
+    _update(country_code, peer_id, _add_to_shard)
+
+
+def remove(country_code, peer_id):
+    _update(country_code, peer_id, _remove_from_shard)
+
+
+def remove_multi(peer_ids_by_country):
+    """
+    :param peer_ids_by_country: dict with lists of peer IDs by country code
+    """
+    for country_code, peer_ids in peer_ids_by_country.items():
+        for peer_id in peer_ids:
+            remove(country_code, peer_id)
+
+
+def sample(country_code, count, excluded=()):
+    """
+    Picks random peers of a country, completing with peers of neighbouring
+    countries if the country has too few
+    :param country_code: country of the peers
+    :param count: number of peers to pick
+    :param excluded: peer IDs that must not be picked
+    :return: list of (country code, peer ID) tuples
+    """
+    now = utils.timestamp()
+    picked = []
+    excluded = set(excluded)
+    for country in [country_code] + NEIGHBOUR_COUNTRIES.get(country_code, []):
+        candidates = _sample_country(country, count - len(picked), excluded)
+        if WEIGHT_BY_HANDOUT_RECENCY:
+            candidates = candidate_pool.weighted_sample(
+                candidates, count - len(picked),
+                memcache.get_multi(candidates, namespace=HANDOUTS_NAMESPACE),
+                now)
+        picked.extend((country, peer_id) for peer_id in candidates)
+        excluded.update(candidates)
+        if len(picked) >= count:
+            break
+    if WEIGHT_BY_HANDOUT_RECENCY and picked:
+        memcache.set_multi(
+            dict((peer_id, now) for country, peer_id in picked),
+            time=candidate_pool.DEFAULT_HANDOUT_COOLDOWN,
+            namespace=HANDOUTS_NAMESPACE)
+    return picked
+
+
+def _sample_country(country_code, count, excluded):
+    # reads SAMPLED_SHARDS random shards, and the others only if those do
+    # not hold enough candidates (in small pools)
+    oversampling = candidate_pool.OVERSAMPLING \
+        if WEIGHT_BY_HANDOUT_RECENCY else 1
+    shard_order = random.sample(xrange(SHARD_COUNT), SHARD_COUNT)
+    shards = _load_shards(country_code, shard_order[:SAMPLED_SHARDS])
+    if sum(len(shard) for shard in shards) < \
+            (count + len(excluded)) * oversampling:
+        shards += _load_shards(country_code, shard_order[SAMPLED_SHARDS:])
+    return _sample_shards(shards, count, excluded, oversampling)
+
+
+def _sample_shards(shards, count, excluded, oversampling):
+    # draws positions over the shards as a whole, without joining them
+    total = sum(len(shard) for shard in shards)
+    wanted = min(total, (count + len(excluded)) * oversampling)
+    candidates = []
+    for position in random.sample(xrange(total), wanted):
+        for shard in shards:
+            if position < len(shard):
+                if shard[position] not in excluded:
+                    candidates.append(shard[position])
+                break
+            position -= len(shard)
+        if len(candidates) >= count * oversampling:
+            break
+    return candidates
+
+
+def _shard_key(country_code, shard):
+    return '%s:%d' % (country_code, shard)
+
+
+def _shard_of(peer_id):
+    return (zlib.crc32(peer_id.encode('utf-8')) & 0xFFFFFFFF) % SHARD_COUNT
+
+
+def _load_shards(country_code, shard_numbers):
+    keys = [_shard_key(country_code, shard) for shard in shard_numbers]
+    cached = memcache.get_multi(keys, namespace=NAMESPACE)
+    if len(cached) == len(keys):
+        return [cached[key] for key in keys]
+    shards = _rebuild(country_code)
+    return [cached.get(_shard_key(country_code, shard), shards[shard])
+            for shard in shard_numbers]
+
+
+def _rebuild(country_code):
+    # shards still in memcache are kept (they may have newer updates), only
+    # the missing ones are added
+    peer_ids = storage.backend.regular_peer_ids(country_code,
+                                                MAX_REBUILD_PEERS)
+    shards = [[] for shard in range(SHARD_COUNT)]
+    for peer_id in peer_ids:
+        shard = shards[_shard_of(peer_id)]
+        if len(shard) < MAX_SHARD_SIZE:
+            shard.append(peer_id)
+    memcache.add_multi(
+        dict((_shard_key(country_code, shard), shards[shard])
+             for shard in range(SHARD_COUNT)),
+        namespace=NAMESPACE)
+    logging.info("Rebuilt peer pool of %s with %d peers", country_code,
+                 len(peer_ids))
+    return shards
+
+
+def _update(country_code, peer_id, update_function):
+    # shards missing from memcache are left alone: the pool is rebuilt from
+    # the datastore when it is next sampled
+    key = _shard_key(country_code, _shard_of(peer_id))
+    client = memcache.Client()
+    for i in range(CAS_RETRIES):
+        shard = client.gets(key, namespace=NAMESPACE)
+        if shard is None:
+            return
+        updated_shard = update_function(shard, peer_id)
+        if updated_shard is None or \
+                client.cas(key, updated_shard, namespace=NAMESPACE):
+            return
+    # the shard stays as it is: a peer that was not removed is removed when
+    # a request finds it without session, and a peer that was not added is
+    # only missed by sampling
+    logging.warning("Could not update peer pool shard %s", key)
+
+
+def _add_to_shard(shard, peer_id):
+    if peer_id in shard or len(shard) >= MAX_SHARD_SIZE:
+        return None
+    return shard + [peer_id]
+
+
+def _remove_from_shard(shard, peer_id):
+    if peer_id not in shard:
+        return None
+    return [shard_peer_id for shard_peer_id in shard
+            if shard_peer_id != peer_id]
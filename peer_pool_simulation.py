@@ -0,0 +1,123 @@
+"""
+Simulates regular_peers_request calls against the peer pool of a country
+(peer_pool.py, on the in-memory storage backend), and reports how evenly the
+handouts spread over the peers with each selection strategy, and the
+memcache calls that each request makes:
+- first: the previous behaviour, always the first peers of the query
+- uniform: peer_pool sampling
+- weighted: peer_pool sampling weighted by how recently peers were handed
+  out
+
+The simulation runs in virtual time (see utils.set_clock).
+
+Needs the App Engine SDK libraries (ndb) on the Python path, but no App
+Engine services.
+
+Usage: python peer_pool_simulation.py [peers] [requests] [requests/second]
+"""
+import datetime
+import os
+import sys
+import time
+
+os.environ.setdefault('APPLICATION_ID', 'jaczserver')
+
+import memory_storage
+import peer_pool
+import storage
+import utils
+from models import ActiveSession
+
+PEERS_PER_REQUEST = 5
+
+# a country without neighbours, so that every peer comes from its pool
+COUNTRY_CODE = 'ZZ'
+
+
+def _first(count):
+    return storage.backend.regular_peer_ids(COUNTRY_CODE, count)
+
+
+def _sample(count):
+    return [peer_id for country_code, peer_id
+            in peer_pool.sample(COUNTRY_CODE, count)]
+
+
+STRATEGIES = [
+    ('first', _first, False),
+    ('uniform', _sample, False),
+    ('weighted', _sample, True),
+]
+
+
+def _populate(peer_count):
+    now = datetime.datetime.now()
+    storage.backend.put_sessions([
+        ActiveSession(id='peer%d' % i, peerID='peer%d' % i,
+                      connectionTime=now, lastRefreshTime=now,
+                      localIPAddress='10.0.0.1',
+                      externalIPAddress='10.0.0.1',
+                      localMainServerPort=1,
+                      externalMainServerPort=1,
+                      clientCountryCode=COUNTRY_CODE,
+                      wishRegularConnections=True)
+        for i in range(peer_count)])
+
+
+def simulate(strategy, weighted, peer_count, request_count, request_rate):
+    """
+    :return: (list with the number of handouts of each peer, memcache calls
+    per request)
+    """
+    backend = memory_storage.MemoryStorage()
+    storage.use(backend)
+    _populate(peer_count)
+    handouts = dict(('peer%d' % i, 0) for i in range(peer_count))
+    clock = [time.time()]
+    utils.set_clock(lambda: clock[0])
+    original_weighting = peer_pool.WEIGHT_BY_HANDOUT_RECENCY
+    peer_pool.WEIGHT_BY_HANDOUT_RECENCY = weighted
+    try:
+        # the first request builds the pool, and is not counted
+        strategy(PEERS_PER_REQUEST)
+        start_operations = sum(backend.memcache.operations.values())
+        for request in range(request_count):
+            clock[0] += 1.0 / request_rate
+            for peer_id in strategy(PEERS_PER_REQUEST):
+                handouts[peer_id] += 1
+    finally:
+        peer_pool.WEIGHT_BY_HANDOUT_RECENCY = original_weighting
+        utils.set_clock(time.time)
+    operations = sum(backend.memcache.operations.values()) - start_operations
+    return handouts.values(), float(operations) / request_count
+
+
+def gini(values):
+    values = sorted(values)
+    total = sum(values)
+    if not total:
+        return 0.0
+    weighted = sum((i + 1) * value for i, value in enumerate(values))
+    return 2.0 * weighted / (len(values) * total) - \
+        float(len(values) + 1) / len(values)
+
+
+def main(peer_count=200, request_count=20000, request_rate=10.0):
+    ideal = float(request_count * PEERS_PER_REQUEST) / peer_count
+    print('%d peers, %d requests of %d peers, %.1f requests/s '
+          '(ideal: %.1f handouts per peer)' % (
+              peer_count, request_count, PEERS_PER_REQUEST, request_rate,
+              ideal))
+    print('%-9s %8s %8s %8s %8s %7s %9s' % (
+        'strategy', 'min', 'max', 'max/avg', 'idle', 'gini', 'memcache'))
+    for name, strategy, weighted in STRATEGIES:
+        handouts, operations = simulate(strategy, weighted, peer_count,
+                                        request_count, request_rate)
+        print('%-9s %8d %8d %8.2f %8d %7.3f %9.1f' % (
+            name, min(handouts), max(handouts), max(handouts) / ideal,
+            sum(1 for count in handouts if count == 0), gini(handouts),
+            operations))
+
+
+if __name__ == '__main__':
+    main(*[float(arg) if '.' in arg else int(arg) for arg in sys.argv[1:]])
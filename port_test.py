@@ -0,0 +1,98 @@
+"""
+Reachability test of the main server port of connecting peers, performed by
+the external port test service.
+
+Tests run as asynchronous urlfetch RPCs with a bounded deadline: start_test
+issues the request and returns a PortTest, whose get_result waits for it.
+Results are cached by (external IP, port, peerID), so reconnections of a
+peer do not call the service again. Failed calls (timeouts, service errors)
+count as unreachable but are not cached.
+"""
+import json
+import logging
+import urllib
+
+from google.appengine.api import urlfetch
+
+import caches
+from settings import PORT_TEST_SERVICE_URL
+
+# seconds to wait for the port test service
+DEADLINE = 5
+
+# seconds that results are cached. Unreachable results are kept for less
+# time, so a peer that fixes its port forwarding can soon connect
+REACHABLE_TTL = 10 * 60
+UNREACHABLE_TTL = 60
+
+CACHE_SIZE = 10000
+
+cache = caches.ReadThroughCache('port_test', lru_size=CACHE_SIZE,
+                                ttl=REACHABLE_TTL,
+                                negative_ttl=UNREACHABLE_TTL)
+
+
+class PortTest:
+    """
+    A port test, either already resolved from the cache or waiting for the
+    response of the port test service.
+    """
+
+    def __init__(self, cache_key, result=None, rpc=None):
+        self._cache_key = cache_key
+        self._result = result
+        self._rpc = rpc
+
+    def get_result(self):
+        """
+        :return: True if the port is reachable
+        """
+        if self._result is None:
+            self._result = self._resolve()
+        return self._result
+
+    def _resolve(self):
+        try:
+            response = self._rpc.get_result()
+            result = json.loads(response.content)
+        except (urlfetch.Error, ValueError) as e:
+            logging.warning("Port test of %s failed: %r", self._cache_key, e)
+            return False
+        if not isinstance(result, dict):
+            logging.warning("Port test of %s failed: unexpected response %r",
+                            self._cache_key, response.content)
+            return False
+        reachable = result.get("result") == 'OK'
+        if logging.getLogger().isEnabledFor(logging.DEBUG):
+            logging.debug("Port test of %s: %s", self._cache_key,
+                          response.content)
+        cache.set(self._cache_key, reachable,
+                  REACHABLE_TTL if reachable else UNREACHABLE_TTL)
+        return reachable
+
+
+def start_test(peer_id, public_ip, main_port):
+    """
+    Starts the reachability test of a peer port
+    :param peer_id: ID of the peer
+    :param public_ip: external IP address of the peer
+    :param main_port: external main server port of the peer
+    :return: PortTest of the port
+    """
+    cache_key = '%s:%s:%s' % (public_ip, main_port, peer_id)
+    cached = cache.peek(cache_key)
+    if cached is not None:
+        return PortTest(cache_key, result=cached)
+    form_data = urllib.urlencode({
+        "ip": public_ip,
+        "port": main_port,
+        "peerid": peer_id
+    })
+    rpc = urlfetch.create_rpc(deadline=DEADLINE)
+    urlfetch.make_fetch_call(
+        rpc,
+        url=PORT_TEST_SERVICE_URL,
+        payload=form_data,
+        method=urlfetch.POST,
+        headers={'Content-Type': 'application/x-www-form-urlencoded'})
+    return PortTest(cache_key, rpc=rpc)
@@ -0,0 +1,69 @@
+"""
+Local stand-in of the port test service, for running and benchmarking the
+connect path offline. Answers POST /porttestservice/ports like the real
+service, without actually testing the ports.
+
+To use it, set PORT_TEST_SERVICE_URL in settings.py to
+http://127.0.0.1:<port>/porttestservice/ports
+
+Usage: python port_test_service.py [port] [latency (s)] [unreachable ratio]
+"""
+import BaseHTTPServer
+import SocketServer
+import json
+import random
+import sys
+import time
+import urlparse
+
+PATH = '/porttestservice/ports'
+
+
+class PortTestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    # set by main
+    latency = 0.0
+    unreachable_ratio = 0.0
+
+    def do_POST(self):
+        if self.path != PATH:
+            self.send_error(404)
+            return
+        length = int(self.headers.getheader('Content-Length') or 0)
+        fields = urlparse.parse_qs(self.rfile.read(length))
+        if not all(name in fields for name in ('ip', 'port', 'peerid')):
+            self.send_error(400)
+            return
+        if self.latency:
+            time.sleep(self.latency)
+        reachable = random.random() >= self.unreachable_ratio
+        body = json.dumps({'result': 'OK' if reachable else 'KO'})
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class PortTestServer(SocketServer.ThreadingMixIn,
+                     BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+
+def main(port=8080, latency=0.0, unreachable_ratio=0.0):
+    PortTestHandler.latency = latency
+    PortTestHandler.unreachable_ratio = unreachable_ratio
+    server = PortTestServer(('127.0.0.1', port), PortTestHandler)
+    print('Port test service on http://127.0.0.1:%d%s (latency %.3fs, '
+          '%.0f%% unreachable)' % (port, PATH, latency,
+                                   unreachable_ratio * 100))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main(*[float(arg) if '.' in arg else int(arg) for arg in sys.argv[1:]])
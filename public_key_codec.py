@@ -0,0 +1,94 @@
+"""
+Compact binary encoding of the public keys of a peer (the publicKeySizes and
+publicKeyValues of a registration), built on serializer_api. Stored in
+PeerData.publicKeys instead of the hexadecimal strings, halving their size.
+
+Layout: a flags byte, followed by the body (zlib-compressed if the
+_COMPRESSED_FLAG is set):
+- an int with the number of sizes, followed by each size as a long
+- an int with the number of values, followed for each value by a kind byte
+  and
+  - for lowercase hexadecimal values, an int with the number of digits and
+    the raw bytes (with a leading 0 digit if the number of digits is odd)
+  - for any other value, a serializer_api string
+"""
+import binascii
+import re
+import zlib
+
+import serializer_api
+
+# compress the body when it gets smaller. Keys are random bytes, so this
+# rarely pays off, but costs a compression attempt per registration
+COMPRESS = False
+COMPRESSION_LEVEL = 6
+
+_COMPRESSED_FLAG = 0x01
+
+_HEX_VALUE = 0
+_STRING_VALUE = 1
+
+_HEX_PATTERN = re.compile(r'\A[0-9a-f]*\Z')
+
+
+def encode_public_keys(sizes, values, compress=COMPRESS):
+    """
+    Encodes the public keys of a peer
+    :param sizes: list of key sizes
+    :param values: list of key values (hexadecimal strings)
+    :param compress: compress the encoding if that makes it smaller
+    :return: byte string with the encoded keys
+    """
+    body = serializer_api.serialize_int_value(len(sizes))
+    for size in sizes:
+        body += serializer_api.serialize_long_value(size)
+    body += serializer_api.serialize_int_value(len(values))
+    for value in values:
+        body += _encode_value(value)
+    body = bytes(body)
+    flags = 0
+    if compress:
+        compressed_body = zlib.compress(body, COMPRESSION_LEVEL)
+        if len(compressed_body) < len(body):
+            body = compressed_body
+            flags |= _COMPRESSED_FLAG
+    return bytes(serializer_api.serialize_byte_value(flags)) + body
+
+
+def decode_public_keys(data):
+    """
+    Decodes the public keys of a peer
+    :param data: buffer with the encoded keys
+    :return: (list of key sizes, list of key values)
+    """
+    reader = serializer_api.Reader(data)
+    flags = reader.read_byte_value()
+    if flags & _COMPRESSED_FLAG:
+        reader = serializer_api.Reader(
+            zlib.decompress(reader.read_bytes(reader.remaining()).tobytes()))
+    sizes = [reader.read_long_value()
+             for i in range(reader.read_int_value())]
+    values = [_decode_value(reader)
+              for i in range(reader.read_int_value())]
+    return sizes, values
+
+
+def _encode_value(value):
+    if _HEX_PATTERN.match(value):
+        digits = len(value)
+        return serializer_api.serialize_byte_value(_HEX_VALUE) + \
+            serializer_api.serialize_int_value(digits) + \
+            bytearray(binascii.unhexlify('0' * (digits % 2) + value))
+    return serializer_api.serialize_byte_value(_STRING_VALUE) + \
+        serializer_api.serialize_string(value)
+
+
+def _decode_value(reader):
+    kind = reader.read_byte_value()
+    if kind == _HEX_VALUE:
+        digits = reader.read_int_value()
+        value = binascii.hexlify(reader.read_bytes((digits + 1) // 2))
+        return value[len(value) - digits:].decode('ascii')
+    elif kind == _STRING_VALUE:
+        return reader.read_string()
+    raise ValueError("Unknown public key value kind: %d" % kind)
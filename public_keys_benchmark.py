@@ -0,0 +1,74 @@
+"""
+Compares the stored size and the load time of PeerData entities with the
+public keys in hexadecimal repeated properties (legacy) and packed with
+public_key_codec, with and without compression.
+
+Load time is the time to parse the serialized entity and build the model
+(as a datastore get or a memcache hit does), and access time adds reading
+the keys with PeerData.public_keys, which decodes packed keys.
+
+Needs the App Engine SDK libraries (ndb) on the Python path.
+
+Usage: python public_keys_benchmark.py [entities] [keys per peer] [key bits]
+"""
+import datetime
+import os
+import random
+import sys
+import time
+
+os.environ.setdefault('APPLICATION_ID', 'jaczserver')
+
+from google.appengine.datastore import entity_pb
+
+import public_key_codec
+from models import PeerData
+
+
+def _peers(count, key_count, key_bits, packed, compress=False):
+    now = datetime.datetime.now()
+    peers = []
+    for i in range(count):
+        peer_id = '%032x' % random.getrandbits(128)
+        sizes = [key_bits] * key_count
+        values = [u'%0*x' % (key_bits // 4, random.getrandbits(key_bits))
+                  for j in range(key_count)]
+        if packed:
+            peers.append(PeerData(
+                id=peer_id, peerID=peer_id, registrationTime=now,
+                publicKeys=public_key_codec.encode_public_keys(
+                    sizes, values, compress)))
+        else:
+            peers.append(PeerData(
+                id=peer_id, peerID=peer_id, registrationTime=now,
+                publicKeySizes=sizes, publicKeyValues=values))
+    return peers
+
+
+def _load(serialized_peers, access):
+    start = time.time()
+    for data in serialized_peers:
+        peer = PeerData._from_pb(entity_pb.EntityProto(data))
+        if access:
+            peer.public_keys()
+    return time.time() - start
+
+
+def main(count=10000, key_count=2, key_bits=2048):
+    print('%-20s %12s %16s %16s' % ('format', 'bytes/entity',
+                                    'load us/entity', 'access us/entity'))
+    for name, packed, compress in (('hex (legacy)', False, False),
+                                   ('packed', True, False),
+                                   ('packed, compressed', True, True)):
+        serialized_peers = [peer._to_pb().Encode() for peer in
+                            _peers(count, key_count, key_bits, packed,
+                                   compress)]
+        size = sum(len(data) for data in serialized_peers) / float(count)
+        load_time = _load(serialized_peers, False)
+        access_time = _load(serialized_peers, True)
+        print('%-20s %12.0f %16.2f %16.2f' % (
+            name, size, load_time * 1e6 / count, access_time * 1e6 / count))
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:]])
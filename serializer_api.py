@@ -1,4 +1,5 @@
 import codecs
+import struct
 
 
 class MutableOffset:
@@ -12,12 +13,73 @@ class MutableOffset:
         return self.offset
 
 
+def _offset_or_new(m_offset):
+    # each call without an explicit offset gets its own, so calls never share
+    # (and corrupt) a common default instance
+    if m_offset is None:
+        return MutableOffset()
+    return m_offset
+
+
+# precompiled big-endian formats for the supported number widths. Values are
+# packed unsigned (after masking to the width, as the original hex based
+# encoding did), and unpacked signed
+_PACK_FORMATS = {
+    1: struct.Struct('>B'),
+    2: struct.Struct('>H'),
+    4: struct.Struct('>I'),
+    8: struct.Struct('>Q'),
+}
+
+_UNPACK_FORMATS = {
+    1: struct.Struct('>b'),
+    2: struct.Struct('>h'),
+    4: struct.Struct('>i'),
+    8: struct.Struct('>q'),
+}
+
+
 def serialize_number(number, byte_count):
     """
     Serializes a number into an array of bytes
     :param number: number to serialize
     :param byte_count: number of bytes that the serialization should span
     :return: the byte array with the serialized number
+    :raise ValueError: if the number is below -2^(8 * byte_count). Other
+    values are masked to byte_count bytes (wrapping as the original hex
+    based encoding did), but the hex encoding gave other bytes for those
+    """
+    bits = byte_count * 8
+    if number < -(1 << bits):
+        raise ValueError("%d does not fit in %d bytes" % (number, byte_count))
+    packer = _PACK_FORMATS.get(byte_count)
+    if packer is None:
+        return _serialize_number_hex(number, byte_count)
+    return bytearray(packer.pack(number & ((1 << bits) - 1)))
+
+
+def deserialize_number(data, byte_count, m_offset=None):
+    """
+    Deserializes a number from a byte array
+    :param data: byte array with the serialized number
+    :param byte_count: number of bytes to deserialize
+    :param m_offset: MutableOffset instance for reading from the data. If
+    None, the data is read from its start
+    :return: the deserialized number
+    """
+    m_offset = _offset_or_new(m_offset)
+    unpacker = _UNPACK_FORMATS.get(byte_count)
+    if unpacker is None:
+        return _deserialize_number_hex(data, byte_count, m_offset)
+    number = unpacker.unpack_from(data, m_offset.value())[0]
+    m_offset.add(byte_count)
+    return number
+
+
+def _serialize_number_hex(number, byte_count):
+    """
+    Original hex based serialization. Used for byte counts without a
+    precompiled format, and as reference for the struct based engine
     """
     if number < 0:
         number += 2**(byte_count * 8)
@@ -30,13 +92,10 @@ def serialize_number(number, byte_count):
     return bytes
 
 
-def deserialize_number(data, byte_count, m_offset):
+def _deserialize_number_hex(data, byte_count, m_offset):
     """
-    Deserializes a number from a byte array
-    :param data: byte array with the serialized number
-    :param byte_count: number of bytes to deserialize
-    :param offset: MutableOffset instance for reading from the data
-    :return: the deserialized number
+    Original hex based deserialization. Used for byte counts without a
+    precompiled format, and as reference for the struct based engine
     """
     hex_str = ""
     for i in range(m_offset.value(), m_offset.value() + byte_count):
@@ -113,7 +172,7 @@ def serialize_long_value(long_):
     return serialize_number(long_, 8)
 
 
-def deserialize_boolean(data, m_offset=MutableOffset()):
+def deserialize_boolean(data, m_offset=None):
     byte = deserialize_byte_value(data, m_offset)
     if byte == -1:
         return None
@@ -121,7 +180,8 @@ def deserialize_boolean(data, m_offset=MutableOffset()):
         return byte != 0
 
 
-def deserialize_byte_object(data, m_offset=MutableOffset()):
+def deserialize_byte_object(data, m_offset=None):
+    m_offset = _offset_or_new(m_offset)
     not_none = deserialize_boolean(data, m_offset)
     if not_none:
         return deserialize_byte_value(data, m_offset)
@@ -129,11 +189,12 @@ def deserialize_byte_object(data, m_offset=MutableOffset()):
         return None
 
 
-def deserialize_byte_value(data, m_offset=MutableOffset()):
+def deserialize_byte_value(data, m_offset=None):
     return deserialize_number(data, 1, m_offset)
 
 
-def deserialize_short_object(data, m_offset=MutableOffset()):
+def deserialize_short_object(data, m_offset=None):
+    m_offset = _offset_or_new(m_offset)
     not_none = deserialize_boolean(data, m_offset)
     if not_none:
         return deserialize_short_value(data, m_offset)
@@ -141,11 +202,12 @@ def deserialize_short_object(data, m_offset=MutableOffset()):
         return None
 
 
-def deserialize_short_value(data, m_offset=MutableOffset()):
+def deserialize_short_value(data, m_offset=None):
     return deserialize_number(data, 2, m_offset)
 
 
-def deserialize_int_object(data, m_offset=MutableOffset()):
+def deserialize_int_object(data, m_offset=None):
+    m_offset = _offset_or_new(m_offset)
     not_none = deserialize_boolean(data, m_offset)
     if not_none:
         return deserialize_int_value(data, m_offset)
@@ -153,11 +215,12 @@ def deserialize_int_object(data, m_offset=MutableOffset()):
         return None
 
 
-def deserialize_int_value(data, m_offset=MutableOffset()):
+def deserialize_int_value(data, m_offset=None):
     return deserialize_number(data, 4, m_offset)
 
 
-def deserialize_long_object(data, m_offset=MutableOffset()):
+def deserialize_long_object(data, m_offset=None):
+    m_offset = _offset_or_new(m_offset)
     not_none = deserialize_boolean(data, m_offset)
     if not_none:
         return deserialize_long_value(data, m_offset)
@@ -165,7 +228,7 @@ def deserialize_long_object(data, m_offset=MutableOffset()):
         return None
 
 
-def deserialize_long_value(data, m_offset=MutableOffset()):
+def deserialize_long_value(data, m_offset=None):
     return deserialize_number(data, 8, m_offset)
 
 
@@ -178,7 +241,8 @@ def serialize_string(string, encoding="utf-8"):
         return serialize_int_value(-1)
 
 
-def deserialize_string(data, m_offset=MutableOffset(), encoding="utf-8"):
+def deserialize_string(data, m_offset=None, encoding="utf-8"):
+    m_offset = _offset_or_new(m_offset)
     length = deserialize_int_value(data, m_offset)
     if length >= 0:
         string = codecs.decode(
@@ -190,44 +254,156 @@ def deserialize_string(data, m_offset=MutableOffset(), encoding="utf-8"):
         return None
 
 
-data = serialize_boolean(True)
-data += serialize_boolean(None)
-data += serialize_boolean(False)
-data += serialize_byte_object(None)
-data += serialize_byte_object(-5)
-data += serialize_byte_value(8)
-data += serialize_short_object(None)
-data += serialize_short_object(3)
-data += serialize_short_value(-3)
-data += serialize_int_object(None)
-data += serialize_int_object(-27)
-data += serialize_int_value(5000)
-data += serialize_long_object(None)
-data += serialize_long_object(-300000)
-data += serialize_long_value(123456)
-data += serialize_string(u'hello')
-data += serialize_string(None)
-data += serialize_string(u'fuckkkkkkkkk')
-
-m_offset = MutableOffset()
-print(deserialize_boolean(data, m_offset))
-print(deserialize_boolean(data, m_offset))
-print(deserialize_boolean(data, m_offset))
-print(deserialize_byte_object(data, m_offset))
-print(deserialize_byte_object(data, m_offset))
-print(deserialize_byte_value(data, m_offset))
-print(deserialize_short_object(data, m_offset))
-print(deserialize_short_object(data, m_offset))
-print(deserialize_short_value(data, m_offset))
-print(deserialize_int_object(data, m_offset))
-print(deserialize_int_object(data, m_offset))
-print(deserialize_int_value(data, m_offset))
-print(deserialize_long_object(data, m_offset))
-print(deserialize_long_object(data, m_offset))
-print(deserialize_long_value(data, m_offset))
-print(deserialize_string(data, m_offset))
-print(deserialize_string(data, m_offset))
-print(deserialize_string(data, m_offset))
+class Reader:
+    """
+    Cursor for deserializing values out of a buffer without copying it.
+
+    The buffer (str, bytearray, memoryview, or the receive buffer of a socket)
+    is wrapped in a memoryview, fixed width values are unpacked in place and
+    strings are decoded straight from a slice of the view. Each reader keeps
+    its own position, so a reader per request can be used from many threads
+    over distinct buffers.
+    """
+
+    def __init__(self, data, start=0, end=None):
+        """
+        :param data: buffer to read from
+        :param start: position in data where reading starts
+        :param end: position in data where reading stops (None for the end of
+        the buffer)
+        """
+        view = memoryview(data)
+        if end is None:
+            end = len(view)
+        self.view = view[start:end]
+        self.offset = 0
 
+    def value(self):
+        return self.offset
 
+    def add(self, value):
+        self.offset += value
 
+    def remaining(self):
+        """
+        :return: number of bytes not yet read
+        """
+        return len(self.view) - self.offset
+
+    def read_number(self, byte_count):
+        self._require(byte_count)
+        unpacker = _UNPACK_FORMATS.get(byte_count)
+        if unpacker is None:
+            number = _deserialize_number_hex(
+                bytearray(self.view[self.offset:self.offset + byte_count]),
+                byte_count, MutableOffset())
+        else:
+            number = unpacker.unpack_from(self.view, self.offset)[0]
+        self.offset += byte_count
+        return number
+
+    def read_bytes(self, length):
+        """
+        Reads a fixed number of raw bytes
+        :param length: number of bytes to read
+        :return: a memoryview over the read bytes (no copy is made)
+        """
+        self._require(length)
+        data = self.view[self.offset:self.offset + length]
+        self.offset += length
+        return data
+
+    def read_boolean(self):
+        byte = self.read_number(1)
+        if byte == -1:
+            return None
+        else:
+            return byte != 0
+
+    def read_byte_object(self):
+        return self._read_object(1)
+
+    def read_byte_value(self):
+        return self.read_number(1)
+
+    def read_short_object(self):
+        return self._read_object(2)
+
+    def read_short_value(self):
+        return self.read_number(2)
+
+    def read_int_object(self):
+        return self._read_object(4)
+
+    def read_int_value(self):
+        return self.read_number(4)
+
+    def read_long_object(self):
+        return self._read_object(8)
+
+    def read_long_value(self):
+        return self.read_number(8)
+
+    def read_string(self, encoding="utf-8"):
+        length = self.read_number(4)
+        if length >= 0:
+            return codecs.decode(self.read_bytes(length), encoding)
+        else:
+            return None
+
+    def _read_object(self, byte_count):
+        if self.read_boolean():
+            return self.read_number(byte_count)
+        else:
+            return None
+
+    def _require(self, byte_count):
+        if self.offset + byte_count > len(self.view):
+            raise ValueError(
+                "Not enough data: %d bytes required, %d available" %
+                (byte_count, len(self.view) - self.offset))
+
+
+def _demo():
+    data = serialize_boolean(True)
+    data += serialize_boolean(None)
+    data += serialize_boolean(False)
+    data += serialize_byte_object(None)
+    data += serialize_byte_object(-5)
+    data += serialize_byte_value(8)
+    data += serialize_short_object(None)
+    data += serialize_short_object(3)
+    data += serialize_short_value(-3)
+    data += serialize_int_object(None)
+    data += serialize_int_object(-27)
+    data += serialize_int_value(5000)
+    data += serialize_long_object(None)
+    data += serialize_long_object(-300000)
+    data += serialize_long_value(123456)
+    data += serialize_string(u'hello')
+    data += serialize_string(None)
+    data += serialize_string(u'fuckkkkkkkkk')
+
+    m_offset = MutableOffset()
+    print(deserialize_boolean(data, m_offset))
+    print(deserialize_boolean(data, m_offset))
+    print(deserialize_boolean(data, m_offset))
+    print(deserialize_byte_object(data, m_offset))
+    print(deserialize_byte_object(data, m_offset))
+    print(deserialize_byte_value(data, m_offset))
+    print(deserialize_short_object(data, m_offset))
+    print(deserialize_short_object(data, m_offset))
+    print(deserialize_short_value(data, m_offset))
+    print(deserialize_int_object(data, m_offset))
+    print(deserialize_int_object(data, m_offset))
+    print(deserialize_int_value(data, m_offset))
+    print(deserialize_long_object(data, m_offset))
+    print(deserialize_long_object(data, m_offset))
+    print(deserialize_long_value(data, m_offset))
+    print(deserialize_string(data, m_offset))
+    print(deserialize_string(data, m_offset))
+    print(deserialize_string(data, m_offset))
+
+
+if __name__ == '__main__':
+    _demo()
@@ -0,0 +1,72 @@
+"""
+Micro-benchmark comparing the struct based number encoding of serializer_api
+against the original hex based one, per serialized type.
+
+Usage: python serializer_benchmark.py [iterations]
+"""
+import sys
+import timeit
+
+import serializer_api
+
+TYPES = [
+    ('byte', 1, -5),
+    ('short', 2, -3000),
+    ('int', 4, 5000000),
+    ('long', 8, -300000000000),
+]
+
+DEFAULT_ITERATIONS = 100000
+
+
+def _time(function, iterations):
+    # best of 3 runs, in microseconds per call
+    return min(timeit.repeat(function, number=iterations, repeat=3)) \
+        / iterations * 1e6
+
+
+def benchmark_type(byte_count, value, iterations):
+    """
+    Times serialization and deserialization of a value with both engines
+    :param byte_count: width of the serialized number
+    :param value: value to serialize
+    :param iterations: number of calls per timing run
+    :return: dict with the per-call times (in microseconds) of each engine
+    """
+    data = serializer_api.serialize_number(value, byte_count)
+    return {
+        'serialize_hex': _time(
+            lambda: serializer_api._serialize_number_hex(value, byte_count),
+            iterations),
+        'serialize_struct': _time(
+            lambda: serializer_api.serialize_number(value, byte_count),
+            iterations),
+        'deserialize_hex': _time(
+            lambda: serializer_api._deserialize_number_hex(
+                data, byte_count, serializer_api.MutableOffset()),
+            iterations),
+        'deserialize_struct': _time(
+            lambda: serializer_api.deserialize_number(
+                data, byte_count, serializer_api.MutableOffset()),
+            iterations),
+    }
+
+
+def main(iterations=DEFAULT_ITERATIONS):
+    print('%-6s %-12s %10s %10s %8s' % (
+        'type', 'operation', 'hex (us)', 'struct (us)', 'speedup'))
+    for name, byte_count, value in TYPES:
+        result = benchmark_type(byte_count, value, iterations)
+        for operation in ('serialize', 'deserialize'):
+            hex_time = result[operation + '_hex']
+            struct_time = result[operation + '_struct']
+            print('%-6s %-12s %10.3f %10.3f %7.1fx' % (
+                name, operation, hex_time, struct_time,
+                hex_time / struct_time))
+
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1:
+        main(int(sys.argv[1]))
+    else:
+        main()
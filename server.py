@@ -17,10 +17,8 @@
 import datetime
 import logging
 import endpoints
-import json
 from protorpc import message_types
 from protorpc import remote
-from google.appengine.ext import ndb
 
 from models import HelloReturn
 from models import RegistrationRequest
@@ -30,21 +28,37 @@ from models import ConnectionRequest
 from models import ConnectionResponse
 from models import ConnectionResponseValue
 from models import UpdateRequest
+from models import MultiUpdateRequest
 from models import RefreshResponse
+from models import MultiRefreshResponse
 from models import RefreshResponseValue
 from models import DisconnectResponse
 from models import InfoRequest
 from models import RegularPeersRequest
 from models import PeerIDInfo
 from models import InfoResponse
+from models import CountrySessionCount
+from models import SessionCountsResponse
 from models import PeerData
 from models import ActiveSession
 from settings import WEB_CLIENT_ID
 from settings import ANDROID_CLIENT_ID
 from settings import IOS_CLIENT_ID
 from settings import ANDROID_AUDIENCE
-import urllib
-from google.appengine.api import urlfetch
+import change_log
+import peer_info_codec
+import peer_info_cache
+import peer_pool
+import caches
+import sweeper
+import heartbeats
+import instrumentation
+import port_test
+import public_key_codec
+import session_counters
+import session_tokens
+import storage
+import utils
 
 API_EXPLORER_CLIENT_ID = endpoints.API_EXPLORER_CLIENT_ID
 
@@ -52,6 +66,34 @@ MIN_REMINDER_TIME = 18 * 60000
 MAX_REMINDER_TIME = 20 * 60000
 
 MAX_REGULAR_PEERS_RETRIEVED = 5
+# largest page of a paged regular peers request
+MAX_REGULAR_PEERS_PAGE_SIZE = 100
+
+# record refreshes in memcache (see heartbeats.py) instead of writing the
+# session on every refresh (every other refresh is written)
+HEARTBEAT_WRITE_BEHIND = True
+
+# accept the session IDs handed out before session tokens (keys of the
+# sessions). Can be disabled once those sessions have expired
+LEGACY_SESSION_IDS = True
+
+# name of the secret signing the session tokens (see storage.get_secret)
+SESSION_TOKEN_SECRET = 'session_tokens'
+
+# token signers, by storage backend (each backend keeps its own secret)
+_token_signers = {}
+
+# PeerData never changes after registration, so lookups are cached for long.
+# Unregistered peers are cached for a short time, as they can register
+PEER_DATA_CACHE_SIZE = 10000
+PEER_DATA_CACHE_TTL = 24 * 60 * 60
+PEER_DATA_CACHE_NEGATIVE_TTL = 60
+
+peer_data_cache = caches.ReadThroughCache(
+    'peer_data',
+    lru_size=PEER_DATA_CACHE_SIZE,
+    ttl=PEER_DATA_CACHE_TTL,
+    negative_ttl=PEER_DATA_CACHE_NEGATIVE_TTL)
 
 
 @endpoints.api(name='server', version='v1', audiences=[ANDROID_AUDIENCE],
@@ -61,6 +103,7 @@ MAX_REGULAR_PEERS_RETRIEVED = 5
 class ServerApi(remote.Service):
     @endpoints.method(message_types.VoidMessage, HelloReturn, path='hello',
                       http_method='GET', name='hello')
+    @instrumentation.instrumented
     def hello(self, request):
         """Create new conference."""
         response = HelloReturn()
@@ -70,6 +113,7 @@ class ServerApi(remote.Service):
     @endpoints.method(RegistrationRequest, RegistrationResponse,
                       path='register',
                       http_method='POST', name='register')
+    @instrumentation.instrumented
     def register(self, request):
         # check that this peer has not been already registered
         existing_peer_data = self._get_peer_data(request.peerID)
@@ -78,16 +122,20 @@ class ServerApi(remote.Service):
             return RegistrationResponse(
                 response=RegistrationResponseValue.ALREADY_REGISTERED)
 
-        now = datetime.datetime.now()
-        peer_data = PeerData(peerID=request.peerID,
+        now = utils.now()
+        peer_data = PeerData(id=request.peerID,
+                             peerID=request.peerID,
                              registrationTime=now,
-                             publicKeySizes=request.publicKeySizes,
-                             publicKeyValues=request.publicKeyValues)
-        peer_data.put()
+                             publicKeys=public_key_codec.encode_public_keys(
+                                 request.publicKeySizes,
+                                 request.publicKeyValues))
+        storage.backend.put_peer(peer_data)
+        peer_data_cache.set(request.peerID, peer_data)
         return RegistrationResponse(response=RegistrationResponseValue.OK)
 
     @endpoints.method(ConnectionRequest, ConnectionResponse, path='connect',
                       http_method='POST', name='connect')
+    @instrumentation.instrumented
     def connect(self, request):
         """Create new conference."""
         # session_id = generate_session_id(32)
@@ -124,36 +172,28 @@ class ServerApi(remote.Service):
             raise endpoints.BadRequestException(
                 "Request 'wishRegularConnections' field required")
 
+        timer = utils.StageTimer('connect')
         existing_peer_data = self._get_peer_data(request.peerID)
+        timer.mark('peer_data')
         if not existing_peer_data:
             # peer is not registered
+            instrumentation.record_stages(timer)
             return ConnectionResponse(
                 response=ConnectionResponseValue.UNREGISTERED_PEER)
 
-        client_reachable = self.test_peer_ports(
+        # the port test runs in the background while the session and its
+        # token are built, so the request only waits for the slowest of both.
+        # Nothing is written before the peer is known to be reachable
+        peer_port_test = port_test.start_test(
             request.peerID,
             self.request_state.remote_address,
             request.externalMainServerPort)
+        timer.mark('port_test_start')
 
-        logging.info(client_reachable)
-
-        if not client_reachable:
-            return ConnectionResponse(
-                response=ConnectionResponseValue.PEER_MAIN_SERVER_UNREACHABLE,
-                sessionID='',
-                minReminderTime=MIN_REMINDER_TIME,
-                maxReminderTime=MAX_REMINDER_TIME)
-
-
-        existing_session = self._get_active_session_by_peer(
-            peer_id=request.peerID)
-        if existing_session:
-            logging.info("Session already exists, deleting old session")
-            existing_session.key.delete()
-
-        # create new session
-        now = datetime.datetime.now()
-        active_session = ActiveSession(peerID=request.peerID,
+        # create new session (keyed by peerID, replacing any existing one)
+        now = utils.now()
+        active_session = ActiveSession(id=request.peerID,
+                                       peerID=request.peerID,
                                        connectionTime=now,
                                        lastRefreshTime=now,
                                        localIPAddress=request.localIPAddress,
@@ -162,10 +202,42 @@ class ServerApi(remote.Service):
                                        # localRESTServerPort=request.localRESTServerPort,
                                        externalMainServerPort=request.externalMainServerPort,
                                        clientCountryCode=request.clientCountryCode,
-                                       wishRegularConnections=request.wishRegularConnections)
+                                       wishRegularConnections=request.wishRegularConnections,
+                                       changeVersion=change_log.next_version())
         # externalRESTServerPort=request.externalRESTServerPort)
-        active_session_key = active_session.put()
-        session_id = active_session_key.urlsafe()
+        session_id = self._token_signer().issue(
+            active_session.peerID,
+            active_session.externalIPAddress,
+            active_session.connectionTime)
+
+        client_reachable = peer_port_test.get_result()
+        timer.mark('port_test')
+        if not client_reachable:
+            instrumentation.record_stages(timer)
+            return ConnectionResponse(
+                response=ConnectionResponseValue.PEER_MAIN_SERVER_UNREACHABLE,
+                sessionID='',
+                minReminderTime=MIN_REMINDER_TIME,
+                maxReminderTime=MAX_REMINDER_TIME)
+
+        existing_session = storage.backend.replace_session_async(
+            active_session).get_result()
+        timer.mark('session_write')
+        counter_futures = session_counters.record_changes_async(
+            [active_session], [existing_session] if existing_session else [])
+        if existing_session:
+            logging.debug("Replaced the existing session of %s",
+                          request.peerID)
+            self._remove_from_peer_pool(existing_session)
+        peer_info_cache.set_session(active_session)
+        if active_session.wishRegularConnections:
+            peer_pool.add(active_session.clientCountryCode,
+                          active_session.peerID)
+        timer.mark('peer_pool')
+        for future in counter_futures:
+            future.wait()
+        timer.mark('session_counters')
+        instrumentation.record_stages(timer)
 
         # generate the response
         connection_response = ConnectionResponse(
@@ -180,6 +252,7 @@ class ServerApi(remote.Service):
 
     @endpoints.method(UpdateRequest, RefreshResponse, path='refresh',
                       http_method='POST', name='refresh')
+    @instrumentation.instrumented
     def refresh(self, request):
         """Create new conference."""
         # session_id = generate_session_id(32)
@@ -188,33 +261,117 @@ class ServerApi(remote.Service):
             raise endpoints.BadRequestException(
                 "Request 'sessionID' field required")
 
-        active_session = self._get_active_session_by_key(request.sessionID)
+        active_session, rejection = self._resolve_sessions(
+            [request.sessionID])[request.sessionID]
         if active_session:
-            # active session for this peer exists
-            # check that the peer IP address is similar to the stored one
-            if (
-                        active_session.externalIPAddress != self.request_state.remote_address):
-                return RefreshResponse(
-                    response=RefreshResponseValue.WRONG_IP_ADDRESS)
+            # active session for this peer exists, refreshed from its IP
+            # address
             # Check if ok or too soon
-            now = datetime.datetime.now()
-            if active_session.lastRefreshTime < now - datetime.timedelta(
-                    milliseconds=MIN_REMINDER_TIME):
+            now = utils.now()
+            if self._last_refresh_time(active_session) < \
+                    now - datetime.timedelta(milliseconds=MIN_REMINDER_TIME):
                 # last refresh time older than now - MIN_REMINDER_TIME -> OK
-                active_session.lastRefreshTime = now
-                active_session.put()
+                # (written to the datastore unless recorded as a heartbeat)
+                if not HEARTBEAT_WRITE_BEHIND or \
+                        heartbeats.needs_flush(active_session, now) or \
+                        not heartbeats.record(active_session.key, now):
+                    active_session.lastRefreshTime = now
+                    storage.backend.put_session(active_session)
+                    peer_info_cache.set_session(active_session)
                 return RefreshResponse(response=RefreshResponseValue.OK)
             else:
                 # too soon, remove active_session and notify
-                active_session.key.delete()
+                counter_futures = session_counters.record_changes_async(
+                    removed_sessions=[active_session])
+                storage.backend.delete_session(active_session.key)
+                peer_info_cache.invalidate([active_session.peerID])
+                change_log.record_removals([active_session.peerID])
+                self._remove_from_peer_pool(active_session)
+                for future in counter_futures:
+                    future.wait()
                 return RefreshResponse(response=RefreshResponseValue.TOO_SOON)
 
         else:
-            return RefreshResponse(
-                response=RefreshResponseValue.UNRECOGNIZED_SESSION)
+            return RefreshResponse(response=rejection)
+
+    @endpoints.method(MultiUpdateRequest, MultiRefreshResponse,
+                      path='refresh_multi',
+                      http_method='POST', name='refresh_multi')
+    @instrumentation.instrumented
+    def refresh_multi(self, request):
+        """Refresh several sessions, as a refresh request for each."""
+        if not request.sessionIDList:
+            raise endpoints.BadRequestException(
+                "Request 'sessionIDList' field required")
+
+        resolved_sessions = self._resolve_sessions(request.sessionIDList)
+        now = utils.now()
+        too_soon_limit = now - \
+            datetime.timedelta(milliseconds=MIN_REMINDER_TIME)
+        refresh_times = self._last_refresh_times(
+            [active_session for active_session, rejection
+             in resolved_sessions.values() if active_session])
+
+        # sessions are checked in order, as if refreshed one by one (a
+        # repeated session ID is too soon). They are identified by key, as a
+        # legacy session ID and a token can resolve to different sessions of
+        # the same peer
+        responses = []
+        refreshed_sessions = {}
+        removed_sessions = {}
+        for session_id in request.sessionIDList:
+            active_session, rejection = resolved_sessions[session_id]
+            if rejection:
+                responses.append(rejection)
+            elif active_session.key in removed_sessions:
+                responses.append(RefreshResponseValue.UNRECOGNIZED_SESSION)
+            elif refresh_times[active_session.key] < too_soon_limit:
+                refresh_times[active_session.key] = now
+                refreshed_sessions[active_session.key] = active_session
+                responses.append(RefreshResponseValue.OK)
+            else:
+                # too soon, the session is removed
+                refreshed_sessions.pop(active_session.key, None)
+                removed_sessions[active_session.key] = active_session
+                responses.append(RefreshResponseValue.TOO_SOON)
+
+        futures = []
+        if removed_sessions:
+            futures.extend(storage.backend.delete_sessions_async(
+                removed_sessions.keys()))
+            futures.extend(session_counters.record_changes_async(
+                removed_sessions=removed_sessions.values()))
+        if refreshed_sessions:
+            written_sessions = refreshed_sessions.values()
+            if HEARTBEAT_WRITE_BEHIND:
+                recorded_sessions = [
+                    session for session in written_sessions
+                    if not heartbeats.needs_flush(session, now)]
+                failed_keys = set(heartbeats.record_multi(
+                    [session.key for session in recorded_sessions], now))
+                written_sessions = [
+                    session for session in written_sessions
+                    if session.key in failed_keys or
+                    heartbeats.needs_flush(session, now)]
+            if written_sessions:
+                for active_session in written_sessions:
+                    active_session.lastRefreshTime = now
+                storage.backend.put_sessions(written_sessions)
+                peer_info_cache.set_sessions(written_sessions)
+        if removed_sessions:
+            removed_peer_ids = [session.peerID
+                                for session in removed_sessions.values()]
+            peer_info_cache.invalidate(removed_peer_ids)
+            change_log.record_removals(removed_peer_ids)
+            for active_session in removed_sessions.values():
+                self._remove_from_peer_pool(active_session)
+        for future in futures:
+            future.wait()
+        return MultiRefreshResponse(responseList=responses)
 
     @endpoints.method(UpdateRequest, DisconnectResponse, path='disconnect',
                       http_method='POST', name='disconnect')
+    @instrumentation.instrumented
     def disconnect(self, request):
         """Create new conference."""
         # session_id = generate_session_id(32)
@@ -223,15 +380,25 @@ class ServerApi(remote.Service):
             raise endpoints.BadRequestException(
                 "Request 'sessionID' field required")
 
-        active_session = self._get_active_session_by_key(request.sessionID)
+        # sessions are only disconnected from their IP address
+        active_session, rejection = self._resolve_sessions(
+            [request.sessionID])[request.sessionID]
         if active_session:
-            active_session.key.delete()
+            counter_futures = session_counters.record_changes_async(
+                removed_sessions=[active_session])
+            storage.backend.delete_session(active_session.key)
+            peer_info_cache.invalidate([active_session.peerID])
+            change_log.record_removals([active_session.peerID])
+            self._remove_from_peer_pool(active_session)
+            for future in counter_futures:
+                future.wait()
             return DisconnectResponse(response="OK")
         else:
             return DisconnectResponse(response="UNRECOGNIZED_SESSION")
 
     @endpoints.method(InfoRequest, InfoResponse, path='info',
                       http_method='POST', name='info')
+    @instrumentation.instrumented
     def info(self, request):
         """Create new conference."""
         # session_id = generate_session_id(32)
@@ -240,34 +407,58 @@ class ServerApi(remote.Service):
             raise endpoints.BadRequestException(
                 "Request 'peerIDList' field required")
 
-        # copy peerIDs in a list
+        # copy peerIDs in a list (without duplicates, keeping the order)
         peer_id_list = []
+        seen_peer_ids = set()
         for peerID in request.peerIDList:
-            peer_id_list.append(peerID)
-
-        active_sessions = ActiveSession \
-            .query(ActiveSession.peerID.IN(peer_id_list)) \
-            .fetch()
-
-        peer_id_info_list = []
-        for peer_session in active_sessions:
-            peer_id_info_list.append(
-                PeerIDInfo(
-                    peerID=peer_session.peerID,
-                    localIPAddress=peer_session.localIPAddress,
-                    externalIPAddress=peer_session.externalIPAddress,
-                    localMainServerPort=peer_session.localMainServerPort,
-                    externalMainServerPort=peer_session.externalMainServerPort,
-                    clientCountryCode=peer_session.clientCountryCode,
-                    wishRegularConnections=peer_session.wishRegularConnections
-                )
-            )
-
-        info_response = InfoResponse(peerIDInfoList=peer_id_info_list)
-        return info_response
+            if peerID not in seen_peer_ids:
+                seen_peer_ids.add(peerID)
+                peer_id_list.append(peerID)
+
+        # taken before reading the peers, so that the changes made while
+        # they are read are returned again by the next request
+        version = change_log.covered_version()
+        # resolved through the projection cache, and batched key gets for
+        # the peers not cached
+        peer_values = peer_info_cache.get_multi(peer_id_list,
+                                                self._expiration_limit())
+
+        last_seen_version = request.lastSeenVersion
+        if last_seen_version is None:
+            peer_id_info_list = [
+                self._build_peer_id_info(peer_values[peer_id])
+                for peer_id in peer_id_list if peer_id in peer_values]
+            response = self._build_info_response(peer_id_info_list,
+                                                 request.binaryResponse)
+        else:
+            # only the peers that connected since the last seen version
+            peer_id_info_list = [
+                self._build_peer_id_info(peer_values[peer_id])
+                for peer_id in peer_id_list if peer_id in peer_values and
+                peer_values[peer_id][peer_info_cache.CHANGE_VERSION] >
+                last_seen_version]
+            response = self._build_info_response(peer_id_info_list,
+                                                 request.binaryResponse)
+            # peers without session removed since the last seen version. If
+            # the tombstones do not reach back to it, any of them may have
+            # been, and they are all reported
+            missing_peer_ids = [peer_id for peer_id in peer_id_list
+                                if peer_id not in peer_values]
+            if missing_peer_ids and \
+                    last_seen_version < change_log.tombstone_horizon():
+                response.removedPeerIDList = missing_peer_ids
+            elif missing_peer_ids:
+                removal_versions = change_log.removal_versions(
+                    missing_peer_ids)
+                response.removedPeerIDList = [
+                    peer_id for peer_id in missing_peer_ids
+                    if removal_versions.get(peer_id, 0) > last_seen_version]
+        response.version = version
+        return response
 
     @endpoints.method(RegularPeersRequest, InfoResponse, path='regular_peers_request',
                       http_method='POST', name='regular_peers_request')
+    @instrumentation.instrumented
     def regular_peers_request(self, request):
         """Create new conference."""
         # session_id = generate_session_id(32)
@@ -276,100 +467,205 @@ class ServerApi(remote.Service):
             raise endpoints.BadRequestException(
                 "Request 'clientCountryCode' field required")
 
-        # retrieve a list of candidate peers (same country as in request)
-        query = ActiveSession.query() \
-            .filter(
-            ActiveSession.clientCountryCode == request.clientCountryCode).filter(
-            ActiveSession.wishRegularConnections == True)
+        if request.pageSize is not None or request.cursor:
+            return self._regular_peers_page(request)
 
-        active_sessions = query.fetch(MAX_REGULAR_PEERS_RETRIEVED)
+        # pick random candidate peers (same country as in request, or
+        # neighbouring countries if there are not enough)
+        candidates = peer_pool.sample(request.clientCountryCode,
+                                      MAX_REGULAR_PEERS_RETRIEVED)
+        peer_values = peer_info_cache.get_multi(
+            [peer_id for country_code, peer_id in candidates],
+            self._expiration_limit())
 
         peer_id_info_list = []
-        for peer_session in active_sessions:
-            peer_id_info_list.append(
-                PeerIDInfo(
-                    peerID=peer_session.peerID,
-                    localIPAddress=peer_session.localIPAddress,
-                    externalIPAddress=peer_session.externalIPAddress,
-                    localMainServerPort=peer_session.localMainServerPort,
-                    externalMainServerPort=peer_session.externalMainServerPort,
-                    clientCountryCode=peer_session.clientCountryCode,
-                    wishRegularConnections=peer_session.wishRegularConnections
-                )
-            )
-
-        info_response = InfoResponse(peerIDInfoList=peer_id_info_list)
-        return info_response
+        for country_code, peer_id in candidates:
+            if peer_id in peer_values:
+                peer_id_info_list.append(
+                    self._build_peer_id_info(peer_values[peer_id]))
+            else:
+                # the session of this peer no longer exists, or has expired
+                peer_pool.remove(country_code, peer_id)
+        return self._build_info_response(peer_id_info_list,
+                                         request.binaryResponse)
+
+    @endpoints.method(message_types.VoidMessage, SessionCountsResponse,
+                      path='session_counts',
+                      http_method='GET', name='session_counts')
+    @instrumentation.instrumented
+    def session_counts(self, request):
+        """Number of active sessions per country."""
+        counts = session_counters.get_counts()
+        return SessionCountsResponse(countryList=[
+            CountrySessionCount(clientCountryCode=country_code,
+                                online=online,
+                                wishRegularConnections=wish_regular)
+            for country_code, (online, wish_regular) in sorted(
+                counts.items())])
+
+    def _regular_peers_page(self, request):
+        """
+        Serves a page of the peers of a country that wish regular
+        connections, continuing from the cursor of the request
+        """
+        page_size = MAX_REGULAR_PEERS_RETRIEVED if request.pageSize is None \
+            else request.pageSize
+        if not 0 < page_size <= MAX_REGULAR_PEERS_PAGE_SIZE:
+            raise endpoints.BadRequestException(
+                "Request 'pageSize' field must be between 1 and %d" %
+                MAX_REGULAR_PEERS_PAGE_SIZE)
+        try:
+            peer_ids, next_cursor = storage.backend.regular_peer_ids_page(
+                request.clientCountryCode, page_size, request.cursor or None)
+        except ValueError:
+            raise endpoints.BadRequestException(
+                "Request 'cursor' field is not valid")
+
+        # the PeerIDInfo fields come from the projection cache. Expired
+        # sessions not yet removed by the sweeper are left out, so pages can
+        # be shorter than pageSize
+        peer_values = peer_info_cache.get_multi(peer_ids,
+                                                self._expiration_limit())
+        peer_id_info_list = [self._build_peer_id_info(peer_values[peer_id])
+                             for peer_id in peer_ids
+                             if peer_id in peer_values]
+        response = self._build_info_response(peer_id_info_list,
+                                             request.binaryResponse)
+        response.nextCursor = next_cursor or ''
+        return response
+
+    @staticmethod
+    def _build_peer_id_info(peer_values):
+        """
+        :param peer_values: peer_info_cache entry (starting with the
+        peer_info_cache.FIELDS values)
+        """
+        return PeerIDInfo(**dict(zip(peer_info_cache.FIELDS, peer_values)))
+
+    @staticmethod
+    def _build_info_response(peer_id_info_list, binary_response):
+        if binary_response:
+            return InfoResponse(
+                packedPeerIDInfoList=bytes(
+                    peer_info_codec.encode_peer_id_info_list(
+                        peer_id_info_list)))
+        else:
+            return InfoResponse(peerIDInfoList=peer_id_info_list)
+
+    @staticmethod
+    def _remove_from_peer_pool(active_session):
+        if active_session.wishRegularConnections:
+            peer_pool.remove(active_session.clientCountryCode,
+                             active_session.peerID)
 
     @staticmethod
     def _get_peer_data(peer_id):
-        return PeerData.query(PeerData.peerID == peer_id).get()
+        return peer_data_cache.get(peer_id, ServerApi._load_peer_data)
 
-    def _get_active_session_by_key(self, session_id):
-        try:
-            session_key = ndb.Key(urlsafe=session_id)
-            active_session = session_key.get()
-            if active_session:
-                return active_session
+    @staticmethod
+    def _load_peer_data(peer_id):
+        return storage.backend.get_peer(peer_id)
+
+    def _resolve_sessions(self, session_ids):
+        """
+        Finds the sessions of session IDs. Session tokens that are not valid
+        or were issued to another IP address are rejected before any RPC,
+        and a token of an older session of the peer does not match its
+        current session
+        :return: dict by session ID of (session, None), or (None, the
+        RefreshResponseValue rejecting the session ID)
+        """
+        resolved_sessions = {}
+        tokens = {}
+        legacy_session_ids = []
+        signer = self._token_signer()
+        remote_address = self.request_state.remote_address
+        for session_id in session_ids:
+            token = signer.verify(session_id)
+            if token is None:
+                if LEGACY_SESSION_IDS:
+                    legacy_session_ids.append(session_id)
+                else:
+                    resolved_sessions[session_id] = (
+                        None, RefreshResponseValue.UNRECOGNIZED_SESSION)
+            elif token.external_ip != remote_address:
+                resolved_sessions[session_id] = (
+                    None, RefreshResponseValue.WRONG_IP_ADDRESS)
             else:
-                return None
-        except Exception:
-            return None
-
-    def _get_active_session_by_peer(
-            self,
-            peer_id):
-        return ActiveSession.query(ActiveSession.peerID == peer_id).get()
-
-    def test_peer_ports(
-            self,
-            peer_id,
-            public_ip,
-            main_port):
-        # generate POST request for the ports test server
-        form_fields = {
-            "ip": public_ip,
-            "port": main_port,
-            "peerid": peer_id
-        }
-        form_data = urllib.urlencode(form_fields)
-        result = urlfetch.fetch(
-            url="http://139.162.162.223:8080/porttestservice/ports",
-            # url="http://127.0.0.1:8080/porttestservice/ports",
-            payload=form_data,
-            method=urlfetch.POST,
-            headers={
-                'Content-Type': 'application/x-www-form-urlencoded'})
-        logging.info(result.content)
-        logging.info(json.loads(result.content).get("result"))
-
-        if json.loads(result.content).get("result") == 'OK':
-            return True
-        else:
-            return False
-        # if result.content.result == 'OK':
-        #     logging.info('Client is reachable')
-        # else:
-        #     logging.info('Client is unreachable')
-        return
+                tokens[session_id] = token
+
+        if tokens:
+            sessions = storage.backend.get_sessions(
+                list(set(token.peer_id for token in tokens.values())))
+            for session_id, token in tokens.items():
+                active_session = sessions.get(token.peer_id)
+                if active_session and \
+                        active_session.connectionTime == token.issue_time:
+                    resolved_sessions[session_id] = (active_session, None)
+                else:
+                    resolved_sessions[session_id] = (
+                        None, RefreshResponseValue.UNRECOGNIZED_SESSION)
+
+        if legacy_session_ids:
+            sessions = storage.backend.get_sessions_by_id(legacy_session_ids)
+            for session_id in legacy_session_ids:
+                active_session = sessions.get(session_id)
+                if not active_session:
+                    resolved_sessions[session_id] = (
+                        None, RefreshResponseValue.UNRECOGNIZED_SESSION)
+                elif active_session.externalIPAddress != remote_address:
+                    resolved_sessions[session_id] = (
+                        None, RefreshResponseValue.WRONG_IP_ADDRESS)
+                else:
+                    resolved_sessions[session_id] = (active_session, None)
+        return resolved_sessions
+
+    @staticmethod
+    def _token_signer():
+        backend = storage.backend
+        signer = _token_signers.get(backend)
+        if signer is None:
+            signer = session_tokens.Signer(
+                backend.get_secret(SESSION_TOKEN_SECRET))
+            _token_signers[backend] = signer
+        return signer
+
+    @staticmethod
+    def _last_refresh_time(active_session):
+        if HEARTBEAT_WRITE_BEHIND:
+            return heartbeats.last_refresh_time(active_session)
+        return active_session.lastRefreshTime
+
+    @staticmethod
+    def _last_refresh_times(active_sessions):
+        """
+        :return: dict with the last refresh time of the sessions, by session
+        key
+        """
+        stored_times = dict((session.key, session.lastRefreshTime)
+                            for session in active_sessions)
+        if HEARTBEAT_WRITE_BEHIND and stored_times:
+            return heartbeats.last_refresh_times(stored_times)
+        return stored_times
+
+    @staticmethod
+    def _expiration_limit():
+        """
+        :return: time before which sessions not refreshed are expired
+        """
+        return utils.now() - \
+            datetime.timedelta(milliseconds=MAX_REMINDER_TIME)
 
     @staticmethod
-    def _remove_old_clients():
-        """Create Announcement & assign to memcache; used by
-        memcache cron job & putAnnouncement().
+    def _remove_old_clients(cursor=None, limit=None):
+        """Delete the sessions not refreshed within MAX_REMINDER_TIME.
+        :param cursor: cursor returned by a previous unfinished run
+        :param limit: expiration limit of the run being continued
+        :return: the SweepResult of the run
         """
-        limit = datetime.datetime.now() - \
-                datetime.timedelta(milliseconds=MAX_REMINDER_TIME)
-        logging.info("Deleting sessions older than " + unicode(limit))
-        # recover all sessions with lastRefreshTime older than limit
-        old_sessions = ActiveSession.query(
-            ActiveSession.lastRefreshTime < limit).fetch()
-        for old_session in old_sessions:
-            # delete old session
-            logging.info("Deleting session " + old_session.peerID)
-            old_session.key.delete()
-
-        return
+        if limit is None:
+            limit = ServerApi._expiration_limit()
+        return sweeper.sweep_expired_sessions(limit, cursor)
 
 
 api = endpoints.api_server([ServerApi])  # register API
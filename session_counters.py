@@ -0,0 +1,140 @@
+"""
+Counters of the active sessions of each country, and of how many of them
+wish regular connections.
+
+The counters are updated as sessions are created and removed (connect,
+disconnect, TOO_SOON refreshes and the sweeper), in sharded entities (see
+storage.COUNTER_SHARD_COUNT), so they are read without scanning the
+sessions. Expired sessions count until the sweeper removes them. Updates
+lost by failed requests, or applied twice by concurrent removals of the same
+session, make the counters drift: reconcile counts the sessions with a scan,
+and corrects the counters by the difference, and runs periodically as a
+cron. The scan is read in pages with cursors, and continued by later runs
+(chained as tasks) when it takes longer than a time budget.
+"""
+import logging
+import time
+
+import caches
+import storage
+
+# seconds that reads of the counters are cached
+READ_TTL = 30
+
+RECONCILE_PAGE_SIZE = 1000
+
+# seconds that a reconcile run can take. Leaves a safe margin below the
+# deadline of cron and task queue requests
+RECONCILE_TIME_BUDGET = 60
+
+_COUNTS_KEY = 'all'
+
+cache = caches.ReadThroughCache('session_counts', lru_size=1, ttl=READ_TTL,
+                                negative_ttl=READ_TTL)
+
+
+def record_changes_async(added_sessions=(), removed_sessions=()):
+    """
+    Updates the counters with created and removed sessions (a replaced
+    session is removed)
+    :return: list of futures of the updates
+    """
+    deltas = {}
+    for sessions, sign in ((added_sessions, 1), (removed_sessions, -1)):
+        for session in sessions:
+            online, wish_regular = deltas.get(session.clientCountryCode,
+                                              (0, 0))
+            deltas[session.clientCountryCode] = (
+                online + sign,
+                wish_regular + sign if session.wishRegularConnections
+                else wish_regular)
+    if not deltas:
+        return []
+    return storage.backend.update_session_counts_async(deltas)
+
+
+def get_counts():
+    """
+    :return: dict of the (online, wishRegularConnections) counters by country
+    code (up to READ_TTL seconds old)
+    """
+    return cache.get(_COUNTS_KEY, _load_counts)
+
+
+class ReconcileResult:
+    def __init__(self, counts, snapshot):
+        # (online, wishRegularConnections) counts of the sessions scanned so
+        # far, by country code
+        self.counts = counts
+        # counters when the scan started, by country code
+        self.snapshot = snapshot
+        # countries whose counters were corrected (once finished)
+        self.drifted = 0
+        self.pages = 0
+        # cursor to continue from if the run did not finish
+        self.cursor = None
+        self.finished = False
+
+
+def reconcile(cursor=None, counts=None, snapshot=None,
+              page_size=RECONCILE_PAGE_SIZE,
+              time_budget=RECONCILE_TIME_BUDGET):
+    """
+    Counts the sessions with a scan, and once the scan is finished adds to
+    the counters the difference between the counts and the counters when
+    the scan started, so that the updates made meanwhile are kept. Sessions
+    created or removed during the scan, before the scan reaches them, are
+    counted twice or missed until the next run: the error is bounded by the
+    session changes during the scan
+    :param cursor: cursor returned by the previous run (None to start)
+    :param counts: counts returned by the previous run (None to start)
+    :param snapshot: snapshot returned by the previous run (None to start)
+    :param time_budget: seconds after which no more pages are read
+    :return: ReconcileResult of the run
+    """
+    start = time.time()
+    if snapshot is None:
+        snapshot = storage.backend.get_session_counts(consistent=True)
+    result = ReconcileResult(dict(counts or {}), snapshot)
+    while True:
+        sessions, cursor, more = storage.backend.session_countries_page(
+            cursor, page_size)
+        result.pages += 1
+        for session in sessions:
+            online, wish_regular = result.counts.get(
+                session.clientCountryCode, (0, 0))
+            result.counts[session.clientCountryCode] = (
+                online + 1,
+                wish_regular + 1 if session.wishRegularConnections
+                else wish_regular)
+        if not more or not cursor:
+            result.finished = True
+            break
+        if time.time() - start >= time_budget:
+            result.cursor = cursor
+            return result
+    result.drifted = _correct_counters(result.counts, result.snapshot)
+    logging.info("Reconciled the session counters of %d countries (%d had "
+                 "drifted)", len(result.counts), result.drifted)
+    return result
+
+
+def _correct_counters(counts, previous_counts):
+    # the corrections go through the same transactional shard updates as the
+    # session changes, so concurrent updates are not overwritten
+    deltas = {}
+    for country_code in set(counts) | set(previous_counts):
+        online, wish_regular = counts.get(country_code, (0, 0))
+        previous_online, previous_wish_regular = previous_counts.get(
+            country_code, (0, 0))
+        if (online, wish_regular) != (previous_online, previous_wish_regular):
+            deltas[country_code] = (online - previous_online,
+                                    wish_regular - previous_wish_regular)
+    for future in storage.backend.update_session_counts_async(deltas):
+        future.wait()
+    cache.delete(_COUNTS_KEY)
+    return len(deltas)
+
+
+def _load_counts(key):
+    return storage.backend.get_session_counts()
@@ -0,0 +1,100 @@
+"""
+Signed session tokens, given to peers as their sessionID on connect.
+
+A token carries the peerID, the external IP address and the issue time of
+the session, signed with HMAC-SHA256 (truncated to MAC_SIZE bytes), so that
+malformed, forged and IP-mismatched session IDs are rejected in process,
+before any RPC. The issue time is the connectionTime of the session: a token
+of an older session of the same peer does not match the current session.
+
+Token layout (base64url without padding):
+version (1 byte), issue time (8 bytes, microseconds since the epoch),
+IP address length (1 byte), IP address, peerID (UTF-8), MAC
+"""
+import base64
+import collections
+import datetime
+import hashlib
+import hmac
+import struct
+
+VERSION = 1
+
+MAC_SIZE = 16
+
+# longest token accepted, so that huge bogus session IDs are rejected before
+# being decoded
+MAX_TOKEN_LENGTH = 512
+
+EPOCH = datetime.datetime(1970, 1, 1)
+
+_HEADER = struct.Struct('>BQB')
+
+SessionToken = collections.namedtuple(
+    'SessionToken', ['peer_id', 'external_ip', 'issue_time'])
+
+
+class Signer:
+    def __init__(self, secret):
+        """
+        :param secret: secret key of the HMAC (a byte string)
+        """
+        self._mac = hmac.new(secret, digestmod=hashlib.sha256)
+
+    def issue(self, peer_id, external_ip, issue_time):
+        """
+        :param issue_time: datetime of the issue (the connectionTime of the
+        session)
+        :return: the token, as a string
+        """
+        external_ip = external_ip.encode('utf-8')
+        payload = _HEADER.pack(VERSION, _to_microseconds(issue_time),
+                               len(external_ip)) + \
+            external_ip + peer_id.encode('utf-8')
+        return base64.urlsafe_b64encode(
+            payload + self._sign(payload)).rstrip('=')
+
+    def verify(self, token):
+        """
+        :return: the SessionToken of a token, or None if the token is not
+        valid (malformed, or not signed with the secret of this signer)
+        """
+        if not token or len(token) > MAX_TOKEN_LENGTH:
+            return None
+        try:
+            data = base64.urlsafe_b64decode(
+                str(token) + '=' * (-len(token) % 4))
+        except (TypeError, ValueError):
+            # not base64, or not ASCII
+            return None
+        if len(data) < _HEADER.size + MAC_SIZE:
+            return None
+        payload = data[:-MAC_SIZE]
+        if not hmac.compare_digest(self._sign(payload), data[-MAC_SIZE:]):
+            return None
+        version, issue_time, ip_length = _HEADER.unpack_from(payload)
+        if version != VERSION or \
+                len(payload) < _HEADER.size + ip_length:
+            return None
+        ip_end = _HEADER.size + ip_length
+        try:
+            return SessionToken(payload[ip_end:].decode('utf-8'),
+                                payload[_HEADER.size:ip_end].decode('utf-8'),
+                                _from_microseconds(issue_time))
+        except (UnicodeDecodeError, OverflowError):
+            return None
+
+    def _sign(self, payload):
+        mac = self._mac.copy()
+        mac.update(payload)
+        return mac.digest()[:MAC_SIZE]
+
+
+def _to_microseconds(time):
+    delta = time - EPOCH
+    return (delta.days * 86400 + delta.seconds) * 1000000 + \
+        delta.microseconds
+
+
+def _from_microseconds(microseconds):
+    return EPOCH + datetime.timedelta(microseconds=microseconds)
@@ -16,3 +16,12 @@ WEB_CLIENT_ID = '311275972649-gbaof9hp8eeks192ft5e4934fa7puod4.apps.googleuserco
 ANDROID_CLIENT_ID = 'replace with Android client ID'
 IOS_CLIENT_ID = 'replace with iOS client ID'
 ANDROID_AUDIENCE = WEB_CLIENT_ID
+
+# Service that checks whether the main server port of a connecting peer is
+# reachable. For local runs, point it to port_test_service.py:
+# PORT_TEST_SERVICE_URL = 'http://127.0.0.1:8080/porttestservice/ports'
+PORT_TEST_SERVICE_URL = 'http://139.162.162.223:8080/porttestservice/ports'
+
+# where peers and sessions are stored (see storage.py): 'ndb' for the
+# datastore, or 'memory' to keep them in the memory of the process
+STORAGE_BACKEND = 'ndb'
@@ -0,0 +1,20 @@
+import json
+import webapp2
+import instrumentation
+
+class EndpointStats(webapp2.RequestHandler):
+    def get(self):
+        """Report the endpoint, RPC and cache statistics of this instance."""
+        self.response.content_type = 'application/json'
+        self.response.write(json.dumps(instrumentation.stats(), indent=2,
+                                       sort_keys=True))
+
+    def post(self):
+        """Reset the statistics of this instance."""
+        instrumentation.reset()
+        self.response.set_status(204)
+
+
+app = webapp2.WSGIApplication([
+    ('/stats/endpoints', EndpointStats),
+], debug=True)
@@ -0,0 +1,406 @@
+"""
+Storage of peers (PeerData) and their sessions (ActiveSession).
+
+The server stores entities through the backend of this module, so that it
+can run on the datastore or entirely in process:
+- NdbStorage: the datastore, through ndb (the default)
+- memory_storage.MemoryStorage: dicts in the memory of the process, for
+  self-hosted runs and local benchmarks
+
+Entities are ndb model instances with both backends (the in-memory backend
+does not make any RPC with them). Each backend also provides the memcache
+used by the caches, available as storage.memcache.
+
+Methods ending in _async return futures (with a get_result method), so that
+callers can overlap them with other work.
+"""
+import os
+import random
+
+from google.appengine.api import datastore_errors
+from google.appengine.api import memcache as app_engine_memcache
+from google.appengine.ext import ndb
+from google.net.proto import ProtocolBuffer
+
+from models import PeerData
+from models import ActiveSession
+from models import ServerSecret
+from models import SessionCounterShard
+from settings import STORAGE_BACKEND
+
+# look up PeerData entities by the indexed peerID property if they are not
+# found by key. Can be disabled once migrations.py has converted them all
+LEGACY_PEER_DATA_LOOKUP = True
+
+# datastore keys looked up per get_multi call
+GET_MULTI_BATCH_SIZE = 1000
+
+SECRET_SIZE = 32
+
+# shards of the session counters of each country. Each update goes to a
+# random shard, so concurrent updates rarely write the same entity
+COUNTER_SHARD_COUNT = 20
+
+
+class Storage(object):
+    """
+    Interface of the storage backends. Peers and sessions are identified by
+    their peerID, except in the deletions of sessions that have been read,
+    which take the session key: legacy sessions (see session_id) have auto
+    IDs.
+    """
+
+    # memcache client of the backend (the memcache module API)
+    memcache = None
+
+    def get_peer(self, peer_id):
+        """
+        :return: the PeerData of a peer, or None if it is not registered
+        """
+        raise NotImplementedError()
+
+    def put_peer(self, peer_data):
+        raise NotImplementedError()
+
+    def get_session(self, peer_id):
+        """
+        :return: the ActiveSession of a peer, or None if it has none
+        """
+        raise NotImplementedError()
+
+    def get_sessions(self, peer_ids):
+        """
+        :return: dict with the ActiveSessions of the peers that have one, by
+        peerID
+        """
+        raise NotImplementedError()
+
+    def get_session_by_id(self, session_id):
+        """
+        :param session_id: legacy session ID (see session_id)
+        :return: the ActiveSession, or None if the session ID is unknown or
+        not valid
+        """
+        raise NotImplementedError()
+
+    def get_sessions_by_id(self, session_ids):
+        """
+        :param session_ids: list of legacy session IDs (see session_id)
+        :return: dict with the ActiveSessions of the session IDs that are
+        known and valid, by session ID
+        """
+        raise NotImplementedError()
+
+    def session_id(self, session):
+        """
+        :return: the legacy session ID of a stored session (its key), as
+        handed out before session tokens (see session_tokens.py)
+        """
+        return session.key.urlsafe()
+
+    def put_session(self, session):
+        raise NotImplementedError()
+
+    def put_sessions(self, sessions):
+        raise NotImplementedError()
+
+    def replace_session_async(self, session):
+        """
+        Stores a new session in place of the existing session of its peer
+        :return: future of the replaced session, or None if the peer had no
+        session
+        """
+        raise NotImplementedError()
+
+    def delete_session(self, session_key):
+        raise NotImplementedError()
+
+    def delete_sessions_async(self, session_keys):
+        """
+        :return: list of futures of the deletions
+        """
+        raise NotImplementedError()
+
+    def regular_peer_ids(self, country_code, limit):
+        """
+        :return: list with the peerIDs of the sessions of a country that
+        wish regular connections (at most limit)
+        """
+        raise NotImplementedError()
+
+    def regular_peer_ids_page(self, country_code, page_size, cursor=None):
+        """
+        Reads a page of the peerIDs of the sessions of a country that wish
+        regular connections, in a fixed order
+        :param cursor: cursor returned for the previous page (None to start)
+        :return: (list of peerIDs, cursor of the next page as a string, or
+        None if there are no more pages)
+        :raise ValueError: if the cursor is not valid
+        """
+        raise NotImplementedError()
+
+    def get_secret(self, name):
+        """
+        :return: a random secret shared by all the server instances (a byte
+        string), created on first use
+        """
+        raise NotImplementedError()
+
+    def update_session_counts_async(self, deltas):
+        """
+        Adds to the session counters of countries
+        :param deltas: dict of (online, wishRegularConnections) deltas by
+        country code
+        :return: list of futures of the updates
+        """
+        raise NotImplementedError()
+
+    def get_session_counts(self, consistent=False):
+        """
+        :param consistent: see every update of the counters made before the
+        call (slower)
+        :return: dict of the (online, wishRegularConnections) counters by
+        country code
+        """
+        raise NotImplementedError()
+
+    def session_countries_page(self, cursor=None, page_size=1000):
+        """
+        Reads a page of all the sessions. The sessions only need to have
+        their key, clientCountryCode and wishRegularConnections
+        :param cursor: cursor returned for the previous page (None to start)
+        :return: (list of sessions, cursor of the next page, whether there
+        are more pages)
+        """
+        raise NotImplementedError()
+
+    def expired_sessions_page(self, limit, cursor=None, page_size=500):
+        """
+        Reads a page of the sessions last refreshed before a limit. The
+        sessions only need to have their key, lastRefreshTime,
+        clientCountryCode and wishRegularConnections
+        :param cursor: cursor returned for the previous page (None to start)
+        :return: (list of sessions, cursor of the next page, whether there
+        are more pages)
+        """
+        raise NotImplementedError()
+
+
+class CompletedFuture:
+    """
+    Future of an operation that has already completed
+    """
+
+    def __init__(self, result=None):
+        self._result = result
+
+    def get_result(self):
+        return self._result
+
+    def wait(self):
+        pass
+
+    def done(self):
+        return True
+
+
+class NdbStorage(Storage):
+    memcache = app_engine_memcache
+
+    def get_peer(self, peer_id):
+        peer_data = PeerData.get_by_id(peer_id)
+        if not peer_data and LEGACY_PEER_DATA_LOOKUP:
+            # not yet migrated to a peerID key
+            peer_data = PeerData.query(PeerData.peerID == peer_id).get()
+        return peer_data
+
+    def put_peer(self, peer_data):
+        peer_data.put()
+
+    def get_session(self, peer_id):
+        return ActiveSession.get_by_id(peer_id)
+
+    def get_sessions(self, peer_ids):
+        # all the batches are issued before waiting for any of them
+        futures = []
+        for i in range(0, len(peer_ids), GET_MULTI_BATCH_SIZE):
+            batch = peer_ids[i:i + GET_MULTI_BATCH_SIZE]
+            futures.extend(ndb.get_multi_async(
+                [ndb.Key(ActiveSession, peer_id) for peer_id in batch]))
+        sessions = {}
+        for future in futures:
+            session = future.get_result()
+            if session:
+                sessions[session.peerID] = session
+        return sessions
+
+    def get_session_by_id(self, session_id):
+        session_key = _session_key(session_id)
+        if session_key is None:
+            return None
+        return session_key.get()
+
+    def get_sessions_by_id(self, session_ids):
+        session_keys = {}
+        for session_id in session_ids:
+            session_key = _session_key(session_id)
+            if session_key is not None:
+                session_keys[session_id] = session_key
+        sessions = ndb.get_multi(session_keys.values())
+        return dict((session_id, session) for session_id, session
+                    in zip(session_keys.keys(), sessions) if session)
+
+    def put_session(self, session):
+        session.put()
+
+    def put_sessions(self, sessions):
+        ndb.put_multi(sessions)
+
+    def replace_session_async(self, session):
+        return _replace_session_async(session)
+
+    def delete_session(self, session_key):
+        session_key.delete()
+
+    def delete_sessions_async(self, session_keys):
+        return ndb.delete_multi_async(list(session_keys))
+
+    def regular_peer_ids(self, country_code, limit):
+        return [key.id() for key in ActiveSession.query(
+            ActiveSession.clientCountryCode == country_code,
+            ActiveSession.wishRegularConnections == True).fetch(
+            limit, keys_only=True)]
+
+    def regular_peer_ids_page(self, country_code, page_size, cursor=None):
+        # keys-only, as the PeerIDInfo properties are not indexed (they are
+        # read from peer_info_cache). Results are in key order. A cursor that
+        # decodes but belongs to another query is rejected by the fetch
+        try:
+            if cursor is not None:
+                cursor = ndb.Cursor(urlsafe=cursor)
+            keys, next_cursor, more = ActiveSession.query(
+                ActiveSession.clientCountryCode == country_code,
+                ActiveSession.wishRegularConnections == True).fetch_page(
+                page_size, start_cursor=cursor, keys_only=True)
+        except (TypeError, ValueError,
+                ProtocolBuffer.ProtocolBufferDecodeError,
+                datastore_errors.BadArgumentError,
+                datastore_errors.BadValueError,
+                datastore_errors.BadRequestError):
+            raise ValueError("Invalid cursor: %r" % cursor)
+        return ([key.id() for key in keys],
+                next_cursor.urlsafe() if more and next_cursor else None)
+
+    def get_secret(self, name):
+        return ServerSecret.get_or_insert(
+            name, value=os.urandom(SECRET_SIZE)).value
+
+    def update_session_counts_async(self, deltas):
+        return [_update_counter_shard_async(
+                    country_code, random.randrange(COUNTER_SHARD_COUNT),
+                    online, wish_regular)
+                for country_code, (online, wish_regular) in deltas.items()
+                if online or wish_regular]
+
+    def get_session_counts(self, consistent=False):
+        # a single query over the (few) shards of all countries. Queries are
+        # eventually consistent: consistent reads get the shards that a
+        # keys-only query finds by key, and only miss the updates of shards
+        # created just before the call
+        if consistent:
+            shards = ndb.get_multi(
+                SessionCounterShard.query().fetch(keys_only=True))
+        else:
+            shards = SessionCounterShard.query()
+        counts = {}
+        for shard in shards:
+            if shard is None:
+                continue
+            online, wish_regular = counts.get(shard.clientCountryCode, (0, 0))
+            counts[shard.clientCountryCode] = (
+                online + shard.online,
+                wish_regular + shard.wishRegularConnections)
+        return counts
+
+    def session_countries_page(self, cursor=None, page_size=1000):
+        # projection query, as cheap as a keys-only query
+        return ActiveSession.query().fetch_page(
+            page_size, start_cursor=cursor,
+            projection=[ActiveSession.clientCountryCode,
+                        ActiveSession.wishRegularConnections])
+
+    def expired_sessions_page(self, limit, cursor=None, page_size=500):
+        # projection query, as cheap as a keys-only query
+        return ActiveSession.query(
+            ActiveSession.lastRefreshTime < limit).fetch_page(
+            page_size, start_cursor=cursor,
+            projection=[ActiveSession.lastRefreshTime,
+                        ActiveSession.clientCountryCode,
+                        ActiveSession.wishRegularConnections])
+
+
+def _session_key(session_id):
+    # None for session IDs that are not keys of sessions
+    try:
+        session_key = ndb.Key(urlsafe=session_id)
+    except (TypeError, ValueError, ProtocolBuffer.ProtocolBufferDecodeError,
+            datastore_errors.Error):
+        # not base64, not a serialized key, or not a valid key
+        return None
+    if session_key.kind() != ActiveSession._get_kind():
+        return None
+    return session_key
+
+
+@ndb.transactional_tasklet
+def _replace_session_async(session):
+    # reads in a transaction see the data as of its start, so the read of the
+    # replaced session and the write are issued together
+    existing_session, _ = yield (
+        session.key.get_async(use_cache=False),
+        session.put_async())
+    raise ndb.Return(existing_session)
+
+
+def _counter_shard_key(country_code, shard):
+    return ndb.Key(SessionCounterShard, '%s:%d' % (country_code, shard))
+
+
+@ndb.transactional_tasklet
+def _update_counter_shard_async(country_code, shard, online, wish_regular):
+    key = _counter_shard_key(country_code, shard)
+    counter = yield key.get_async()
+    if counter is None:
+        counter = SessionCounterShard(key=key, clientCountryCode=country_code)
+    counter.online += online
+    counter.wishRegularConnections += wish_regular
+    yield counter.put_async()
+
+
+class _MemcacheProxy(object):
+    """
+    Forwards memcache calls to the memcache of the current backend
+    """
+
+    def __getattr__(self, name):
+        return getattr(backend.memcache, name)
+
+
+def use(new_backend):
+    """
+    Replaces the storage backend
+    """
+    global backend
+    backend = new_backend
+
+
+def _default_backend():
+    if STORAGE_BACKEND == 'memory':
+        import memory_storage
+        return memory_storage.MemoryStorage()
+    return NdbStorage()
+
+
+memcache = _MemcacheProxy()
+
+backend = _default_backend()
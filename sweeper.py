@@ -0,0 +1,122 @@
+"""
+Removal of expired sessions.
+
+Expired sessions are found with projection queries on lastRefreshTime and
+the peer pool properties (as cheap as keys-only queries), read in pages with
+cursors, and deleted with asynchronous batch deletes that overlap with the
+reading of the next page. Write-behind refreshes leave the stored refresh
+time of live sessions up to FLUSH_AGE old (see heartbeats.py), so pages also
+hold the live sessions whose last refresh was recorded as a heartbeat. They
+are kept, and read again by each run until their next refresh writes them.
+A run stops when its time budget is spent, and returns a cursor from which a
+later run continues.
+"""
+import datetime
+import logging
+import time
+
+import change_log
+import heartbeats
+import peer_info_cache
+import peer_pool
+import session_counters
+import storage
+
+DEFAULT_PAGE_SIZE = 500
+
+# seconds that a run can take. Leaves a safe margin below the deadline of
+# cron and task queue requests
+DEFAULT_TIME_BUDGET = 60
+
+# format of the expiration limit when passed between runs
+LIMIT_FORMAT = '%Y-%m-%dT%H:%M:%S.%f'
+
+
+class SweepResult:
+    def __init__(self, limit):
+        # sessions last refreshed before this time are expired
+        self.limit = limit
+        self.deleted = 0
+        # sessions kept thanks to a heartbeat (or to the grace of sessions
+        # that may have lost it, see heartbeats.expired)
+        self.kept = 0
+        self.pages = 0
+        self.duration = 0.0
+        # cursor to continue from if the run did not finish
+        self.cursor = None
+        self.finished = False
+
+
+def sweep_expired_sessions(limit, cursor=None, page_size=DEFAULT_PAGE_SIZE,
+                           time_budget=DEFAULT_TIME_BUDGET):
+    """
+    Deletes sessions last refreshed before a limit
+    :param limit: expiration limit. Runs continuing a previous run must use
+    the same limit, so that its cursor is valid
+    :param cursor: cursor returned by the previous run (None to start)
+    :param page_size: number of keys read (and deleted) per batch
+    :param time_budget: seconds after which no more pages are read
+    :return: SweepResult of the run
+    """
+    start = time.time()
+    result = SweepResult(limit)
+    futures = []
+    while True:
+        sessions, cursor, more = storage.backend.expired_sessions_page(
+            limit, cursor, page_size)
+        result.pages += 1
+        if sessions:
+            futures.extend(
+                _sweep_page(sessions, limit, result))
+        if not more or not cursor:
+            result.finished = True
+            break
+        if time.time() - start >= time_budget:
+            result.cursor = cursor
+            break
+    for future in futures:
+        future.wait()
+    result.duration = time.time() - start
+    logging.info(
+        "Swept sessions older than %s: %d deleted, %d kept by heartbeats "
+        "in %d pages, %.2f s%s",
+        limit, result.deleted, result.kept, result.pages,
+        result.duration,
+        "" if result.finished else " (continuing in a new run)")
+    return result
+
+
+def _sweep_page(sessions, limit, result):
+    # sessions only carry their key and the projected properties. Kept
+    # sessions are not written back: their next refresh writes them
+    expired_keys = heartbeats.expired_keys(
+        dict((session.key, session.lastRefreshTime) for session in sessions),
+        limit)
+    expired_sessions = [session for session in sessions
+                        if session.key in expired_keys]
+    expired_pool_peers = {}
+    for session in expired_sessions:
+        if session.wishRegularConnections:
+            expired_pool_peers.setdefault(
+                session.clientCountryCode, []).append(session.key.id())
+    result.deleted += len(expired_sessions)
+    result.kept += len(sessions) - len(expired_sessions)
+    futures = []
+    if expired_sessions:
+        expired_peer_ids = [session.key.id() for session in expired_sessions]
+        futures.extend(storage.backend.delete_sessions_async(
+            [session.key for session in expired_sessions]))
+        futures.extend(session_counters.record_changes_async(
+            removed_sessions=expired_sessions))
+        peer_info_cache.invalidate(expired_peer_ids)
+        change_log.record_removals(expired_peer_ids)
+        peer_pool.remove_multi(expired_pool_peers)
+    return futures
+
+
+def format_limit(limit):
+    return limit.strftime(LIMIT_FORMAT)
+
+
+def parse_limit(limit):
+    return datetime.datetime.strptime(limit, LIMIT_FORMAT)
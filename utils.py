@@ -1,5 +1,64 @@
+import datetime
+import logging
 import random, string
+import time
+
+# source of the current time (in seconds since the epoch) of the server.
+# Simulations replace it with set_clock to run in virtual time
+_clock = time.time
+
 
 def generate_session_id(length):
     return ''.join(random.choice(string.ascii_uppercase + string.digits)
                     for x in xrange(length))
+
+
+def timestamp():
+    """
+    :return: current time in seconds since the epoch
+    """
+    return _clock()
+
+
+def now():
+    """
+    :return: current local time, as datetime.datetime.now()
+    """
+    return datetime.datetime.fromtimestamp(_clock())
+
+
+def set_clock(clock):
+    """
+    Replaces the source of the current time
+    :param clock: function returning the time in seconds since the epoch
+    (time.time to restore the real time)
+    """
+    global _clock
+    _clock = clock
+
+
+class StageTimer:
+    """
+    Measures the time taken by the consecutive stages of a request. Each
+    stage is the time elapsed since the previous mark, so for stages that
+    overlap it is the time the request waited for them.
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.stages = []
+        self._start = self._last = time.time()
+
+    def mark(self, stage):
+        now = time.time()
+        self.stages.append((stage, now - self._last))
+        self._last = now
+
+    def total(self):
+        return self._last - self._start
+
+    def log(self):
+        if logging.getLogger().isEnabledFor(logging.DEBUG):
+            logging.debug("%s: %.1f ms (%s)", self.name, self.total() * 1000,
+                          ', '.join('%s %.1f ms' % (stage, duration * 1000)
+                                    for stage, duration in self.stages))